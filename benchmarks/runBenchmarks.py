@@ -0,0 +1,213 @@
+import numpy as np
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import subprocess
+import multiprocessing
+from datetime import datetime, timedelta
+
+"""
+Benchmarks of every stage of the scripts on the synthetic inputs of
+synthData.py. Every stage runs in a new process, so the peak memory (RSS)
+of one does not count in the next one; its inputs are prepared in that
+process before the timer starts (the peak RSS includes them).
+For every stage, the wall time, peak RSS and rows per second are saved in
+results/<commit>.json (and compared with another result with --compare).
+
+python3 runBenchmarks.py [--scale small|medium|nyc] [--stages importDatabase,fcd2counts] [--compare results/abc.json]
+"""
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'trips'))
+sys.path.insert(0, BENCH_DIR)
+
+from synthData import makeFixtures, OFFSET, START_DATE, SCALES
+
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+def dateRange(fx):
+    """
+    Dates (yyyy/mm/dd) of the months of trips of the fixtures.
+    """
+    end = START_DATE
+    for m in range(fx['months']):
+        end = (end + timedelta(days=32)).replace(day=1)
+    return START_DATE.strftime('%Y/%m/%d'), end.strftime('%Y/%m/%d')
+
+def zonesReq(fx):
+    return list(range(1, fx['zones'] + 1))
+
+def classify(fx):
+    from tripsGenerator import geojson2plygons, classifyLanes
+    from netReader import iterEdges, iterLanes
+    polys = geojson2plygons(fx['zones_path'], zonesReq(fx))
+    return classifyLanes(iterLanes(iterEdges(fx['map_path'], 'private', None, offset=OFFSET, verbose=0)), polys)
+
+def loadTrips(fx, work):
+    from tripsGenerator import importDatabase
+    sdate, edate = dateRange(fx)
+    os.makedirs(os.path.join(work, "cache"), exist_ok=True)
+    return importDatabase(sdate, edate, os.path.join(work, "cache"), verbose=0, zones_req=zonesReq(fx),
+                          source=fx['tlc_dir'])
+
+# Stages: function(fixtures, work directory) -> (rows, seconds)
+
+def benchImportDatabase(fx, work):
+    shutil.rmtree(os.path.join(work, "cache"), ignore_errors=True) # Cold cache
+    begin = time.perf_counter()
+    df = loadTrips(fx, work)
+    return len(df), time.perf_counter() - begin
+
+def benchClassifyEdges(fx, work):
+    begin = time.perf_counter()
+    tazs = classify(fx)
+    return sum(len(edges) for edges in tazs.values()), time.perf_counter() - begin
+
+def benchWriteTazFile(fx, work):
+    from tripsGenerator import writeTazFile
+    tazs = classify(fx)
+    begin = time.perf_counter()
+    writeTazFile(os.path.join(work, "tazs.xml"), fx['zones_path'], tazs, zonesReq(fx), offset=OFFSET)
+    return len(tazs), time.perf_counter() - begin
+
+def benchWriteTripsFile(fx, work):
+    from tripsGenerator import writeTripsFile
+    tazs = classify(fx)
+    df = loadTrips(fx, work)
+    sdate, edate = dateRange(fx)
+    begin = time.perf_counter()
+    writeTripsFile(os.path.join(work, "trips.xml"), zonesReq(fx), tazs, df, sdate, edate, seed=0)
+    return len(df), time.perf_counter() - begin
+
+def benchGenerateOD(fx, work):
+    # The path of generateOD.py with --cache-dir: the months are streamed from
+    # the cache and the matrices are written by blocks in OD_matrices_bench.npy
+    from generateOD import streamODMatrices
+    from tlcData import parseDate, cacheMonths
+    sdate, edate = dateRange(fx)
+    cache_dir = os.path.join(work, "cache")
+    cacheMonths(parseDate(sdate), parseDate(edate), cache_dir, source=fx['tlc_dir'])
+    os.chdir(work)
+    begin = time.perf_counter()
+    rows, _ = streamODMatrices(parseDate(sdate), parseDate(edate), "bench", 1, cache_dir=cache_dir,
+                               source=fx['tlc_dir'])
+    return rows, time.perf_counter() - begin
+
+def benchConvertToVMR(fx, work, n_matrices=48):
+    from numpyToVisum import exportVMR
+    path = os.path.join(work, "OD_matrices_bench.npy")
+    if not os.path.exists(path):
+        benchGenerateOD(fx, work)
+    out = os.path.join(work, "vmr")
+    os.makedirs(out, exist_ok=True)
+    os.chdir(out)
+    begin = time.perf_counter()
+    exportVMR(path, 0, n_matrices, interval=1)
+    return n_matrices, time.perf_counter() - begin
+
+def benchFcd2counts(fx, work):
+    from fcd2counts import FcdCounter
+    counter = FcdCounter(fx['zones_path'], zonesReq(fx), OFFSET)
+    begin = time.perf_counter()
+    counter.write(fx['fcd_path'], os.path.join(work, "counts.csv"), verbose=0)
+    return fx['fcd_seconds'] // 3, time.perf_counter() - begin # Timesteps of the file
+
+STAGES = [('importDatabase', benchImportDatabase),
+          ('classifyEdges', benchClassifyEdges),
+          ('writeTazFile', benchWriteTazFile),
+          ('writeTripsFile', benchWriteTripsFile),
+          ('generateOD', benchGenerateOD),
+          ('convertToVMR', benchConvertToVMR),
+          ('fcd2counts', benchFcd2counts)]
+
+def runStage(name, fx, work, queue):
+    """
+    Body of the process of a stage: run it and send its measures.
+    """
+    stage = dict(STAGES)[name]
+    # The prints of the scripts are not part of the results
+    sys.stdout = open(os.devnull, 'w')
+    rows, seconds = stage(fx, work)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # kB in Linux
+    queue.put({'rows': int(rows), 'wall_s': seconds, 'peak_rss_mb': peak_kb / 1024.0,
+               'rows_per_s': rows / seconds if seconds > 0 else None})
+
+def measure(name, fx, work):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=runStage, args=(name, fx, work, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {'error': "exit code {0}".format(process.exitcode)}
+    return queue.get()
+
+def gitCommit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=ROOT_DIR) != 0
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(results, previous):
+    """
+    Print the ratio of the times and peak memory of `results` to `previous`.
+    """
+    print("Compared with {0}:".format(previous['commit']))
+    for name, stage in results['stages'].items():
+        old = previous['stages'].get(name)
+        if old is None or 'error' in old or 'error' in stage:
+            continue
+        print("  {0:16s} time x{1:.2f}  peak RSS x{2:.2f}".format(
+            name, stage['wall_s'] / old['wall_s'], stage['peak_rss_mb'] / old['peak_rss_mb']))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the stages on synthetic data")
+    parser.add_argument("--scale", default='small', choices=sorted(SCALES), help="size of the inputs")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the inputs")
+    parser.add_argument("--data-dir", default=None,
+                        help="directory of the inputs, generated if missing (benchData_<scale> by default)")
+    parser.add_argument("--stages", default=None, help="stages to run, separated by commas (all by default)")
+    parser.add_argument("--output", default=None, help="json with the results (results/<commit>.json by default)")
+    parser.add_argument("--compare", default=None, help="json with previous results to compare with")
+    args = parser.parse_args()
+
+    data_dir = os.path.abspath(args.data_dir or os.path.join(BENCH_DIR, "benchData_{0}".format(args.scale)))
+    fixtures_path = os.path.join(data_dir, "fixtures.json")
+    fx = json.load(open(fixtures_path)) if os.path.exists(fixtures_path) else None
+    if fx is None or fx['seed'] != args.seed or any(fx[k] != v for k, v in SCALES[args.scale].items()):
+        print("Writing the synthetic inputs in {0}".format(data_dir))
+        fx = makeFixtures(data_dir, args.scale, args.seed)
+    work = os.path.join(data_dir, "work")
+    os.makedirs(work, exist_ok=True)
+
+    names = [name for name, _ in STAGES] if args.stages is None else args.stages.split(',')
+    commit = gitCommit()
+    results = {'commit': commit, 'date': datetime.now().isoformat(timespec='seconds'),
+               'scale': args.scale, 'seed': args.seed, 'cpus': os.cpu_count(), 'stages': {}}
+    for name in names:
+        results['stages'][name] = measure(name, fx, work)
+        stage = results['stages'][name]
+        if 'error' in stage:
+            print("{0:16s} failed: {1}".format(name, stage['error']))
+        else:
+            print("{0:16s} {1:9.3f} s  {2:8.1f} MB  {3:12.0f} rows/s".format(
+                name, stage['wall_s'], stage['peak_rss_mb'], stage['rows_per_s'] or 0))
+
+    output = args.output or os.path.join(RESULTS_DIR, "{0}_{1}.json".format(commit, args.scale))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fout:
+        json.dump(results, fout, indent=1)
+    print("Results saved in {0}".format(output))
+    if args.compare is not None:
+        compare(results, json.load(open(args.compare)))
+
+if __name__ == '__main__':
+    main()
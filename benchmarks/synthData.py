@@ -0,0 +1,204 @@
+import numpy as np
+import os
+import json
+import argparse
+from datetime import datetime, timedelta
+
+"""
+Deterministic synthetic inputs for the scripts, at configurable scale:
+    - zones.geojson: a grid of square zones (some of them MultiPolygons) with
+      OBJECTID and LocationID.
+    - map.net.xml: a SUMO network with typed edges (allowed and disallowed
+      vehicle classes), lanes and internal edges over the zones.
+    - tlc/yellow_tripdata_YYYY-MM.csv: monthly trips with the TLC schema.
+    - fcd.txt: SUMO FCD output of vehicles moving over the zones.
+The same seed and scale give the same files.
+
+python3 synthData.py OUTPUT_DIR [--scale small|medium|nyc] [--seed 0]
+"""
+
+# Offset of the SUMO network (the one of the NYC map)
+OFFSET = (-584029.48, -4507296.15)
+
+SCALES = {
+    'small': {'zones': 20, 'edges': 3000, 'months': 1, 'trips_per_month': 20000,
+              'fcd_seconds': 3600, 'vehicles': 60},
+    'medium': {'zones': 100, 'edges': 30000, 'months': 2, 'trips_per_month': 250000,
+               'fcd_seconds': 4 * 3600, 'vehicles': 500},
+    'nyc': {'zones': 263, 'edges': 100000, 'months': 3, 'trips_per_month': 1000000,
+            'fcd_seconds': 6 * 3600, 'vehicles': 2000},
+}
+
+START_DATE = datetime(2017, 10, 1)
+
+TLC_COLUMNS = ['VendorID', 'tpep_pickup_datetime', 'tpep_dropoff_datetime', 'passenger_count',
+               'trip_distance', 'RatecodeID', 'store_and_fwd_flag', 'PULocationID', 'DOLocationID',
+               'payment_type', 'fare_amount', 'extra', 'mta_tax', 'tip_amount', 'tolls_amount',
+               'improvement_surcharge', 'total_amount']
+
+EDGE_TYPES = [('highway.primary', 'numLanes="2" speed="13.89" disallow="pedestrian"'),
+              ('highway.residential', 'numLanes="1" speed="13.89" allow="private bus"'),
+              ('highway.footway', 'numLanes="1" speed="2.00" allow="pedestrian"')]
+
+def gridSide(n_zones):
+    return int(np.ceil(np.sqrt(n_zones)))
+
+def makeZones(path, n_zones, cell=1000.0):
+    """
+    Write a geojson with `n_zones` square zones of `cell` meters in a grid,
+    in the coordinates of the network without offset. One of every seven
+    zones is a MultiPolygon of two parts.
+    """
+    side = gridSide(n_zones)
+    features = []
+    for i in range(n_zones):
+        r, c = divmod(i, side)
+        x0, y0 = -OFFSET[0] + c * cell, -OFFSET[1] + r * cell
+        if i % 7 == 3:
+            low = [[x0, y0], [x0+cell, y0], [x0+cell, y0+cell*0.5], [x0, y0+cell*0.5], [x0, y0]]
+            high = [[x0, y0+cell*0.5], [x0+cell, y0+cell*0.5], [x0+cell, y0+cell], [x0, y0+cell], [x0, y0+cell*0.5]]
+            geometry = {'type': 'MultiPolygon', 'coordinates': [[low], [high]]}
+        else:
+            geometry = {'type': 'Polygon', 'coordinates': [[[x0, y0], [x0+cell, y0], [x0+cell, y0+cell],
+                                                            [x0, y0+cell], [x0, y0]]]}
+        features.append({'type': 'Feature', 'geometry': geometry,
+                         'properties': {'OBJECTID': i+1, 'LocationID': i+1, 'zone': "Zone {0}".format(i+1)}})
+    with open(path, 'w') as fout:
+        json.dump({'type': 'FeatureCollection', 'features': features}, fout)
+
+def makeNet(path, n_zones, n_edges, cell=1000.0, seed=0):
+    """
+    Write a net.xml with `n_edges` edges of the EDGE_TYPES (one or two lanes
+    of four points) over the zones, and an internal edge every 50.
+    """
+    rng = np.random.default_rng(seed)
+    width = gridSide(n_zones) * cell
+    with open(path, 'w') as fout:
+        fout.write('<?xml version="1.0" encoding="UTF-8"?>\n<net version="1.0">\n')
+        fout.write('    <location netOffset="{0:.2f},{1:.2f}"/>\n'.format(*OFFSET))
+        for name, attributes in EDGE_TYPES:
+            fout.write('    <type id="{0}" priority="1" {1}/>\n'.format(name, attributes))
+        starts = rng.uniform(0, width, (n_edges, 2))
+        steps = rng.uniform(-150, 150, (n_edges, 2, 3, 2))
+        for e in range(n_edges):
+            x, y = starts[e]
+            if e % 50 == 0:
+                fout.write('    <edge id=":j{0}" function="internal">\n'
+                           '        <lane id=":j{0}_0" index="0" speed="1.00" length="1.00" shape="{1:.2f},{2:.2f} {3:.2f},{4:.2f}"/>\n'
+                           '    </edge>\n'.format(e, x, y, x+1, y+1))
+                continue
+            fout.write('    <edge id="e{0}" from="n{0}" to="n{1}" priority="1" type="{2}">\n'.format(
+                e, e+1, EDGE_TYPES[e % len(EDGE_TYPES)][0]))
+            for l in range(1 + e % 2):
+                points = np.cumsum(np.vstack([[x + l*3.2, y], steps[e, l]]), axis=0)
+                fout.write('        <lane id="e{0}_{1}" index="{1}" speed="13.89" length="100.00" shape="{2}"/>\n'.format(
+                    e, l, " ".join("{0:.2f},{1:.2f}".format(px, py) for px, py in points)))
+            fout.write('    </edge>\n')
+        fout.write('</net>\n')
+
+def timeStrings(times):
+    """
+    Datetimes in the format of the TLC files, yyyy-mm-dd HH:MM:SS.
+    """
+    return np.array([t.replace('T', ' ') for t in times.astype(str).tolist()])
+
+def makeTrips(directory, n_zones, months, trips_per_month, seed=0):
+    """
+    Write `months` monthly csv files from START_DATE with `trips_per_month`
+    trips each, sorted by pickup time, between the zones 1..`n_zones` (with
+    a few trips to the unknown zones 264 and 265).
+    Outputs:
+        - List of the paths written.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    weights = rng.pareto(1.2, n_zones) + 0.1
+    weights /= weights.sum()
+    paths = []
+    month = START_DATE
+    for m in range(months):
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        seconds = int((next_month - month).total_seconds())
+        n = trips_per_month
+        pickups = np.datetime64(month, 's') + np.sort(rng.integers(0, seconds, n)).astype('timedelta64[s]')
+        dropoffs = pickups + rng.integers(60, 3600, n).astype('timedelta64[s]')
+        origins = rng.choice(n_zones, n, p=weights) + 1
+        destinations = rng.choice(n_zones, n, p=weights) + 1
+        unknown = rng.random(n) < 0.01
+        destinations[unknown] = rng.integers(264, 266, unknown.sum())
+        fare = np.round(rng.gamma(2.0, 6.0, n), 2)
+        path = os.path.join(directory, "yellow_tripdata_{0:%Y-%m}.csv".format(month))
+        columns = [np.full(n, 1), timeStrings(pickups), timeStrings(dropoffs), rng.integers(1, 5, n),
+                   np.round(rng.gamma(2.0, 1.5, n), 2), np.full(n, 1), np.full(n, 'N'), origins, destinations,
+                   np.full(n, 1), fare, np.full(n, 0.5), np.full(n, 0.5), np.zeros(n), np.zeros(n),
+                   np.full(n, 0.3), np.round(fare + 1.3, 2)]
+        with open(path, 'w') as fout:
+            fout.write(",".join(TLC_COLUMNS) + "\n")
+            block = 200000
+            for start in range(0, n, block):
+                rows = zip(*[c[start:start+block].tolist() for c in columns])
+                fout.write("".join(",".join(map(str, row)) + "\n" for row in rows))
+        paths.append(path)
+        month = next_month
+    return paths
+
+def makeFcd(path, n_zones, seconds, vehicles, step=3, cell=1000.0, seed=0):
+    """
+    Write a FCD output with `vehicles` vehicles doing random walks over the
+    zones, a timestep every `step` seconds during `seconds` seconds. About
+    80% of the vehicles are active at every timestep, and some of them are
+    on the borders of the zones.
+    """
+    rng = np.random.default_rng(seed)
+    width = gridSide(n_zones) * cell
+    positions = rng.uniform(0, width, (vehicles, 2))
+    with open(path, 'w') as fout:
+        fout.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<fcd-export xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+        for t in range(0, seconds, step):
+            positions = (positions + rng.normal(0, 20, positions.shape)) % width
+            active = np.flatnonzero(rng.random(vehicles) < 0.8)
+            speeds = np.abs(rng.normal(8, 3, len(active)))
+            x = positions[active, 0].copy()
+            border = active % 13 == 0
+            x[border] = np.round(x[border] / cell) * cell
+            lines = "".join('        <vehicle id="veh{0}" x="{1:.2f}" y="{2:.2f}" angle="0.00" type="DEFAULT_VEHTYPE" '
+                            'speed="{3:.2f}" pos="1.00" lane="e1_0" slope="0.00"/>\n'.format(v, px, py, s)
+                            for v, px, py, s in zip(active.tolist(), x.tolist(), positions[active, 1].tolist(),
+                                                    speeds.tolist()))
+            fout.write('    <timestep time="{0:.2f}">\n'.format(t) + lines + '    </timestep>\n')
+        fout.write('</fcd-export>\n')
+
+def makeFixtures(directory, scale='small', seed=0):
+    """
+    Write all the synthetic inputs of `scale` (a name of SCALES or a
+    dictionary like them) in `directory`.
+    Outputs:
+        - Dictionary with the paths and the parameters of the fixtures.
+    """
+    params = SCALES[scale] if isinstance(scale, str) else scale
+    os.makedirs(directory, exist_ok=True)
+    fixtures = dict(params, seed=seed,
+                    zones_path=os.path.join(directory, "zones.geojson"),
+                    map_path=os.path.join(directory, "map.net.xml"),
+                    tlc_dir=os.path.join(directory, "tlc"),
+                    fcd_path=os.path.join(directory, "fcd.txt"))
+    makeZones(fixtures['zones_path'], params['zones'])
+    makeNet(fixtures['map_path'], params['zones'], params['edges'], seed=seed)
+    makeTrips(fixtures['tlc_dir'], params['zones'], params['months'], params['trips_per_month'], seed=seed)
+    makeFcd(fixtures['fcd_path'], params['zones'], params['fcd_seconds'], params['vehicles'], seed=seed)
+    with open(os.path.join(directory, "fixtures.json"), 'w') as fout:
+        json.dump(fixtures, fout, indent=1)
+    return fixtures
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic inputs for the benchmarks")
+    parser.add_argument("output", help="directory of the files")
+    parser.add_argument("--scale", default='small', choices=sorted(SCALES), help="size of the inputs")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generator")
+    args = parser.parse_args()
+    fixtures = makeFixtures(args.output, args.scale, args.seed)
+    print("Fixtures written in {0}: {1}".format(args.output, fixtures))
+
+if __name__ == '__main__':
+    main()
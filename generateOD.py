@@ -3,7 +3,14 @@ import os
 import numpy as np
 import collections
 import sys
+import argparse
 #from numpyToVisum.py import convertToVMR
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trips'))
+from tlcData import parseDate, streamTrips
+from odStore import appendStart, ODStoreWriter, addToStore
+from npyWriter import NpyWriter
+import instrument
+from instrument import span, count, progress
 
 """
     Given three arguments, the program obtain the O/D matrices from the Yellow Taxi dataset.
@@ -12,120 +19,309 @@ import sys
     - End date (open interval) in format year/month/day with day and month with a zero padding
     - Name of the output file
     - Interval size for the O/D matrices
+    - (Optional) Number of rows read at once from the monthly files
+    Options:
+    - --cache-dir DIR: read the months from this columnar cache, downloading only the ones missing.
+    - --source SRC: local directory or mirror url with the monthly files.
+    - --workers N: number of months downloaded at the same time.
+    - --format npy|sparse: dense .npy file (default) or sparse store (directory, see odStore.py).
+    - --dtype TYPE: integer type of the saved counts.
+    - --append: with --format sparse, add to the existing store the slices after its end (and the trips
+      of its slices found in the new monthly files).
+    - --report PATH, --profile PATH: JSON report of the run and cProfile stats.
 """
 
-# Generates the dates that we need
 from datetime import timedelta, date
-def daterange(start_date, end_date):
-    for n in range(int ((end_date - start_date).days)):
-        yield start_date + timedelta(n)
 
-# Clean Data
-def clean_data(df):
+# Build the O/D matrices
+def tripCells(data, start_date, interval, n_bins, n_zones):
     """
-    Elimate unecessary columns from dataframe df
+    Interval, origin and destination of the trips in `data`, the cell where
+    they are counted in the O/D matrices. Trips out of the time range or
+    with unknown zone ids are left out.
+    Inputs:
+        - data: dataframe with the columns tpep_pickup_datetime, PULocationID and DOLocationID.
+        - start_date: date where the first interval begins.
+        - interval: size of the intervals in hours.
+        - n_bins, n_zones: number of intervals and of zone ids.
+    Outputs:
+        - Arrays with the interval, origin and destination of every trip.
     """
-    df = df.drop(['payment_type', 'fare_amount', 'extra', 'mta_tax', 'tip_amount',
-       'tolls_amount', 'improvement_surcharge'], axis = 1) # Delete non-necessary
-    df.tpep_pickup_datetime = pd.to_datetime(df.tpep_pickup_datetime,
-                                                 format='%Y-%m-%d %H:%M:%S')
-    df.tpep_dropoff_datetime = pd.to_datetime(df.tpep_dropoff_datetime,
-                                                 format='%Y-%m-%d %H:%M:%S')
-    return df
+    pickups = data['tpep_pickup_datetime'].values
+    bins = (pickups - np.datetime64(start_date)) // np.timedelta64(interval, 'h')
+    origins = data['PULocationID'].values.astype(np.int64)
+    destinations = data['DOLocationID'].values.astype(np.int64)
+    valid = ((bins >= 0) & (bins < n_bins) &
+             (origins >= 0) & (origins < n_zones) &
+             (destinations >= 0) & (destinations < n_zones))
+    return bins[valid], origins[valid], destinations[valid]
 
+def countCells(OD_matrices, bins, origins, destinations):
+    """
+    Add a trip to `OD_matrices` at every cell (`bins`, `origins`, `destinations`).
+    """
+    if len(bins) == 0:
+        return
+    n_zones = OD_matrices.shape[1]
+    # Only the bins touched by these trips are counted, so the temporary array
+    # is as small as the time span of the trips
+    first, last = bins.min(), bins.max()
+    flat = ((bins - first) * n_zones + origins) * n_zones + destinations
+    counts = np.bincount(flat, minlength=(last - first + 1) * n_zones * n_zones)
+    OD_matrices[first:last+1] += counts.reshape(-1, n_zones, n_zones).astype(OD_matrices.dtype)
+
+class ODBlocks:
+    """
+    O/D matrices of `n_bins` intervals of `interval` hours from `start_date`,
+    counted by blocks of `block_slices` slices so that only the blocks of the
+    trips being read are in memory (instead of the whole time range), with
+    the counts as int32. The blocks are passed in order to `write` (a
+    function that receives the slices of a block, cut to the first `n_out`
+    zones) when the trips read are `keep_slices` slices after them. The few trips far from the ones read
+    (of other months in a monthly file), in a block already written or more
+    than `keep_slices` slices ahead, are kept apart and returned by `close`,
+    to be added to the output at the end.
+    """
+    def __init__(self, n_bins, start_date, interval, write, block_slices=168, keep_slices=None,
+                 n_zones=266, n_out=264):
+        self.n_bins = n_bins
+        self.start_date = start_date
+        self.interval = interval
+        self.write = write
+        self.block_slices = block_slices
+        # Half a month around the trips read, by default
+        self.keep_slices = 16 * 24 // interval if keep_slices is None else keep_slices
+        self.n_zones = n_zones
+        self.n_out = n_out
+        self.n_blocks = -(-n_bins // block_slices)
+        self.blocks = {} # index -> array (block_slices, n_zones, n_zones)
+        self.written = 0 # blocks written
+        self.position = 0 # slice reached by the trips read
+        self.apart = [] # (bins, origins, destinations) of the trips far from the ones read
+
+    def add(self, data):
+        """
+        Count the trips of the dataframe `data` (see tripCells).
+        Outputs:
+            - The number of trips added.
+        """
+        bins, origins, destinations = tripCells(data, self.start_date, self.interval, self.n_bins, self.n_zones)
+        if len(bins) == 0:
+            return 0
+        # The median is not moved by a few trips of other months
+        self.position = max(self.position, int(np.median(bins)))
+        self.flush((self.position - self.keep_slices) // self.block_slices)
+        apart = (bins < self.written * self.block_slices) | (bins >= self.position + self.keep_slices)
+        if apart.any():
+            self.apart.append((bins[apart], origins[apart], destinations[apart]))
+            bins, origins, destinations = bins[~apart], origins[~apart], destinations[~apart]
+        blocks = bins // self.block_slices
+        for b in np.unique(blocks):
+            if b not in self.blocks:
+                self.blocks[b] = np.zeros((self.block_slices, self.n_zones, self.n_zones), dtype=np.int32)
+            selected = blocks == b
+            countCells(self.blocks[b], bins[selected] - b * self.block_slices, origins[selected],
+                       destinations[selected])
+        return len(bins) + int(apart.sum())
+
+    def flush(self, end):
+        """
+        Write the blocks before the block `end`, in order (the ones without
+        trips as zeros).
+        """
+        while self.written < min(end, self.n_blocks):
+            b = self.written
+            block = self.blocks.pop(b, None)
+            size = min(self.block_slices, self.n_bins - b * self.block_slices)
+            if block is None:
+                block = np.zeros((size, self.n_out, self.n_out), dtype=np.int32)
+            self.write(block[:size, :self.n_out, :self.n_out])
+            self.written += 1
+
+    def close(self):
+        """
+        Write the blocks left.
+        Outputs:
+            - Arrays (slices, origins, destinations, trips) of the trips kept
+              apart, by cell, in the first `n_out` zones.
+        """
+        self.flush(self.n_blocks)
+        return groupCells(self.apart, self.n_out)
+
+def groupCells(trips, n_out=264):
+    """
+    Trips per cell of the list `trips` of arrays (slices, origins,
+    destinations), in the first `n_out` zones.
+    Outputs:
+        - Arrays (slices, origins, destinations, trips), a cell per position.
+    """
+    if len(trips) == 0:
+        return (np.zeros(0, dtype=np.int64),) * 4
+    bins, origins, destinations = (np.concatenate(a) for a in zip(*trips))
+    kept = (origins < n_out) & (destinations < n_out)
+    cells, counts = np.unique((bins[kept] * n_out + origins[kept]) * n_out + destinations[kept],
+                              return_counts=True)
+    return cells // n_out**2, cells // n_out % n_out, cells % n_out, counts
 
 def main():
+    parser = argparse.ArgumentParser(description="O/D matrices from the Yellow Taxi dataset")
+    parser.add_argument("sdate", help="begining date, yyyy/mm/dd")
+    parser.add_argument("edate", help="end date (open interval), yyyy/mm/dd")
+    parser.add_argument("outputFile", help="name of the output file")
+    parser.add_argument("interval", type=int, help="interval size in hours")
+    parser.add_argument("chunksize", type=int, nargs='?', default=1000000,
+                        help="rows read at once from the monthly files")
+    parser.add_argument("--cache-dir", default=None, help="columnar cache of the months")
+    parser.add_argument("--source", default=None,
+                        help="local directory or mirror url with the monthly files")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of months downloaded at the same time")
+    parser.add_argument("--format", default='npy', choices=['npy', 'sparse'],
+                        help="dense .npy file or sparse store (directory)")
+    parser.add_argument("--dtype", default=None,
+                        help="integer type of the saved counts (int64 for npy and int32 for sparse by default)")
+    parser.add_argument("--append", action='store_true',
+                        help="add to the existing sparse store only the slices after its end")
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.report, args.profile, script="generateOD", args=vars(args))
+
     ## Read dates ##
     # Format: year/month/day
-    # Read first date
-    sdate = sys.argv[1]
-    # Read last date
-    edate = sys.argv[2]
-    # Read the name of the output file
-    outputFile = sys.argv[3]
-    # interval
-    interval = int(sys.argv[4])
+    sdate, edate = args.sdate, args.edate
+    outputFile = args.outputFile
+    interval = args.interval
     if 24 % interval != 0: # Not divisible
         exit()
+    chunksize = args.chunksize
 
-    sdate = (int(sdate[0:4]), int(sdate[5:7]), int(sdate[8:]))
-    edate = (int(edate[0:4]), int(edate[5:7]), int(edate[8:]))
-
-    ## Load database ##
-    # First year
-    data = []
-
-    lastMonth = 12
-
-    if sdate[0] == edate[0]: # Same year
-        lastMonth = edate[1]
-
-    # First year
-    for i in range(sdate[1], lastMonth+1):
-        url = "https://s3.amazonaws.com/nyc-tlc/trip+data/yellow_tripdata_{0}-{1:02d}.csv".format(sdate[0], i)
-        print("Reading "+url)
-        data_taxis = pd.read_csv(url)
-        data_taxis = clean_data(data_taxis)
-        if i == sdate[1]:
-            data = data_taxis
-        else:
-            data = pd.concat([data, data_taxis], ignore_index=True)
-
-    # Years in the middle
-    for y in range(sdate[0]+1, edate[0]):
-        for i in range(1, 13):
-            url = "https://s3.amazonaws.com/nyc-tlc/trip+data/yellow_tripdata_{0}-{1:02d}.csv".format(y, i)
-            data_taxis = pd.read_csv(url)
-            print("Reading "+url)
-            data_taxis = clean_data(data_taxis)
-            data = pd.concat([data, data_taxis], ignore_index=True)
-
-    # Last year if first and last are not equal (otherwise, is included in first loop)
-    if sdate[0] != edate[0]:
-        for i in range(1, edate[1]+1):
-            url = "https://s3.amazonaws.com/nyc-tlc/trip+data/yellow_tripdata_{0}-{1:02d}.csv".format(edate[0], i)
-            data_taxis = pd.read_csv(url)
-            print("Reading "+url)
-            data_taxis = clean_data(data_taxis)
-            data = pd.concat([data, data_taxis], ignore_index=True)
-    print("Done! \n\n")
+    start_date = parseDate(sdate)
+    end_date = parseDate(edate)
 
+    ## Append mode ##
+    # Only the months after the end of the existing store are read
+    store_path = "OD_matrices_{0}".format(outputFile)
+    append = args.append and os.path.isdir(store_path)
+    if args.append and args.format != 'sparse':
+        parser.error("--append needs --format sparse")
+    if append:
+        try:
+            store_end = appendStart(store_path, interval, 264, args.dtype)
+        except ValueError as e:
+            parser.error(str(e))
+        if start_date > store_end:
+            parser.error("The store {0} ends at {1}, before {2}".format(store_path, store_end, start_date))
+        if store_end >= end_date:
+            print("The store {0} already ends at {1}, nothing to append".format(store_path, store_end))
+            instrument.finish()
+            return
+        print("Appending to {0} from {1}".format(store_path, store_end))
+        start_date = store_end
 
     ## Create OD matrices ##
-    start_date = date(*sdate)
-    end_date = date(*edate)
-
-    OD_matrices = []
-    for single_date in daterange(start_date, end_date):
-        for i in range(0, 24, interval):
-            OD_matrix = np.zeros((266, 266))
-            dateStr = single_date.strftime("%Y-%m-%d")
-            temp_data = data[ (data['tpep_pickup_datetime'] >= dateStr + " {0:02d}:00:00".format(i)) &
-                   (data['tpep_pickup_datetime'] <= dateStr + " {0:02d}:59:59".format(i+interval-1)) ]
-            print("-> {0}: {1} hrs. - {2}".format(dateStr, i, temp_data.size))
-            for k in temp_data.index:
-                element = temp_data.PULocationID[k]
-                OD_matrix[element][element] += 1
-
-            OD_matrices.append(OD_matrix)
-
-
-    # Delete unknown Origin-Destination
-    # According to documentation, zones 264 and 265 are unknown
-    n = len(OD_matrices)
-    for i in range(n):
-        OD_matrices[i] = np.delete(OD_matrices[i], 265, 1)
-        OD_matrices[i] = np.delete(OD_matrices[i], 265, 0)
-
-        OD_matrices[i] = np.delete(OD_matrices[i], 264, 1)
-        OD_matrices[i] = np.delete(OD_matrices[i], 264, 0)
-
-    OD_matrices_np = np.array(OD_matrices, dtype=np.int64)
-    print(str(OD_matrices_np.shape) + " array to save")
-
-    np.save("OD_matrices_{0}.npy".format(outputFile), OD_matrices_np)
+    n_bins = (end_date - start_date).days * (24 // interval)
+    print("({0}, 264, 264) array to save".format(n_bins))
+    streamODMatrices(start_date, end_date, outputFile, interval, chunksize, args.cache_dir, args.source,
+                     args.workers, args.format, args.dtype, append)
     print('Saved!')
+    instrument.finish()
     # convertToVMR(M)
 
+def streamODMatrices(start_date, end_date, outputFile, interval, chunksize=1000000, cache_dir=None,
+                     source=None, workers=4, format='npy', dtype=None, append=False):
+    """
+    Save the O/D matrices of the trips picked up in [`start_date`,
+    `end_date`), one per interval of `interval` hours, in
+    OD_matrices_`outputFile` (see openMatrices). The months are streamed by
+    chunks of `chunksize` rows (see tlcData.streamTrips) and counted by
+    blocks of slices (ODBlocks), that are written as soon as the trips read
+    are past them. With `append`, the trips of the new monthly files that
+    belong to the slices already in the store (late rows of a previous
+    month) are added to them.
+    Outputs:
+        - The number of rows read and of trips counted.
+    """
+    # According to documentation, zones 264 and 265 are unknown and are not saved
+    n_bins = (end_date - start_date).days * (24 // interval)
+    writer = openMatrices(outputFile, start_date, interval, format, dtype, append)
+    first_slice = writer.n_slices if format == 'sparse' else 0
+    # Beginning of the store, to keep the trips of its slices in the new months
+    store_start = writer.start_date if append else None
+    stored = [] # (slices, origins, destinations) of the trips in the slices of the store
+    def writeBlock(block):
+        with span("save"):
+            writeMatrices(writer, block)
+    blocks = ODBlocks(n_bins, start_date, interval, writeBlock)
+    n_rows, n_trips = 0, 0
+    with span("buildODMatrices"):
+        for data in streamTrips(start_date, end_date, chunksize=chunksize, cache_dir=cache_dir,
+                                source=source, workers=workers, keep_from=store_start):
+            rows, trips = len(data), 0
+            if store_start is not None:
+                before = (data['tpep_pickup_datetime'] < start_date).values
+                if before.any():
+                    stored.append(tripCells(data[before], store_start, interval, first_slice, blocks.n_zones))
+                    trips += len(stored[-1][0])
+                    data = data[~before]
+            trips += blocks.add(data)
+            count("trips", trips)
+            count("rows", rows)
+            n_trips += trips
+            n_rows += rows
+            progress("generateOD", n_rows)
+    print("Done! \n\n")
+    print("Trips counted: {0}".format(n_trips))
+
+    with span("save"):
+        slices, origins, destinations, trips = blocks.close()
+        writer.close()
+        if len(trips) > 0:
+            addTrips(writer.path, format, first_slice + slices, origins, destinations, trips)
+            print("{0} trips of other months added to the slices saved".format(trips.sum()))
+        slices, origins, destinations, trips = groupCells(stored)
+        if len(trips) > 0:
+            addTrips(writer.path, format, slices, origins, destinations, trips)
+            print("{0} trips added to the slices that were already in the store".format(trips.sum()))
+        if append:
+            print("The store has {0} slices".format(writer.n_slices))
+    return n_rows, n_trips
+
+def openMatrices(outputFile, start_date, interval, format='npy', dtype=None, append=False):
+    """
+    Writer of the O/D matrices (264 x 264 slices) in OD_matrices_`outputFile`.npy
+    (NpyWriter), or in the sparse store OD_matrices_`outputFile` with
+    `format` 'sparse' (ODStoreWriter, after its last slice with `append`).
+    """
+    if format == 'sparse':
+        path = "OD_matrices_{0}".format(outputFile)
+        if append:
+            return ODStoreWriter.reopen(path)
+        return ODStoreWriter(path, 264, start_date, interval, dtype or 'int32')
+    return NpyWriter("OD_matrices_{0}.npy".format(outputFile), (264, 264), dtype or 'int64')
+
+def writeMatrices(writer, OD_matrices):
+    """
+    Append the slices `OD_matrices` with `writer` (see openMatrices),
+    checking that the counts fit in its dtype.
+    """
+    if OD_matrices.max(initial=0) > np.iinfo(writer.dtype).max:
+        raise ValueError("Counts up to {0} do not fit in {1}".format(OD_matrices.max(), writer.dtype))
+    writer.write(OD_matrices)
+
+def addTrips(path, format, slices, origins, destinations, trips):
+    """
+    Add `trips` to the cells (`slices`, `origins`, `destinations`), all
+    different, of the O/D matrices saved in `path` (.npy file or sparse store).
+    """
+    if format == 'sparse':
+        addToStore(path, slices, origins, destinations, trips)
+        return
+    OD_matrices = np.load(path, mmap_mode='r+')
+    values = OD_matrices[slices, origins, destinations].astype(np.int64) + trips
+    if values.max(initial=0) > np.iinfo(OD_matrices.dtype).max:
+        raise ValueError("Counts up to {0} do not fit in {1}".format(values.max(), OD_matrices.dtype))
+    OD_matrices[slices, origins, destinations] = values
+    OD_matrices.flush()
+
 if __name__ == '__main__':
     main()
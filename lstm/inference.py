@@ -0,0 +1,345 @@
+import numpy as np
+import os
+import time
+import json
+import asyncio
+import argparse
+
+"""
+Rolling forecasts of the counts of the next `horizon` windows with the
+trained LSTM models, updated as new counts arrive (read from the output of
+fcd2counts.py while it is written, or from a synthetic feed). Every model is
+loaded once and forecasts only the zones it was trained on (`--zones`, in
+the order of its columns); several models serve several sets of zones.
+
+python3 inference.py [--model model.h5 --zones 140,141,236,237,262,263] [--steps 500] [--clients 8]
+python3 inference.py --counts dataframe.npy [--model model.h5 --zones ...]
+python3 inference.py --serve 127.0.0.1:8765 [--counts dataframe.npy] [--model model.h5 --zones ...]
+"""
+
+# Zones of the counts the model of lstm.ipynb is trained with
+MODEL_ZONES = [140, 141, 236, 237, 262, 263]
+
+class PersistenceModel:
+    """
+    Forecast that repeats the last counts, used when there is no trained
+    model. Same interface as a Keras model.
+    """
+    def __init__(self, lookback=6, width=6, horizon=3):
+        self.input_shape = (None, lookback, width)
+        self.horizon = horizon
+
+    def predict(self, X, verbose=0):
+        return np.tile(X[:, -1, :], (1, self.horizon))
+
+def loadModel(path):
+    import keras
+    return keras.models.load_model(path)
+
+class ForecastService:
+    """
+    Keep the last `lookback` counts of the zones of a model in a rolling
+    buffer and forecast their next `horizon` windows.
+    Inputs:
+        - model: object with `predict` and `input_shape` (None, lookback, width),
+          whose output is (samples, horizon * width).
+        - zones: OBJECTIDs of the zones the model was trained on, in the
+          order of its columns (as many as its width).
+    """
+    def __init__(self, model, zones, horizon=3):
+        self.model = model
+        _, self.lookback, self.width = model.input_shape
+        if len(zones) != self.width:
+            raise ValueError("The model forecasts {0} zones, not {1}".format(self.width, len(zones)))
+        self.zones = [int(z) for z in zones]
+        self.horizon = horizon
+        self.n_zones = len(self.zones)
+        self.buffer = np.zeros((self.lookback, self.n_zones), dtype=np.float32)
+        self.position = 0
+        self.steps = 0
+        self.time = None
+        self.latencies = []
+        self.cached = None # (steps, forecast) of the last prediction
+
+    def update(self, time, counts):
+        """
+        Add the counts of the zones of the model in the window of the row
+        labelled `time`.
+        """
+        self.buffer[self.position] = counts
+        self.position = (self.position + 1) % self.lookback
+        self.steps += 1
+        self.time = time
+
+    def ready(self):
+        return self.steps >= self.lookback
+
+    def inputs(self):
+        """
+        Input of the model with the buffer: array (1, lookback, zones),
+        oldest window first.
+        """
+        return np.roll(self.buffer, -self.position, axis=0)[None]
+
+    def predict(self, steps, X):
+        """
+        Forecast from the inputs `X` taken after `steps` updates, array
+        (horizon, zones) of rounded non negative counts.
+        """
+        begin = time.perf_counter()
+        y = np.asarray(self.model.predict(X, verbose=0)).reshape(self.horizon, self.n_zones)
+        forecast = np.maximum(np.round(y), 0)
+        self.latencies.append(time.perf_counter() - begin)
+        self.cached = (steps, forecast)
+        return forecast
+
+    def forecast(self):
+        """
+        Forecast of the next `horizon` windows of the current buffer, computed
+        once per update.
+        """
+        if self.cached is not None and self.cached[0] == self.steps:
+            return self.cached[1]
+        return self.predict(self.steps, self.inputs())
+
+def predictionStats(services):
+    """
+    Latency (ms) percentiles and throughput of the predictions of `services`.
+    """
+    latencies = np.array([l for s in services for l in s.latencies]) * 1000
+    if len(latencies) == 0:
+        return {'predictions': 0}
+    zones = sum(s.n_zones * len(s.latencies) for s in services)
+    return {'predictions': len(latencies),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'zones_per_second': float(zones / latencies.sum() * 1000)}
+
+class ForecastServer:
+    """
+    Asyncio handler of requests, one JSON object per line:
+        {"op": "update", "time": t, "counts": [...]} -> {"ok": true}
+        {"op": "forecast"} -> {"time": t, "zones": [...], "forecast": [[...], ...]}
+        {"op": "stats"} -> latency statistics
+    The counts of the updates are the ones of `feed_zones` (OBJECTIDs, the
+    columns of the counts of fcd2counts.py); every service of `services`
+    takes the columns of its zones, and a forecast has the zones of all the
+    services. The forecast requests that arrive while a prediction is running
+    wait for it instead of starting another one.
+    """
+    def __init__(self, services, feed_zones):
+        self.services = services
+        feed_zones = [int(z) for z in feed_zones]
+        missing = [z for s in services for z in s.zones if z not in feed_zones]
+        if len(missing) > 0:
+            raise ValueError("Zones of the models not in the counts: {0}".format(missing))
+        self.columns = [np.array([feed_zones.index(z) for z in s.zones]) for s in services]
+        self.zones = [z for s in services for z in s.zones]
+        self.pending = [None] * len(services) # (steps, future) of the prediction in course
+        self.request_latencies = []
+
+    def update(self, time, counts):
+        counts = np.asarray(counts)
+        for service, columns in zip(self.services, self.columns):
+            service.update(time, counts[columns])
+
+    def ready(self):
+        return all(s.ready() for s in self.services)
+
+    async def serviceForecast(self, i):
+        service = self.services[i]
+        if service.cached is not None and service.cached[0] == service.steps:
+            return service.cached[1]
+        if self.pending[i] is None or self.pending[i][0] != service.steps:
+            # The inputs are taken here, so later updates do not change them
+            loop = asyncio.get_running_loop()
+            self.pending[i] = (service.steps, loop.run_in_executor(None, service.predict, service.steps,
+                                                                   service.inputs()))
+        return await asyncio.shield(self.pending[i][1])
+
+    async def forecast(self):
+        """
+        Forecast (horizon, zones) of the zones of all the services.
+        """
+        forecasts = await asyncio.gather(*[self.serviceForecast(i) for i in range(len(self.services))])
+        return np.concatenate(forecasts, axis=1)
+
+    async def request(self, message):
+        begin = time.perf_counter()
+        op = message.get('op')
+        if op == 'update':
+            self.update(message['time'], message['counts'])
+            response = {'ok': True}
+        elif op == 'forecast':
+            if not self.ready():
+                response = {'error': "Less than {0} windows received".format(max(s.lookback for s in self.services))}
+            else:
+                response = {'time': self.services[0].time, 'zones': self.zones,
+                            'forecast': (await self.forecast()).tolist()}
+        elif op == 'stats':
+            response = dict(predictionStats(self.services), **requestStats(self.request_latencies))
+        else:
+            response = {'error': "Unknown op: {0}".format(op)}
+        self.request_latencies.append(time.perf_counter() - begin)
+        return response
+
+    async def handle(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            writer.write((json.dumps(await self.request(json.loads(line))) + "\n").encode())
+            await writer.drain()
+        writer.close()
+
+def requestStats(latencies):
+    if len(latencies) == 0:
+        return {'requests': 0}
+    latencies = np.array(latencies) * 1000
+    return {'requests': len(latencies),
+            'request_p50_ms': float(np.percentile(latencies, 50)),
+            'request_p99_ms': float(np.percentile(latencies, 99))}
+
+def followCounts(path, follow=False, poll=1.0):
+    """
+    Generator with the pairs (time, counts) of the counts written by
+    fcd2counts.py in `path` (.npy, with the zones and times in `path`.json,
+    or .csv), read incrementally: only the complete rows that were not read
+    yet are read every time. With `follow`, it waits for new rows (checking
+    every `poll` seconds) while the file is being written, like `tail -f`;
+    without it, the rows already written are read and a csv without a
+    complete header raises a ValueError.
+    Outputs:
+        - First, the list of the zones of the columns, then the pairs.
+    """
+    while follow and not os.path.exists(path if path.endswith(".csv") else path + ".json"):
+        time.sleep(poll)
+    if path.endswith(".npy"):
+        with open(path + ".json") as fmeta:
+            meta = json.load(fmeta)
+        yield meta['zones']
+        with open(path, 'rb') as fin:
+            np.lib.format.read_magic(fin)
+            _, _, dtype = np.lib.format.read_array_header_1_0(fin)
+            row_bytes = len(meta['zones']) * dtype.itemsize
+            k = 0
+            while True:
+                data = fin.read(((os.path.getsize(path) - fin.tell()) // row_bytes) * row_bytes)
+                for row in np.frombuffer(data, dtype=dtype).reshape(-1, len(meta['zones'])):
+                    yield meta['begin_value'] + k * meta['time_laps'], row
+                    k += 1
+                if len(data) == 0:
+                    if not follow:
+                        return
+                    time.sleep(poll)
+        return
+    with open(path) as fin:
+        header = ""
+        while not header.endswith("\n"):
+            header += fin.readline()
+            if header.endswith("\n"):
+                break
+            if not follow:
+                raise ValueError("The counts file {0} has no complete header".format(path))
+            time.sleep(poll)
+        yield [int(z) for z in header.strip().split(",")[1:]]
+        pending = ""
+        while True:
+            pending += fin.readline()
+            if pending.endswith("\n"):
+                values = pending.strip().split(",")
+                yield int(values[0]), np.array(values[1:], dtype=np.int64)
+                pending = ""
+            elif not follow:
+                return
+            else:
+                time.sleep(poll)
+
+def syntheticFeed(n_zones, steps, time_laps=600, seed=0):
+    """
+    Generator with pairs (time, counts) of counts with a daily cycle and noise
+    per zone, like the output of fcd2counts.py.
+    """
+    rng = np.random.default_rng(seed)
+    level = rng.gamma(2.0, 5.0, n_zones)
+    phase = rng.uniform(0, 2*np.pi, n_zones)
+    for k in range(steps):
+        t = k * time_laps
+        mean = level * (1.5 + np.sin(2*np.pi*t/86400 + phase))
+        yield t, rng.poisson(mean)
+
+async def benchmark(server, feed, clients=8):
+    """
+    Replay `feed` through `server`: after every update, `clients` concurrent
+    forecast requests.
+    """
+    begin = time.perf_counter()
+    for t, counts in feed:
+        await server.request({'op': 'update', 'time': t, 'counts': counts})
+        if server.ready():
+            await asyncio.gather(*[server.request({'op': 'forecast'}) for _ in range(clients)])
+    elapsed = time.perf_counter() - begin
+    return dict(predictionStats(server.services), **requestStats(server.request_latencies),
+                requests_per_second=len(server.request_latencies) / elapsed)
+
+async def feedServer(server, feed):
+    """
+    Send the pairs (time, counts) of the blocking generator `feed` to
+    `server` as they arrive, reading it in a thread.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await loop.run_in_executor(None, next, feed, None)
+        if item is None:
+            return
+        server.update(*item)
+
+def main():
+    parser = argparse.ArgumentParser(description="Rolling forecasts of the counts per zone")
+    parser.add_argument("--model", action='append', default=None,
+                        help="saved Keras model, can be repeated (persistence forecast if not given)")
+    parser.add_argument("--zones", action='append', default=None,
+                        help="OBJECTIDs of the zones of every --model, separated by commas, in the order of "
+                             "its columns ({0} by default)".format(",".join(map(str, MODEL_ZONES))))
+    parser.add_argument("--steps", type=int, default=500, help="windows of the synthetic feed")
+    parser.add_argument("--counts", default=None,
+                        help="read the counts of fcd2counts.py (.npy or .csv) as they are written instead")
+    parser.add_argument("--poll", type=float, default=1.0, help="seconds between the reads of new counts with --serve")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent forecast requests per window")
+    parser.add_argument("--serve", default=None, help="host:port to listen for requests")
+    args = parser.parse_args()
+
+    zone_sets = [[int(z) for z in zones.split(',')] for zones in (args.zones or [",".join(map(str, MODEL_ZONES))])]
+    if args.model is None:
+        models = [PersistenceModel(width=len(zones)) for zones in zone_sets]
+    elif len(args.model) != len(zone_sets):
+        parser.error("Give the --zones of every --model")
+    else:
+        models = [loadModel(path) for path in args.model]
+    services = [ForecastService(model, zones) for model, zones in zip(models, zone_sets)]
+
+    # With --serve, the counts file is followed while it grows
+    if args.counts is not None:
+        feed = followCounts(args.counts, follow=args.serve is not None, poll=args.poll)
+        feed_zones = next(feed)
+    else:
+        feed_zones = list(dict.fromkeys(z for zones in zone_sets for z in zones))
+        feed = syntheticFeed(len(feed_zones), args.steps)
+    server = ForecastServer(services, feed_zones)
+    if args.serve is not None:
+        host, port = args.serve.rsplit(':', 1)
+
+        async def serve():
+            listener = await asyncio.start_server(server.handle, host, int(port))
+            if args.counts is not None:
+                asyncio.ensure_future(feedServer(server, feed))
+            async with listener:
+                await listener.serve_forever()
+        asyncio.run(serve())
+        return
+
+    report = asyncio.run(benchmark(server, feed, args.clients))
+    print(json.dumps(report, indent=1))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import json
+from numpy.lib.stride_tricks import sliding_window_view
+
+"""
+Input/target windows of the counts per zone (rows: time windows, columns:
+zones) to train the forecaster, without copying the overlapping windows:
+the windows are strided views of the counts, that can be memory-mapped from
+the .npy written by fcd2counts.py. Only the batches used are copied.
+"""
+
+def loadCounts(path):
+    """
+    Read the counts written by fcd2counts.py.
+    Inputs:
+        - path: .npy file (mapped in memory, with the zones and times in
+          `path`.json) or .csv file (read in memory).
+    Outputs:
+        - counts: array (windows, zones).
+        - times: array with the time (seconds) of every row, the end of its
+          window (its start if counted with --label-start).
+        - zones: list of the zones of the columns.
+    """
+    if path.endswith(".npy"):
+        counts = np.load(path, mmap_mode='r')
+        meta = json.load(open(path + ".json"))
+        times = meta['begin_value'] + meta['time_laps'] * np.arange(len(counts))
+        return counts, times, meta['zones']
+    df = pd.read_csv(path, index_col=0)
+    return df.values, df.index.values, [int(z) for z in df.columns]
+
+class WindowDataset:
+    """
+    Windows of `lookback` rows of `counts` as inputs and the next `horizon`
+    rows (flattened) as targets, beginning every `stride` rows, like
+        X = counts[i:i+lookback], y = counts[i+lookback:i+lookback+horizon].flatten()
+    Inputs:
+        - counts: array (rows, zones), can be a memmap.
+        - times: time of every row, to split by time (row numbers by default).
+        - starts: rows where the windows begin (all the complete windows by default).
+    """
+    def __init__(self, counts, lookback=6, horizon=3, stride=1, times=None, starts=None):
+        self.counts = counts
+        self.lookback = lookback
+        self.horizon = horizon
+        self.stride = stride
+        self.times = np.arange(len(counts)) if times is None else np.asarray(times)
+        if starts is None:
+            starts = np.arange(0, len(counts) - lookback - horizon + 1, stride)
+        self.starts = starts
+        # Views (no copy) of all the windows: (window, lookback, zones) and (window, horizon, zones)
+        self.inputs = sliding_window_view(counts, lookback, axis=0).transpose(0, 2, 1)
+        self.targets = sliding_window_view(counts[lookback:], horizon, axis=0).transpose(0, 2, 1)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        """
+        Inputs and targets of the windows `idx` (index, slice or array), as float32.
+        """
+        starts = self.starts[idx]
+        X = self.inputs[starts].astype(np.float32)
+        y = self.targets[starts].astype(np.float32)
+        return X, y.reshape(y.shape[:-2] + (-1,))
+
+    def subset(self, mask):
+        return WindowDataset(self.counts, self.lookback, self.horizon, self.stride,
+                             self.times, self.starts[mask])
+
+    def split(self, split_time=None, fraction=0.8):
+        """
+        Split the windows by time: training windows end before `split_time`
+        (the time at `fraction` of the rows by default) and validation windows
+        begin at it or later, so no row is in both.
+        """
+        if split_time is None:
+            split_time = self.times[int(len(self.times) * fraction)]
+        last = self.times[self.starts + self.lookback + self.horizon - 1]
+        first = self.times[self.starts]
+        return self.subset(last < split_time), self.subset(first >= split_time)
+
+    def batches(self, batch_size=64, shuffle=False, seed=None):
+        """
+        Generator with the pairs (X, y) of batches of `batch_size` windows.
+        """
+        order = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng(seed).shuffle(order)
+        for i in range(0, len(order), batch_size):
+            yield self[order[i:i+batch_size]]
+
+    def tfDataset(self, batch_size=64, shuffle=False, seed=None):
+        """
+        tf.data.Dataset with the batches, built by `batches` (reshuffled every
+        epoch with `shuffle`) and prefetched.
+        """
+        import tensorflow as tf
+        rng = np.random.default_rng(seed)
+        n_zones = self.counts.shape[1]
+
+        def generator():
+            return self.batches(batch_size, shuffle, rng.integers(1 << 31) if shuffle else None)
+
+        signature = (tf.TensorSpec((None, self.lookback, n_zones), tf.float32),
+                     tf.TensorSpec((None, self.horizon * n_zones), tf.float32))
+        dataset = tf.data.Dataset.from_generator(generator, output_signature=signature)
+        return dataset.prefetch(tf.data.AUTOTUNE)
@@ -3,45 +3,170 @@ import os
 import numpy as np
 import collections
 import sys
+import argparse
+from multiprocessing import Pool
+from odStore import loadOD
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trips'))
+import instrument
+from instrument import span, count, progress
 
 """
 This program receive as arguments:
-    - Name of the .npy file where the OD matrices are allocated
+    - Name of the .npy file (or sparse store directory, see odStore.py) where the OD matrices are allocated
     - Start index to make the VMR matrices
     - End index (exclusive) to make the VMR matrices
+Options:
+    - --interval H: hours of every matrix, for the time in the header (6 by
+      default, or the interval of the sparse store).
+    - --sparse: write the non-zero cells as lists (O format) instead of full matrices.
+    - --workers N: number of processes writing files.
+    - --report PATH, --profile PATH: JSON report of the run and cProfile stats.
 
 The program writes as many txt as required in the current directory.
 """
 
-def convertToVMR(M, start=None, end=None):
+# Size of the buffer of the output files
+BUFFER_SIZE = 1 << 22
+
+def formatMatrix(M, delimiter=b"    "):
+    """
+    Text (bytes) of the 2-D matrix M of integers as written by
+    np.savetxt(fout, M, delimiter='    ', fmt='%i'). The digits of all the
+    cells are placed at once in a byte array, one pass per digit position.
+    """
+    M = np.asarray(M)
+    rows, cols = M.shape
+    if M.size == 0:
+        return b"\n" * rows
+    values = M.ravel().astype(np.int64)
+    if values.min() < 0: # Only the counts (non negative) are vectorized
+        return "".join(delimiter.decode().join(map(str, row)) + "\n" for row in M.tolist()).encode()
+
+    # Number of digits of every value
+    digits = np.ones(len(values), dtype=np.int64)
+    power = 10
+    while True:
+        bigger = values >= power
+        if not bigger.any():
+            break
+        digits += bigger
+        power *= 10
+    # Every value is followed by the delimiter, or by a new line at the end of the row
+    after = np.full(len(values), len(delimiter), dtype=np.int64)
+    after[cols-1::cols] = 1
+    ends = np.cumsum(digits + after)
+    out = np.full(ends[-1], ord(' '), dtype=np.uint8)
+    if delimiter != b" " * len(delimiter):
+        starts = ends - after
+        for i, char in enumerate(delimiter):
+            out[starts[after > 1] + i] = char
+    out[ends[cols-1::cols] - 1] = ord('\n')
+
+    last = ends - after - 1 # Position of the last digit
+    for j in range(int(digits.max())):
+        has = digits > j
+        out[last[has] - j] = ord('0') + values[has] % 10
+        values //= 10
+    return out.tobytes()
+
+def formatSparse(M):
+    """
+    Text (bytes) of the non-zero cells of the 2-D matrix M, one "origin destination
+    value" line per cell, with the districts numbered from 1.
+    """
+    origins, destinations = np.nonzero(M)
+    return "".join("{0:4d} {1:4d} {2}\n".format(o, d, v)
+                   for o, d, v in zip((origins+1).tolist(), (destinations+1).tolist(),
+                                      M[origins, destinations].tolist())).encode()
+
+def vmrText(M, k, interval=6, start_hour=0, sparse=False):
+    """
+    Content (bytes) of the file of the k-th matrix of M, where every matrix
+    covers `interval` hours from `start_hour`.
+    """
+    begin = (start_hour + k * interval) % 24
+    header = "{0:02d}:00 {1:02d}:00\n".format(begin, begin + interval)
+    matrix = M[k]
+    if sparse:
+        return ("$O\n1\n" + header).encode() + formatSparse(matrix)
+    districts = "".join("{0:4d}".format(i+1) for i in range(matrix.shape[0]))
+    return ("$VMR\n1\n" + header + districts + "\n").encode() + formatMatrix(matrix)
+
+def writeVMR(M, k, interval=6, start_hour=0, sparse=False):
+    """
+    Save the k-th matrix of M in OD_output{k}.txt.
+    """
+    with open("OD_output{0}.txt".format(k), 'wb', buffering=BUFFER_SIZE) as fout:
+        fout.write(vmrText(M, k, interval, start_hour, sparse))
+
+def convertToVMR(M, start=None, end=None, interval=6, start_hour=0, sparse=False):
     """
     Given a 3-D matrix M, save every 2D matrix in a txt file in VMR format
+    (or O format with `sparse`)
     """
     if start == None:
         start = 0
     if end == None:
         end = M.shape[0]
 
-    hours = [0, 6, 12, 18]
-    # Open file
     for k in range(start, end):
-        fout = open("OD_output{0}.txt".format(k),'w')
-        # Format header
-        fout.write("$VMR\n")
-        fout.write("1\n")
-        fout.write("{0:02d}:00 {1:02d}:00\n".format(hours[k%4], hours[k%4]+6))
-        # District numbers
-        for i in range(M.shape[1]):
-            fout.write("{0:4d}".format(i+1))
-        fout.write("\n")
-        # Save adj matrix
-        np.savetxt(fout, M[k], delimiter='    ', fmt = '%i')
-        fout.close()
+        writeVMR(M, k, interval, start_hour, sparse)
+        count("matrices")
+        progress("convertToVMR", k - start + 1, end - start, "matrices")
+
+# Matrices of the worker processes, set by initWorker
+worker_matrices = None
+
+def initWorker(path):
+    global worker_matrices
+    worker_matrices = loadOD(path)
+
+def writeWorkerVMR(args):
+    writeVMR(worker_matrices, *args)
+
+def exportVMR(path, start=None, end=None, interval=None, sparse=False, workers=1):
+    """
+    Convert the matrices [`start`, `end`) of the file or store in `path`,
+    reading only those, with `workers` processes. The interval and the hour
+    of the first matrix come from the store; with a .npy file, the interval is
+    `interval` (6 hours by default) and the first matrix begins at 00:00.
+    """
+    M = loadOD(path)
+    start_hour = 0
+    if hasattr(M, 'interval'):
+        if interval is not None and interval != M.interval:
+            print("The matrices of {0} are of {1} hours".format(path, M.interval))
+        interval, start_hour = M.interval, M.start_date.hour
+    elif interval is None:
+        interval = 6
+    if start == None:
+        start = 0
+    if end == None:
+        end = M.shape[0]
+
+    if workers <= 1:
+        convertToVMR(M, start, end, interval, start_hour, sparse)
+        return
+    tasks = [(k, interval, start_hour, sparse) for k in range(start, end)]
+    with Pool(workers, initializer=initWorker, initargs=(path,)) as pool:
+        for done, _ in enumerate(pool.imap_unordered(writeWorkerVMR, tasks, chunksize=4)):
+            count("matrices")
+            progress("convertToVMR", done + 1, len(tasks), "matrices")
 
 def main():
-    ## Read nunpy array
-    M = np.load(sys.argv[1])
-    convertToVMR(M, int(sys.argv[2]), int(sys.argv[3]))
+    parser = argparse.ArgumentParser(description="VMR files from the O/D matrices")
+    parser.add_argument("path", help=".npy file or sparse store with the O/D matrices")
+    parser.add_argument("start", type=int, help="first matrix")
+    parser.add_argument("end", type=int, help="end matrix (exclusive)")
+    parser.add_argument("--interval", type=int, default=None, help="hours of every matrix (6 by default)")
+    parser.add_argument("--sparse", action='store_true', help="write lists of the non-zero cells (O format)")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes")
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.report, args.profile, script="numpyToVisum", args=vars(args))
+    with span("convertToVMR"):
+        exportVMR(args.path, args.start, args.end, args.interval, args.sparse, args.workers)
+    instrument.finish()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,223 @@
+import numpy as np
+import os
+import json
+from datetime import datetime, timedelta
+
+"""
+Sparse storage of the O/D matrices: a directory with the matrices split in
+chunks of consecutive time slices. Every chunk is a compressed npz file with
+the non-zero cells of its slices (CSR by slice: `ptr`, flat cell index
+origin*n_zones + destination, and value), and meta.json has the shape, the
+dtype, the time of every slice and the slices of every chunk. Only the chunks
+of the slices read are loaded.
+The store can grow: appendOD adds slices after the last one in new chunk
+files, without rewriting the existing ones, and then replaces meta.json.
+addToStore adds counts to slices already written, rewriting their chunks.
+"""
+
+META_FILE = "meta.json"
+
+class ODStoreWriter:
+    """
+    Write the O/D matrices of `n_zones` x `n_zones`, one per interval of
+    `interval` hours from `start_date`, in the directory `path`, by chunks of
+    `chunk_slices` slices. The values are saved as `dtype`; a value that does
+    not fit raises a ValueError.
+    """
+    def __init__(self, path, n_zones, start_date, interval, dtype='int32', chunk_slices=168):
+        self.path = path
+        self.n_zones = n_zones
+        self.start_date = start_date
+        self.interval = interval
+        self.dtype = np.dtype(dtype)
+        self.chunk_slices = chunk_slices
+        self.buffer = []
+        self.n_slices = 0
+        self.chunks = []
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def reopen(cls, path, chunk_slices=168):
+        """
+        Writer that appends slices to the store in `path`, with its zones,
+        dates, interval and dtype. The existing chunks are kept as they are.
+        """
+        store = ODStore(path)
+        writer = cls(path, store.shape[1], store.start_date, store.interval, store.dtype, chunk_slices)
+        writer.n_slices = store.shape[0]
+        writer.chunks = list(store.chunks)
+        return writer
+
+    def write(self, matrices):
+        """
+        Append the slices of the 3-D array `matrices` (slices, n_zones, n_zones).
+        """
+        for k in range(len(matrices)):
+            self.buffer.append(matrices[k])
+            if len(self.buffer) == self.chunk_slices:
+                self._writeChunk()
+
+    def _writeChunk(self):
+        block = np.asarray(self.buffer)
+        name = "chunk{0:05d}.npz".format(len(self.chunks))
+        saveChunk(os.path.join(self.path, name), block, self.dtype)
+        self.chunks.append({'file': name, 'start': self.n_slices, 'end': self.n_slices + len(block)})
+        self.n_slices += len(block)
+        self.buffer = []
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self._writeChunk()
+        meta = {'shape': [self.n_slices, self.n_zones, self.n_zones],
+                'dtype': self.dtype.str,
+                'start_date': self.start_date.isoformat(),
+                'interval': self.interval,
+                'chunks': self.chunks}
+        tmp_path = os.path.join(self.path, META_FILE + ".tmp")
+        with open(tmp_path, 'w') as fout:
+            json.dump(meta, fout, indent=1)
+        os.replace(tmp_path, os.path.join(self.path, META_FILE))
+
+def saveChunk(path, block, dtype):
+    """
+    Save the slices of the 3-D array `block` as a chunk file in `path`, with
+    the values as `dtype` (ValueError if they do not fit). An existing chunk
+    is replaced at once.
+    """
+    if block.size > 0 and block.max(initial=0) > np.iinfo(dtype).max:
+        raise ValueError("Counts up to {0} do not fit in {1}".format(block.max(), dtype))
+    flat = block.reshape(len(block), -1)
+    slices, cells = np.nonzero(flat)
+    ptr = np.zeros(len(block)+1, dtype=np.int64)
+    ptr[1:] = np.cumsum(np.bincount(slices, minlength=len(block)))
+    tmp_path = path + ".tmp.npz"
+    np.savez_compressed(tmp_path, ptr=ptr, cells=cells.astype(np.uint32), values=flat[slices, cells].astype(dtype))
+    os.replace(tmp_path, path)
+
+def addToStore(path, slices, origins, destinations, values):
+    """
+    Add `values` to the cells (`slices`, `origins`, `destinations`) of the
+    store in `path`, rewriting only the chunks of those slices.
+    """
+    store = ODStore(path)
+    slices = np.asarray(slices, dtype=np.int64)
+    chunk_of = np.searchsorted(store.ends, slices, side='right')
+    for c in np.unique(chunk_of):
+        chunk = store.chunks[c]
+        selected = chunk_of == c
+        block = store.read(chunk['start'], chunk['end']).astype(np.int64)
+        np.add.at(block, (slices[selected] - chunk['start'], np.asarray(origins)[selected],
+                          np.asarray(destinations)[selected]), np.asarray(values)[selected])
+        saveChunk(os.path.join(path, chunk['file']), block, store.dtype)
+
+def appendStart(path, interval, n_zones, dtype=None):
+    """
+    Time where the slices appended to the store in `path` must begin, after
+    checking that the store has intervals of `interval` hours, `n_zones`
+    zones and the dtype `dtype` (if given). Raises a ValueError if not.
+    """
+    store = ODStore(path)
+    if store.interval != interval:
+        raise ValueError("The store {0} has intervals of {1} hours, not {2}".format(path, store.interval, interval))
+    if store.shape[1] != n_zones:
+        raise ValueError("The store {0} has {1} zones, not {2}".format(path, store.shape[1], n_zones))
+    if dtype is not None and np.dtype(dtype) != store.dtype:
+        raise ValueError("The store {0} is {1}, not {2}".format(path, store.dtype, np.dtype(dtype)))
+    return store.sliceTime(len(store))
+
+def appendOD(path, OD_matrices, start_date, interval, dtype=None, chunk_slices=168):
+    """
+    Append the 3-D array `OD_matrices`, whose first slice begins at
+    `start_date`, to the store in `path` (see appendStart).
+    Outputs:
+        - Number of slices of the store.
+    """
+    end = appendStart(path, interval, OD_matrices.shape[1], dtype)
+    if end != start_date:
+        raise ValueError("The store {0} ends at {1}, the new slices begin at {2}".format(path, end, start_date))
+    writer = ODStoreWriter.reopen(path, chunk_slices)
+    writer.write(OD_matrices)
+    writer.close()
+    return writer.n_slices
+
+def saveOD(path, OD_matrices, start_date, interval, dtype='int32', chunk_slices=168):
+    """
+    Save the 3-D array `OD_matrices` in a sparse store in `path`.
+    """
+    writer = ODStoreWriter(path, OD_matrices.shape[1], start_date, interval, dtype, chunk_slices)
+    writer.write(OD_matrices)
+    writer.close()
+
+class ODStore:
+    """
+    Read a store written by ODStoreWriter. It is indexed like the dense 3-D
+    array (store[k], store[start:end]), decompressing only the chunks needed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta = json.load(open(os.path.join(path, META_FILE)))
+        self.shape = tuple(self.meta['shape'])
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.start_date = datetime.fromisoformat(self.meta['start_date'])
+        self.interval = self.meta['interval']
+        self.chunks = self.meta['chunks']
+        self.ends = np.array([c['end'] for c in self.chunks], dtype=np.int64)
+        self.cached = (None, None) # Last chunk read
+
+    def __len__(self):
+        return self.shape[0]
+
+    def sliceTime(self, k):
+        """
+        Begining of the interval of the slice `k`.
+        """
+        return self.start_date + timedelta(hours=k * self.interval)
+
+    def sliceIndex(self, time):
+        """
+        Index of the slice that contains the datetime `time`.
+        """
+        return int((time - self.start_date) // timedelta(hours=self.interval))
+
+    def _chunk(self, c):
+        if self.cached[0] != c:
+            data = np.load(os.path.join(self.path, self.chunks[c]['file']))
+            self.cached = (c, (data['ptr'], data['cells'], data['values']))
+        return self.cached[1]
+
+    def read(self, start, end):
+        """
+        Dense array with the slices [`start`, `end`).
+        """
+        start, end = max(start, 0), min(end, self.shape[0])
+        n = self.shape[1]
+        out = np.zeros((max(end - start, 0), n * n), dtype=self.dtype)
+        c = int(np.searchsorted(self.ends, start, side='right'))
+        while c < len(self.chunks) and self.chunks[c]['start'] < end:
+            ptr, cells, values = self._chunk(c)
+            first = self.chunks[c]['start']
+            a, b = max(start, first), min(end, self.chunks[c]['end'])
+            lo, hi = ptr[a - first], ptr[b - first]
+            rows = np.repeat(np.arange(a, b) - start, np.diff(ptr[a-first:b-first+1]))
+            out[rows, cells[lo:hi]] = values[lo:hi]
+            c += 1
+        return out.reshape(-1, n, n)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, end, step = k.indices(self.shape[0])
+            return self.read(start, end)[::step]
+        if k < 0:
+            k += self.shape[0]
+        if k < 0 or k >= self.shape[0]:
+            raise IndexError("Slice {0} out of the store with {1} slices".format(k, self.shape[0]))
+        return self.read(k, k+1)[0]
+
+def loadOD(path):
+    """
+    Open the O/D matrices in `path` without reading them: a sparse store
+    (directory) or a .npy file, mapped in memory.
+    """
+    if os.path.isdir(path):
+        return ODStore(path)
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,325 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trips'))
+from tlcData import parseDate, monthRange, partitionPath, CACHE_DIR
+from zoneModel import loadZoneModel
+
+"""
+Run the whole workflow from a json configuration: the stages are processes
+with declared inputs and outputs, in a graph of dependencies,
+    taz ------------.
+                     trips
+    import ---------'
+           `-- od -- vmr
+    fcd
+so the independent ones (the TAZ file and the import of the trips, the trips
+and the O/D matrices, the counts of the fcd) run at the same time. The
+binary cache of the zones (zoneModel.py) is built before, so the stages only
+read it. A stage is skipped if its command and the fingerprints (size and
+modification time) of its inputs and outputs did not change since its last
+successful run, saved in .pipeline/state.json. At the end, the time of every stage and the
+critical path (the longest chain of dependencies) are reported.
+
+python3 pipeline.py pipeline.json [--jobs N] [--stages od,vmr] [--force trips] [--dry-run]
+
+Configuration (the sections od, vmr and fcd are optional):
+{
+ "zones": "data/taxi_zones.geojson", "map": "data/map.net.xml",
+ "offset": [-584029.48, -4507296.15], "zones_req": [140, 141, 236] or "all",
+ "car_type": "private", "edge_types": "none",
+ "sdate": "2017/10/01", "edate": "2017/12/31",
+ "trip_cache": "taxiCache", "source": null,
+ "taz_file": "sumo/tazs.xml", "trips_file": "sumo/odTrips.xml", "trips_options": ["--sort"],
+ "od": {"name": "2017", "interval": 1, "format": "npy"},
+ "vmr": {"start": 0, "end": 24, "interval": 1, "dir": "vmr"},
+ "fcd": {"fcd": "sumo/fcd.txt", "output": "dataframe.csv", "options": ["--workers", "4"]}
+}
+"""
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_DIR = ".pipeline"
+
+def fingerprint(path):
+    """
+    Size and modification time of the file `path`, or of all the files in
+    the directory `path`. None if it does not exist.
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    if os.path.isdir(path):
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                full = os.path.join(root, name)
+                stat = os.stat(full)
+                files.append([os.path.relpath(full, path), stat.st_size, stat.st_mtime_ns])
+        return files
+    return None
+
+def stageKey(stage):
+    """
+    Hash of the command of `stage` and the fingerprints of its inputs.
+    """
+    inputs = {'command': stage['command'], 'cwd': stage['cwd'],
+              'inputs': [[path, fingerprint(path)] for path in stage['inputs']]}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def outputsKey(stage):
+    return hashlib.sha256(json.dumps([fingerprint(path) for path in stage['outputs']]).encode()).hexdigest()
+
+def tripsConfig(config, path):
+    """
+    Write the configuration file of tripsGenerator.py in `path`, only if it
+    changed (its modification time is part of the fingerprints).
+    """
+    zones_req = config.get('zones_req', 'all')
+    lines = [config['zones'], config['map'], config.get('trip_cache', CACHE_DIR),
+             "{0},{1}".format(*config['offset']), config['taz_file'], config['trips_file'],
+             config['sdate'], config['edate'],
+             zones_req if isinstance(zones_req, str) else ",".join(map(str, zones_req)),
+             config.get('car_type', 'private'), config.get('edge_types', 'none')]
+    text = "\n".join(lines) + "\n"
+    if os.path.exists(path) and open(path).read() == text:
+        return
+    with open(path, 'w') as fout:
+        fout.write(text)
+
+def buildStages(config, state_dir=STATE_DIR):
+    """
+    List of the stages of `config`, in an order compatible with their
+    dependencies. A stage is a dictionary with its name, the names of the
+    stages it depends on, the command, its working directory (None for the
+    current one) and the paths of its inputs and outputs.
+    """
+    python = sys.executable
+    trips_script = os.path.join(ROOT_DIR, 'trips', 'tripsGenerator.py')
+    config_path = os.path.join(state_dir, "tripsGenerator.txt")
+    report = lambda name: ["--report", os.path.abspath(os.path.join(state_dir, "reports", name + ".json"))]
+    trip_cache = config.get('trip_cache', CACHE_DIR)
+    months = [partitionPath(trip_cache, year, month)
+              for year, month in monthRange(parseDate(config['sdate']), parseDate(config['edate']))]
+    source = [] if config.get('source') is None else ["--source", config['source']]
+
+    stages = [
+        {'name': 'taz', 'deps': [], 'cwd': None,
+         'command': [python, trips_script, config_path, "--only", "taz"] + report('taz'),
+         'inputs': [config['zones'], config['map'], config_path], 'outputs': [config['taz_file']]},
+        {'name': 'import', 'deps': [], 'cwd': None,
+         'command': [python, trips_script, config_path, "--only", "import"] + source + report('import'),
+         'inputs': [config_path], 'outputs': months},
+        {'name': 'trips', 'deps': ['taz', 'import'], 'cwd': None,
+         'command': [python, trips_script, config_path, "--only", "trips"] + source +
+                    config.get('trips_options', []) + report('trips'),
+         'inputs': [config['zones'], config['map'], config_path, config['taz_file']] + months,
+         'outputs': [config['trips_file']]},
+    ]
+    if 'od' in config:
+        od = config['od']
+        sparse = od.get('format', 'npy') == 'sparse'
+        od_path = "OD_matrices_{0}{1}".format(od['name'], "" if sparse else ".npy")
+        stages.append({'name': 'od', 'deps': ['import'], 'cwd': None,
+                       'command': [python, os.path.join(ROOT_DIR, 'generateOD.py'), config['sdate'], config['edate'],
+                                   od['name'], str(od.get('interval', 1)), "--cache-dir", trip_cache,
+                                   "--format", od.get('format', 'npy')] + source + report('od'),
+                       'inputs': months, 'outputs': [od_path]})
+        if 'vmr' in config:
+            vmr = config['vmr']
+            interval = ["--interval", str(vmr['interval'])] if 'interval' in vmr else []
+            stages.append({'name': 'vmr', 'deps': ['od'], 'cwd': vmr.get('dir', 'vmr'),
+                           'command': [python, os.path.join(ROOT_DIR, 'numpyToVisum.py'), os.path.abspath(od_path),
+                                       str(vmr['start']), str(vmr['end'])] + interval +
+                                      vmr.get('options', []) + report('vmr'),
+                           'inputs': [od_path],
+                           'outputs': [os.path.join(vmr.get('dir', 'vmr'), "OD_output{0}.txt".format(k))
+                                       for k in range(vmr['start'], vmr['end'])]})
+    if 'fcd' in config:
+        fcd = config['fcd']
+        zones_req = config.get('zones_req', 'all')
+        if zones_req == 'all':
+            zones_req = loadZoneModel(config['zones'], config['offset']).ids.tolist()
+        stages.append({'name': 'fcd', 'deps': [], 'cwd': None,
+                       'command': [python, os.path.join(ROOT_DIR, 'trips', 'fcd2counts.py'), "--zones", config['zones'],
+                                   "--fcd", fcd['fcd'], "--offset={0},{1}".format(*config['offset']),
+                                   "--zones-req", ",".join(map(str, zones_req)), "--output", fcd['output']] +
+                                  fcd.get('options', []) + report('fcd'),
+                       'inputs': [config['zones'], fcd['fcd']], 'outputs': [fcd['output']]})
+    return stages
+
+def criticalPath(stages, seconds):
+    """
+    Longest chain of dependencies of `stages` with the times in `seconds`
+    (by name).
+    Outputs:
+        - Length of the chain in seconds and the names of its stages.
+    """
+    finish = {}
+    previous = {}
+    for stage in stages: # in order of dependencies
+        deps = [d for d in stage['deps'] if d in finish]
+        first = max(deps, key=lambda d: finish[d]) if len(deps) > 0 else None
+        finish[stage['name']] = (finish[first] if first is not None else 0.0) + seconds.get(stage['name'], 0.0)
+        previous[stage['name']] = first
+    if len(finish) == 0:
+        return 0.0, []
+    name = max(finish, key=finish.get)
+    length = finish[name]
+    path = []
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return length, path[::-1]
+
+def saveJson(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as fout:
+        json.dump(data, fout, indent=1)
+    os.replace(tmp_path, path)
+
+def runStage(stage, log_path):
+    """
+    Run the command of `stage` with its output in `log_path`.
+    Outputs:
+        - Exit code of the command.
+    """
+    if stage['cwd'] is not None:
+        os.makedirs(stage['cwd'], exist_ok=True)
+    with open(log_path, 'w') as log:
+        return subprocess.call(stage['command'], cwd=stage['cwd'], stdout=log, stderr=subprocess.STDOUT)
+
+def runPipeline(stages, state_dir=STATE_DIR, jobs=None, force=(), dry_run=False):
+    """
+    Run the `stages` (see buildStages), each one as soon as the stages it
+    depends on end, at most `jobs` at the same time. The stages up to date
+    are skipped, except the ones in `force`.
+    Outputs:
+        - Dictionary with the status (ran, skipped, failed or blocked), start
+          and time of every stage, and the critical path.
+    """
+    os.makedirs(os.path.join(state_dir, "logs"), exist_ok=True)
+    os.makedirs(os.path.join(state_dir, "reports"), exist_ok=True)
+    state_path = os.path.join(state_dir, "state.json")
+    state = json.load(open(state_path)) if os.path.exists(state_path) else {}
+    names = set(stage['name'] for stage in stages)
+    pending = list(stages)
+    running = {} # future -> (stage, key, start)
+    status = {}
+    results = {}
+    begin = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=jobs or len(stages) or 1) as pool:
+        while len(pending) > 0 or len(running) > 0:
+            # Start the stages whose dependencies ended
+            for stage in list(pending):
+                deps = [d for d in stage['deps'] if d in names]
+                if any(status.get(d) in ('failed', 'blocked') for d in deps):
+                    pending.remove(stage)
+                    status[stage['name']] = 'blocked'
+                    results[stage['name']] = {'status': 'blocked'}
+                    continue
+                if not all(status.get(d) in ('ran', 'skipped', 'would run') for d in deps):
+                    continue
+                pending.remove(stage)
+                key = stageKey(stage)
+                saved = state.get(stage['name'], {})
+                # In a dry run, the stages after one that would run would run too
+                changed = any(status.get(d) == 'would run' for d in deps)
+                if stage['name'] not in force and not changed and saved.get('key') == key and \
+                   saved.get('outputs') == outputsKey(stage) and \
+                   all(fingerprint(path) is not None for path in stage['outputs']):
+                    status[stage['name']] = 'skipped'
+                    results[stage['name']] = {'status': 'skipped', 'last_seconds': saved.get('seconds')}
+                    print("{0}: up to date".format(stage['name']))
+                    continue
+                if dry_run:
+                    status[stage['name']] = 'would run'
+                    results[stage['name']] = {'status': 'would run'}
+                    print("{0}: would run {1}".format(stage['name'], " ".join(stage['command'])))
+                    continue
+                print("{0}: running".format(stage['name']))
+                log_path = os.path.join(state_dir, "logs", stage['name'] + ".log")
+                start = time.perf_counter()
+                running[pool.submit(runStage, stage, log_path)] = (stage, key, start)
+            if len(running) == 0:
+                continue
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, key, start = running.pop(future)
+                name = stage['name']
+                seconds = time.perf_counter() - start
+                code = future.result()
+                results[name] = {'status': 'ran' if code == 0 else 'failed', 'start_s': start - begin,
+                                 'seconds': seconds, 'log': os.path.join(state_dir, "logs", name + ".log")}
+                status[name] = results[name]['status']
+                if code == 0:
+                    state[name] = {'key': key, 'outputs': outputsKey(stage), 'seconds': seconds}
+                    saveJson(state_path, state)
+                    print("{0}: done in {1:.1f} s".format(name, seconds))
+                else:
+                    state.pop(name, None)
+                    saveJson(state_path, state)
+                    print("{0}: failed with exit code {1}, see {2}".format(name, code, results[name]['log']))
+
+    wall = time.perf_counter() - begin
+    results = {stage['name']: results[stage['name']] for stage in stages}
+    seconds = {name: r.get('seconds', 0.0) for name, r in results.items()}
+    length, path = criticalPath(stages, seconds)
+    # The critical path of a full run, with the last time of every stage
+    full_length, full_path = criticalPath(stages, {s['name']: state.get(s['name'], {}).get('seconds', 0.0)
+                                                   for s in stages})
+    report = {'wall_s': wall, 'serial_s': sum(seconds.values()), 'critical_path_s': length,
+              'critical_path': path, 'full_critical_path_s': full_length, 'full_critical_path': full_path,
+              'stages': results}
+    saveJson(os.path.join(state_dir, "report.json"), report)
+    return report
+
+def printReport(report):
+    print("\n{0:8s} {1:9s} {2:>9s} {3:>9s}".format("stage", "status", "start s", "time s"))
+    for name, result in report['stages'].items():
+        print("{0:8s} {1:9s} {2:9.1f} {3:9.1f}".format(name, result['status'], result.get('start_s', 0.0),
+                                                     result.get('seconds', 0.0)))
+    print("Wall time: {0:.1f} s, sum of the stages: {1:.1f} s".format(report['wall_s'], report['serial_s']))
+    print("Critical path: {0} ({1:.1f} s)".format(" -> ".join(report['critical_path']), report['critical_path_s']))
+    print("Critical path of a full run: {0} ({1:.1f} s)".format(" -> ".join(report['full_critical_path']),
+                                                              report['full_critical_path_s']))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the stages of the workflow in parallel, skipping the ones up to date")
+    parser.add_argument("config", help="json with the configuration of the pipeline")
+    parser.add_argument("--jobs", type=int, default=None, help="stages running at the same time (all by default)")
+    parser.add_argument("--stages", default=None, help="stages to run, separated by commas (all by default)")
+    parser.add_argument("--force", default="", help="stages to run even if they are up to date, separated by commas")
+    parser.add_argument("--state-dir", default=STATE_DIR, help="directory of the state, logs and report")
+    parser.add_argument("--dry-run", action='store_true', help="only print the stages that would run")
+    args = parser.parse_args()
+
+    config = json.load(open(args.config))
+    os.makedirs(args.state_dir, exist_ok=True)
+    os.makedirs(config.get('trip_cache', CACHE_DIR), exist_ok=True)
+    tripsConfig(config, os.path.join(args.state_dir, "tripsGenerator.txt"))
+    stages = buildStages(config, args.state_dir)
+    if args.stages is not None:
+        selected = args.stages.split(',')
+        unknown = set(selected) - set(s['name'] for s in stages)
+        if len(unknown) > 0:
+            parser.error("Unknown stages: {0}".format(", ".join(sorted(unknown))))
+        stages = [s for s in stages if s['name'] in selected]
+    if not args.dry_run and any(s['name'] in ('taz', 'trips', 'fcd') for s in stages):
+        # The zone cache is built here, so the stages that start together do not build it at the same time
+        loadZoneModel(config['zones'], config['offset'])
+
+    report = runPipeline(stages, args.state_dir, args.jobs, set(args.force.split(',')) - {''}, args.dry_run)
+    printReport(report)
+    if any(r['status'] in ('failed', 'blocked') for r in report['stages'].values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import numpy as np
+import xml.etree.ElementTree as ET
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'trips'))
+from zoneModel import loadZoneModel
+from zoneGrid import ZoneGrid
+from tripsGenerator import classifyEdges, classifyEdgesBruteForce, classifyLanes, laneShapes
+
+"""
+The classification of the edges with the STRtree (and with the zone grid)
+must be the same as the one of classifyEdgesBruteForce, also for the edges
+on the border of two zones and the zones that are MultiPolygons.
+
+python3 -m pytest tests
+"""
+
+OFFSET = (-1000.0, -2000.0)
+
+def square(x0, y0, side=100.0):
+    return [[[x0, y0], [x0+side, y0], [x0+side, y0+side], [x0, y0+side], [x0, y0]]]
+
+# Zones 1 and 2 share the border x = 100; zone 3 has two separated parts
+ZONES = {1: {'type': 'Polygon', 'coordinates': square(0, 0)},
+         2: {'type': 'Polygon', 'coordinates': square(100, 0)},
+         3: {'type': 'MultiPolygon', 'coordinates': [square(0, 200), square(200, 200)]}}
+
+# Lanes of every edge, in the coordinates of the geojson
+EDGES = {'inside1': [[(10, 10), (50, 40), (90, 20)]],
+         'border': [[(100, 20), (100, 80)]],
+         'cross': [[(50, 50), (150, 50)]],
+         'corner': [[(100, 100), (100, 150)]],
+         'part0': [[(20, 220), (80, 280)]],
+         'part1': [[(220, 220), (280, 280)]],
+         'gap': [[(120, 250), (180, 250)]],
+         'lanes': [[(20, 190), (80, 190)], [(20, 195), (80, 210)]],
+         'outside': [[(500, 500), (600, 600)]]}
+
+# Expected zones of the edges (the rest are in no zone)
+EXPECTED = {1: {'inside1', 'border', 'cross', 'corner'},
+            2: {'border', 'cross', 'corner'},
+            3: {'part0', 'part1', 'lanes'}}
+
+def writeZones(path, zones):
+    features = [{'type': 'Feature', 'geometry': geometry, 'properties': {'OBJECTID': zone, 'LocationID': zone}}
+                for zone, geometry in zones.items()]
+    with open(path, 'w') as fout:
+        json.dump({'type': 'FeatureCollection', 'features': features}, fout)
+
+def writeNet(path, edges):
+    """
+    net.xml with the lanes of `edges`, moved to the SUMO coordinates (the
+    coordinates of the geojson plus OFFSET).
+    """
+    with open(path, 'w') as fout:
+        fout.write('<net version="1.0">\n')
+        for edge, lanes in edges.items():
+            fout.write('    <edge id="{0}" type="highway.primary">\n'.format(edge))
+            for l, points in enumerate(lanes):
+                shape = " ".join("{0:.2f},{1:.2f}".format(x + OFFSET[0], y + OFFSET[1]) for x, y in points)
+                fout.write('        <lane id="{0}_{1}" index="{1}" shape="{2}"/>\n'.format(edge, l, shape))
+            fout.write('    </edge>\n')
+        fout.write('</net>\n')
+
+def classifyAll(tmp_path, edges):
+    """
+    Classification of `edges` over ZONES with classifyEdges, the zone grid and
+    classifyEdgesBruteForce.
+    """
+    zones_path, net_path = str(tmp_path / "zones.geojson"), str(tmp_path / "map.net.xml")
+    writeZones(zones_path, ZONES)
+    writeNet(net_path, edges)
+    polys = loadZoneModel(zones_path, cache_dir=None).polygons()
+    mapRoot = ET.parse(net_path).getroot()
+    allowedIndexs = [i for i, child in enumerate(mapRoot) if child.tag == "edge"]
+    grid = ZoneGrid.build(polys, 10.0, OFFSET)
+    return (classifyEdges(mapRoot, allowedIndexs, polys, OFFSET),
+            classifyLanes(laneShapes(mapRoot, allowedIndexs, OFFSET), polys, grid),
+            classifyEdgesBruteForce(mapRoot, allowedIndexs, polys, OFFSET))
+
+def test_borders_and_multipolygons(tmp_path):
+    tree, grid, brute = classifyAll(tmp_path, EDGES)
+    assert brute == EXPECTED
+    assert tree == brute
+    assert grid == brute
+
+def test_random_edges(tmp_path):
+    rng = np.random.default_rng(0)
+    starts = rng.uniform(-20, 320, (300, 2))
+    # Half of the edges are snapped to the lines of 100 m, where the borders are
+    starts[::2] = np.round(starts[::2] / 100) * 100
+    edges = {'e{0}'.format(e): [[tuple(p) for p in np.cumsum(np.vstack([starts[e], rng.uniform(-40, 40, (3, 2))]), axis=0)]]
+             for e in range(len(starts))}
+    tree, grid, brute = classifyAll(tmp_path, edges)
+    assert sum(len(e) for e in brute.values()) > 0
+    assert tree == brute
+    assert grid == brute
@@ -1,68 +1,553 @@
 import numpy as np
+import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Polygon, mapping, Point, LineString
+from shapely.strtree import STRtree
+import shapely
 from lxml import etree
+from multiprocessing import Pool
+import os
+import json
+import argparse
+from zoneGrid import loadOrBuildGrid
+from npyWriter import NpyWriter
+from fcdStore import FcdStore, isStore
+from zoneModel import loadZoneModel, ZONE_CACHE_DIR
+import instrument
+from instrument import span, count, progress
+
+"""
+Traffic counts per zone from the FCD (floating car data) output of SUMO:
+the max number of vehicles in every zone, sampled every `interv` seconds,
+in windows of `time_laps` seconds. A window ends at every timestep multiple
+of `time_laps` and the k-th row is labelled `begin_value` + k * `time_laps`,
+so the first row has the counts before the first of them. With
+`--label-start`, those counts are not written and every row is labelled by
+the start of its window. The last window, that is not closed, is not written.
 
-def fast_iter(context, func, *args):
-    for event, elem in context:
-        func(elem, *args)
-        # It's safe to call clear() here because no descendants will be
-        # accessed
-        elem.clear()
-        # Also eliminate now-empty references from the root node to elem
-
-def process_element(elem, interv, counts, time_laps, n_polys):
-    if int(float(elem.attrib['time']))%time_laps == 0:
-        M.append(np.copy(counts))
-        counts.fill(0)
-        print(float(elem.attrib['time']) )
-
-    if int(float(elem.attrib['time']))%interv != 0:
-        return
-
-    stepCounts = np.zeros(n_polys)
-    for child in elem: # for every active vehicle
-        x = float(child.attrib['x'])
-        y = float(child.attrib['y'])
-        p0 = Point((x-offset[0], y-offset[1]))
-        stepCounts += np.array(list(polys.intersects(p0)), dtype=int) # check its zone and added to the counts
-
-    for i in range(n_polys):
-        counts[i] = (stepCounts[i] if stepCounts[i]>counts[i] else counts[i])
+python3 fcd2counts.py [--fcd sumo/fcd.txt] [--output dataframe.csv] [options]
+"""
 
+# Default parameters
 zones_path = "data/taxi_zones.geojson"
 fcd_path = "sumo/fcd.txt"
 req_polys = [140, 141, 236, 237, 262, 263]
 offset = (-584029.48,-4507296.15)
 begin_value = 0
-end_value = 7862400
-step_length = 3
 time_laps = 600
+interv = 15
 dataframe_path = "dataframe.csv"
 
-n = (end_value - begin_value) // step_length
+class FcdCounter:
+    """
+    Counts of vehicles per zone of `req_polys` (OBJECTIDs of the geojson in
+    `zones_path`) from fcd files.
+    Inputs:
+        - offset: the offset of the SUMO network, subtracted to the positions.
+        - interv: seconds between the samples of the vehicles.
+        - time_laps: size of the windows in seconds.
+        - begin_value: time of the first row.
+        - grid_path, grid_resolution: zone raster grid (.npy) to classify the
+          vehicles, built if it does not exist. None to use only the exact
+          polygon tests.
+        - n_workers: number of processes. With more than one, the fcd file is
+          split in pieces that are processed in parallel.
+        - zone_cache: directory of the binary cache of the zones (zoneModel.py).
+        - label_start: if True, the counts before the first timestep multiple
+          of `time_laps` are discarded, so the k-th row has the window that
+          begins at the k-th of them, labelled `begin_value` + k * `time_laps`.
+    """
+    def __init__(self, zones_path, req_polys, offset=(0,0), interv=15, time_laps=600, begin_value=0,
+                 grid_path=None, grid_resolution=50.0, n_workers=1, zone_cache=ZONE_CACHE_DIR,
+                 label_start=False):
+        self.zones_path = zones_path
+        self.req_polys = list(req_polys)
+        self.offset = tuple(offset)
+        self.interv = interv
+        self.time_laps = time_laps
+        self.begin_value = begin_value
+        self.grid_path = grid_path
+        self.grid_resolution = grid_resolution
+        self.n_workers = n_workers
+        self.zone_cache = zone_cache
+        self.label_start = label_start
 
+        # Polygons of the zones, indexed by OBJECTID
+        self.polys = loadZoneModel(zones_path, offset, zone_cache).polygons(self.req_polys)
+        self.n_polys = len(self.polys)
+        # Spatial index of the zones
+        self.tree = STRtree(np.asarray(self.polys.values))
+        self.grid = None
+        if grid_path is not None:
+            self.grid = loadOrBuildGrid(grid_path, self.polys, grid_resolution, offset)
 
-# Read the geojson file
-zones = gpd.read_file(zones_path)
-# Save polygons in GeoSeries format
-polys = gpd.GeoSeries({zones['OBJECTID'][i-1] : zones.geometry[i-1] for i in req_polys})
-print("Number of zones: "+str(len(polys)))
+    def params(self):
+        """
+        Arguments to build the same counter in another process (one worker).
+        """
+        return (self.zones_path, self.req_polys, self.offset, self.interv, self.time_laps,
+                self.begin_value, self.grid_path, self.grid_resolution, 1, self.zone_cache,
+                self.label_start)
 
-context = etree.iterparse(fcd_path, tag='timestep')
-M = []
-n_polys = len(polys)
-interv = 15
-counts = np.zeros(n_polys)
-fast_iter(context, process_element, interv, counts, time_laps, n_polys)
+    def count_vehicles(self, elem):
+        """
+        Number of vehicles of the timestep `elem` in every zone.
+        """
+        # Positions of all the active vehicles
+        x = np.array(elem.xpath('*/@x'), dtype=float) - self.offset[0]
+        y = np.array(elem.xpath('*/@y'), dtype=float) - self.offset[1]
+        count("vehicles", len(x)) # Only in this process, not in the workers
 
+        # Zones of all the vehicles in a single query (a vehicle in the border of
+        # two zones counts in both)
+        if self.grid is not None:
+            return self.grid.countPoints(x, y)
+        _, zones_idx = self.tree.query(shapely.points(x, y), predicate='intersects')
+        return np.bincount(zones_idx, minlength=self.n_polys)
 
-import pandas as pd
-indexes = np.array([i for i in range(begin_value, end_value, time_laps)]) # Indexes (seconds)
+    def point_zones(self, x, y):
+        """
+        Pairs (vehicle index, zone index) of the vehicles in the positions
+        (`x`, `y`) in SUMO coordinates.
+        """
+        x = np.asarray(x) - self.offset[0]
+        y = np.asarray(y) - self.offset[1]
+        if self.grid is not None:
+            return self.grid.queryPoints(x, y)
+        return self.tree.query(shapely.points(x, y), predicate='intersects')
+
+    def store_counts(self, store_path):
+        """
+        Generator with a pair (interval start, counts array) per window, like
+        iter_counts, from a columnar store of the fcd file (see fcdStore.py),
+        without parsing the xml.
+        """
+        counts = FcdStore(store_path).windowCounts(self.point_zones, self.n_polys, self.interv, self.time_laps,
+                                                   label_start=self.label_start)
+        for k in range(len(counts)):
+            yield self.begin_value + k*self.time_laps, counts[k]
+
+    def window_counts(self, context):
+        """
+        Generator with the max number of vehicles per zone (sampled every
+        `interv` seconds) between the timesteps multiple of `time_laps`.
+        Outputs:
+            - First, the pair (None, counts before the first timestep multiple of
+              `time_laps`), then a pair (time, counts) for every timestep multiple
+              of `time_laps`, with the counts from it until the next one.
+        """
+        start = None
+        counts = np.zeros(self.n_polys, dtype=np.int64)
+        for event, elem in context:
+            time = int(float(elem.attrib['time']))
+            if time%self.time_laps == 0:
+                yield start, counts
+                start, counts = time, np.zeros(self.n_polys, dtype=np.int64)
+            if time%self.interv == 0:
+                np.maximum(counts, self.count_vehicles(elem), out=counts)
+            # It's safe to call clear() here because no descendants will be accessed
+            elem.clear()
+        yield start, counts
+
+    def count_range(self, path, start, end):
+        """
+        window_counts of the byte range [start, end) of the fcd file, as a list.
+        """
+        reader = RangeReader(path, start, end)
+        try:
+            return list(self.window_counts(etree.iterparse(reader, tag='timestep')))
+        finally:
+            reader.close()
+
+    def iter_parts(self, fcd_path, start=0, segment_bytes=None):
+        """
+        Generator with a pair (end, windows) per piece of the fcd file from the
+        byte `start`, in order: `end` is the byte where the piece ends and
+        `windows` the output of window_counts for it. The pieces are of
+        `segment_bytes` at most (if given) and, with `n_workers` > 1, they are
+        processed by a pool of processes.
+        """
+        size = os.path.getsize(fcd_path)
+        if self.n_workers <= 1 and segment_bytes is None and start == 0:
+            yield size, self.window_counts(etree.iterparse(fcd_path, tag='timestep'))
+            return
+
+        # More pieces than processes to balance the load
+        n_parts = 4 * self.n_workers if self.n_workers > 1 else 1
+        if segment_bytes is not None:
+            n_parts = max(n_parts, -(-(size - start) // segment_bytes))
+        tasks = [(fcd_path, a, b) for a, b in timestep_ranges(fcd_path, n_parts, start)]
+        if self.n_workers <= 1:
+            for task in tasks:
+                yield task[2], self.count_range(*task)
+            return
+        with Pool(self.n_workers, initializer=init_worker, initargs=self.params()) as pool:
+            for task, windows in zip(tasks, pool.imap(count_range, tasks)):
+                yield task[2], windows
+
+    def iter_counts(self, fcd_path):
+        """
+        Generator with a pair (interval start, counts array) per window of
+        the fcd file, `begin_value` + k * `time_laps` for the k-th row. With
+        `n_workers` > 1, the file is split in pieces that are processed by a
+        pool of processes, and merged in time order. `fcd_path` can also be
+        a columnar store of the file (fcdStore.py).
+        """
+        if isStore(fcd_path):
+            yield from self.store_counts(fcd_path)
+            return
+        parts = (windows for end, windows in self.iter_parts(fcd_path))
+        for k, (time, counts) in enumerate(merge_windows(parts, self.n_polys, label_start=self.label_start)):
+            yield self.begin_value + k*self.time_laps, counts
+
+    def checkpoint_params(self, fcd_path, fmt):
+        """
+        Everything a checkpoint depends on, to check it before resuming.
+        """
+        return {'fcd': os.path.abspath(fcd_path), 'fcd_size': os.path.getsize(fcd_path),
+                'zones': [int(z) for z in self.polys.index], 'offset': list(self.offset),
+                'interv': self.interv, 'time_laps': self.time_laps,
+                'begin_value': self.begin_value, 'label_start': self.label_start, 'format': fmt}
+
+    def write(self, fcd_path, output_path, fmt=None, verbose=1, checkpoint_bytes=None, resume=False):
+        """
+        Write the counts of `fcd_path` in `output_path` as they are computed.
+        The format (csv, parquet or npy) is `fmt` or the extension of
+        `output_path`. With npy, the times and zones are saved in
+        `output_path`.json.
+        `fcd_path` can also be a columnar store of the fcd file (fcdStore.py),
+        much faster to count again, and then there are no checkpoints.
+        With `checkpoint_bytes`, the fcd file is processed in pieces of that
+        size and, after each one, the output is flushed and the state (byte
+        offset in the fcd file, counts of the open window, rows written) is
+        saved in `output_path`.checkpoint.json. With `resume`, the run
+        continues from that checkpoint instead of from the beginning. The
+        checkpoint is removed when the run ends. Not available with parquet.
+        Outputs:
+            - Number of rows written.
+        """
+        fmt = countsFormat(output_path, fmt)
+        if isStore(fcd_path):
+            writer = CountsWriter(output_path, list(self.polys.index), fmt, self.begin_value, self.time_laps)
+            for time, counts in self.iter_counts(fcd_path):
+                writer.write(time, counts)
+                count("windows")
+            writer.close()
+            return writer.rows
+        checkpoint_path = output_path + ".checkpoint.json"
+        params = self.checkpoint_params(fcd_path, fmt)
+        if fmt == 'parquet':
+            if resume:
+                print("Checkpoints are not available with parquet, starting from the beginning")
+            checkpoint_bytes, resume = None, False
+
+        start, running, running_start, state = 0, None, None, None
+        if resume and os.path.exists(checkpoint_path):
+            state = json.load(open(checkpoint_path))
+            if state['params'] != params:
+                raise ValueError("The checkpoint {0} is from another run".format(checkpoint_path))
+            start, running_start = state['offset'], state['window_start']
+            if state['counts'] is not None:
+                running = np.array(state['counts'], dtype=np.int64)
+            if verbose > 0:
+                print("Resuming from byte {0} of {1} ({2} rows written)".format(start, fcd_path, state['rows']))
+        elif resume:
+            print("No checkpoint in {0}, starting from the beginning".format(checkpoint_path))
+        if resume and checkpoint_bytes is None:
+            checkpoint_bytes = params['fcd_size']
+
+        writer = CountsWriter(output_path, list(self.polys.index), fmt, self.begin_value, self.time_laps,
+                              resume=None if state is None else (state['rows'], state['output_bytes']))
+        merger = WindowMerger(self.n_polys, running, running_start, self.label_start)
+        for end, windows in self.iter_parts(fcd_path, start, checkpoint_bytes):
+            for _, counts in merger.add(windows):
+                time = self.begin_value + writer.rows*self.time_laps
+                writer.write(time, counts)
+                count("windows")
+                if verbose > 0:
+                    progress("fcd2counts", writer.rows, unit="windows")
+            if checkpoint_bytes is not None:
+                writer.sync()
+                saveCheckpoint(checkpoint_path, {'params': params, 'offset': end, 'rows': writer.rows,
+                                                 'last_window': self.begin_value + (writer.rows-1)*self.time_laps
+                                                                if writer.rows > 0 else None,
+                                                 'output_bytes': writer.size(),
+                                                 'window_start': merger.start,
+                                                 'counts': None if merger.running is None
+                                                           else merger.running.tolist()})
+        writer.close()
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return writer.rows
+
+def saveCheckpoint(path, state):
+    """
+    Write the checkpoint `state` in `path`, replacing the previous one at once.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as fout:
+        json.dump(state, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_path, path)
+
+# Counter of the worker processes, set by init_worker
+worker_counter = None
+
+def init_worker(*params):
+    global worker_counter
+    worker_counter = FcdCounter(*params)
+
+def count_range(task):
+    return worker_counter.count_range(*task)
+
+class WindowMerger:
+    """
+    Join the outputs of window_counts of consecutive pieces of the fcd file.
+    `running` has the counts of the window that is open, the one that
+    continues in the next piece, and `start` the timestep where it began
+    (None before the first timestep multiple of `time_laps`). With
+    `label_start`, the counts before that timestep are discarded (`running`
+    is None until it is reached).
+    """
+    def __init__(self, n_polys, running=None, start=None, label_start=False):
+        if running is None and not label_start:
+            running = np.zeros(n_polys, dtype=np.int64)
+        self.running = running
+        self.start = start
+        self.label_start = label_start
+
+    def add(self, windows):
+        """
+        Generator with pairs (time, counts), where the counts are the max
+        number of vehicles per zone between the previous timestep multiple of
+        `time_laps` and `time`, for the windows closed in this piece. With
+        `label_start`, `time` is the start of the window instead.
+        """
+        for start, counts in windows:
+            if start is None: # The window continues from the previous piece
+                if self.running is not None:
+                    np.maximum(self.running, counts, out=self.running)
+            else:
+                if self.running is not None:
+                    yield (self.start if self.label_start else start), self.running
+                self.start, self.running = start, counts
+
+def merge_windows(parts, n_polys, running=None, start=None, label_start=False):
+    """
+    Join the outputs of window_counts of consecutive pieces of the fcd file.
+    Outputs:
+        - Generator with pairs (time, counts), like WindowMerger.add. The last
+          window, that is not closed, is not returned.
+    """
+    merger = WindowMerger(n_polys, running, start, label_start)
+    for part in parts:
+        for item in merger.add(part):
+            yield item
+
+def countsFormat(path, fmt=None):
+    """
+    Format of the counts file `path`: `fmt` or its extension.
+    """
+    if fmt is None:
+        fmt = os.path.splitext(path)[1][1:]
+    if fmt not in ('csv', 'parquet', 'npy'):
+        raise ValueError("Unknown format for the counts: {0}".format(fmt))
+    return fmt
+
+class CountsWriter:
+    """
+    Incremental writer of rows of counts (a row per window, a column per
+    zone) in csv, parquet or npy format. Rows are buffered by `buffer_rows`.
+    With `resume` = (rows, bytes), a csv or npy file written before is cut to
+    its first `rows` rows (`bytes` bytes) and the new rows are appended.
+    """
+    def __init__(self, path, zones, fmt=None, begin_value=0, time_laps=600, buffer_rows=1024, resume=None):
+        fmt = countsFormat(path, fmt)
+        if resume is not None and fmt == 'parquet':
+            raise ValueError("A parquet file can not be resumed")
+        self.path = path
+        self.zones = zones
+        self.fmt = fmt
+        self.buffer_rows = buffer_rows
+        self.times = []
+        self.buffer = []
+        self.rows = 0 if resume is None else resume[0]
+        if fmt == 'csv':
+            if resume is None:
+                self.fout = open(path, 'w')
+                self.fout.write("," + ",".join(str(z) for z in zones) + "\n")
+            else:
+                os.truncate(path, resume[1])
+                self.fout = open(path, 'a')
+        elif fmt == 'parquet':
+            self.fout = None # Created with the schema of the first block
+        else:
+            self.fout = NpyWriter(path, (len(zones),), np.int64, None if resume is None else resume[0])
+            with open(path + ".json", 'w') as fmeta:
+                json.dump({'zones': [int(z) for z in zones], 'begin_value': begin_value,
+                           'time_laps': time_laps}, fmeta)
+
+    def write(self, time, counts):
+        self.times.append(time)
+        self.buffer.append(np.asarray(counts, dtype=np.int64))
+        self.rows += 1
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        block = np.array(self.buffer)
+        if self.fmt == 'csv':
+            self.fout.write("".join("{0},{1}\n".format(time, ",".join(map(str, row)))
+                                    for time, row in zip(self.times, block.tolist())))
+        elif self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.table([pa.array(self.times, type=pa.int64())] + [pa.array(block[:, i]) for i in range(block.shape[1])],
+                             names=['time'] + [str(z) for z in self.zones])
+            if self.fout is None:
+                self.fout = pq.ParquetWriter(self.path, table.schema)
+            self.fout.write_table(table)
+        else:
+            self.fout.write(block)
+        self.times, self.buffer = [], []
+
+    def sync(self):
+        """
+        Flush the rows to the disk.
+        """
+        self.flush()
+        if self.fmt == 'csv':
+            self.fout.flush()
+            os.fsync(self.fout.fileno())
+        elif self.fmt == 'npy':
+            self.fout.flush()
+            os.fsync(self.fout.fout.fileno())
+
+    def size(self):
+        """
+        Bytes written in the file, after a flush.
+        """
+        if self.fmt == 'csv':
+            return self.fout.tell()
+        if self.fmt == 'npy':
+            return self.fout.fout.tell()
+        return None
+
+    def close(self):
+        self.flush()
+        if self.fout is not None:
+            self.fout.close()
+
+class RangeReader:
+    """
+    File-like object with the bytes [`start`, `end`) of an fcd file,
+    surrounded by a root element so it can be parsed alone.
+    """
+    def __init__(self, path, start, end):
+        self.fin = open(path, 'rb')
+        self.fin.seek(start)
+        self.left = end - start
+        self.pending = b"<fcd-export>"
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = 1 << 20
+        out = self.pending[:size]
+        self.pending = self.pending[size:]
+        if len(out) < size and self.left > 0:
+            block = self.fin.read(min(size - len(out), self.left))
+            self.left -= len(block)
+            if len(block) == 0:
+                self.left = 0
+            out += block
+        if len(out) < size and self.left == 0 and not self.closed:
+            self.closed = True
+            self.pending = b"</fcd-export>"
+            out += self.read(size - len(out))
+        return out
+
+    def close(self):
+        self.fin.close()
+
+def find_tag(fin, position, tag=b"<timestep", block=1 << 20):
+    """
+    Position of the first `tag` in the file `fin` after `position`, or the
+    size of the file.
+    """
+    fin.seek(position)
+    while True:
+        data = fin.read(block)
+        if len(data) == 0:
+            return fin.tell()
+        found = data.find(tag)
+        if found >= 0:
+            return position + found
+        # Overlap the blocks in case the tag is cut
+        position += max(len(data) - len(tag), 1)
+        fin.seek(position)
+
+def timestep_ranges(path, n_parts, start=0):
+    """
+    Split the fcd file in `path`, from the byte `start`, in `n_parts` byte
+    ranges of similar size that begin in a <timestep and contain only whole
+    timesteps.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fin:
+        cuts = [find_tag(fin, start)]
+        for k in range(1, n_parts):
+            cuts.append(max(find_tag(fin, start + k * (size - start) // n_parts), cuts[-1]))
+        end = find_tag(fin, cuts[-1], b"</fcd-export")
+    cuts.append(max(end, cuts[-1]))
+    return [(a, b) for a, b in zip(cuts[:-1], cuts[1:]) if b > a]
+
+def main():
+    parser = argparse.ArgumentParser(description="Traffic counts per zone from the FCD output of SUMO")
+    parser.add_argument("--zones", default=zones_path, help="path to the geojson with the zones")
+    parser.add_argument("--fcd", default=fcd_path, help="path to the fcd file, or to its columnar store (fcdStore.py)")
+    parser.add_argument("--zones-req", default=",".join(str(z) for z in req_polys),
+                        help="list, separated by commas, of the zones to be considered")
+    parser.add_argument("--offset", default="{0},{1}".format(*offset),
+                        help="offset of the network, two floats separated by a comma (use --offset=x,y)")
+    parser.add_argument("--interv", type=int, default=interv, help="seconds between samples")
+    parser.add_argument("--time-laps", type=int, default=time_laps, help="size of the windows in seconds")
+    parser.add_argument("--begin", type=int, default=begin_value, help="time of the first row")
+    parser.add_argument("--label-start", action='store_true',
+                        help="discard the counts before the first window and label the rows by the start of their window")
+    parser.add_argument("--output", default=dataframe_path, help="output file (.csv, .parquet or .npy)")
+    parser.add_argument("--format", default=None, choices=['csv', 'parquet', 'npy'],
+                        help="format of the output, by default from its extension")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes")
+    parser.add_argument("--checkpoint-mb", type=float, default=64,
+                        help="save a checkpoint every this many MB of the fcd file (0 to disable)")
+    parser.add_argument("--resume", action='store_true', help="continue from the last checkpoint of --output")
+    parser.add_argument("--zone-grid", default=None, help="zone raster grid (.npy), built if it does not exist")
+    parser.add_argument("--grid-resolution", type=float, default=50.0, help="size of the cells of the zone grid")
+    parser.add_argument("--zone-cache", default=ZONE_CACHE_DIR, help="directory of the binary cache of the zones")
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.report, args.profile, script="fcd2counts", args=vars(args))
+
+    with span("loadZones"):
+        counter = FcdCounter(args.zones, [int(z) for z in args.zones_req.split(',')],
+                             tuple(float(o) for o in args.offset.split(',')),
+                             args.interv, args.time_laps, args.begin,
+                             args.zone_grid, args.grid_resolution, args.workers, args.zone_cache,
+                             args.label_start)
+    print("Number of zones: "+str(counter.n_polys))
 
-npM = np.array(M, dtype=int) # Convert to a numpy array
-df = pd.DataFrame(data=npM, index=indexes,    # 1st column as index
-             columns=list(polys.index)) # first row as the zones
+    checkpoint_bytes = int(args.checkpoint_mb * 1024**2) if args.checkpoint_mb > 0 else None
+    with span("countVehicles"):
+        rows = counter.write(args.fcd, args.output, args.format, checkpoint_bytes=checkpoint_bytes,
+                             resume=args.resume)
+        if not isStore(args.fcd):
+            count("bytes", os.path.getsize(args.fcd))
+    print("Data saved in {0} ({1} rows)".format(args.output, rows))
+    instrument.finish()
 
-df.to_csv(dataframe_path, sep=",")
-print("Data saved in {0}".format(dataframe_path))
+if __name__ == '__main__':
+    main()
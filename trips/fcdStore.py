@@ -0,0 +1,212 @@
+import numpy as np
+import os
+import json
+import gzip
+import argparse
+from lxml import etree
+from npyWriter import NpyWriter
+
+"""
+Columnar store of a SUMO FCD output, to parse the XML only once. The store
+is a directory with memory-mappable .npy arrays:
+    - times.npy: time of every timestep (float64).
+    - offsets.npy: the records of the timestep i are [offsets[i], offsets[i+1]).
+    - vehicle.npy: code of the vehicle of every record (int32), the index in
+      vehicles.json.
+    - x.npy, y.npy: position of every record (float64, SUMO coordinates).
+    - speed.npy: speed of every record (float32).
+and meta.json with the file converted and the number of timesteps and records.
+
+python3 fcdStore.py sumo/fcd.txt[.gz] sumo/fcdStore
+"""
+
+META_FILE = "meta.json"
+
+def openFcd(path):
+    """
+    Open the fcd file in `path`, compressed with gzip if it ends in .gz.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def convertFcd(fcd_path, store_path, block_records=1000000, verbose=1):
+    """
+    Stream the fcd file `fcd_path` (xml, or xml.gz) into a columnar store in
+    the directory `store_path`, writing the arrays by blocks of about
+    `block_records` records.
+    Outputs:
+        - Dictionary with the metadata of the store.
+    """
+    os.makedirs(store_path, exist_ok=True)
+    column = lambda name, dtype: NpyWriter(os.path.join(store_path, name + ".npy"), (), dtype)
+    writers = {'times': column('times', np.float64), 'offsets': column('offsets', np.int64),
+               'vehicle': column('vehicle', np.int32), 'x': column('x', np.float64),
+               'y': column('y', np.float64), 'speed': column('speed', np.float32)}
+    codes = {} # vehicle id -> code
+    block = {name: [] for name in writers}
+    n_records = 0
+    n_buffered = 0
+    writers['offsets'].write(np.zeros(1, dtype=np.int64))
+
+    def flush():
+        for name, values in block.items():
+            if len(values) > 0:
+                writers[name].write(np.concatenate(values) if name not in ('times', 'offsets') else values)
+                block[name] = []
+
+    with openFcd(fcd_path) as fin:
+        for event, elem in etree.iterparse(fin, tag='timestep'):
+            ids = elem.xpath('*/@id')
+            block['times'].append(float(elem.attrib['time']))
+            block['vehicle'].append(np.array([codes.setdefault(v, len(codes)) for v in ids], dtype=np.int32))
+            block['x'].append(np.array(elem.xpath('*/@x'), dtype=np.float64))
+            block['y'].append(np.array(elem.xpath('*/@y'), dtype=np.float64))
+            block['speed'].append(np.array(elem.xpath('*/@speed'), dtype=np.float32))
+            n_records += len(ids)
+            n_buffered += len(ids)
+            block['offsets'].append(n_records)
+            # It's safe to call clear() here because no descendants will be accessed
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+            if n_buffered >= block_records:
+                flush()
+                n_buffered = 0
+                if verbose > 0:
+                    print("{0} records converted".format(n_records))
+    flush()
+    for writer in writers.values():
+        writer.close()
+
+    with open(os.path.join(store_path, "vehicles.json"), 'w') as fout:
+        json.dump(sorted(codes, key=codes.get), fout)
+    meta = {'source': os.path.abspath(fcd_path), 'source_size': os.path.getsize(fcd_path),
+            'timesteps': writers['times'].rows, 'records': n_records, 'vehicles': len(codes)}
+    tmp_path = os.path.join(store_path, META_FILE + ".tmp")
+    with open(tmp_path, 'w') as fout:
+        json.dump(meta, fout, indent=1)
+    os.replace(tmp_path, os.path.join(store_path, META_FILE))
+    if verbose > 0:
+        print("FCD store saved in {0}: {1}".format(store_path, meta))
+    return meta
+
+def isStore(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+class FcdStore:
+    """
+    Arrays of a store written by convertFcd, mapped in memory.
+    """
+    def __init__(self, store_path):
+        self.path = store_path
+        self.meta = json.load(open(os.path.join(store_path, META_FILE)))
+        load = lambda name: np.load(os.path.join(store_path, name + ".npy"), mmap_mode='r')
+        self.times = load('times')
+        self.offsets = load('offsets')
+        self.vehicle = load('vehicle')
+        self.x = load('x')
+        self.y = load('y')
+        self.speed = load('speed')
+        self.n_timesteps = len(self.times)
+
+    def vehicles(self):
+        """
+        Ids of the vehicles, indexed by their code.
+        """
+        return json.load(open(os.path.join(self.path, "vehicles.json")))
+
+    def iterTimesteps(self, interv=1):
+        """
+        Generator with a tuple (time, vehicle codes, x, y) per timestep, with
+        None instead of the arrays in the timesteps not multiple of `interv`.
+        """
+        seconds = self.times[:].astype(np.int64)
+        offsets = self.offsets[:]
+        for i in range(self.n_timesteps):
+            if seconds[i] % interv != 0:
+                yield self.times[i], None, None, None
+                continue
+            a, b = offsets[i], offsets[i+1]
+            yield self.times[i], self.vehicle[a:b], self.x[a:b], self.y[a:b]
+
+    def windowCounts(self, point_zones, n_zones, interv=15, time_laps=600, block_records=4000000,
+                     label_start=False):
+        """
+        Max number of vehicles per zone (sampled every `interv` seconds) in
+        every window of `time_laps` seconds, like fcd2counts.py does while
+        parsing: a window begins at every timestep multiple of `time_laps`,
+        the first row has the counts before the first of them (not counted
+        with `label_start`), and the last window, that is not closed, is not
+        returned.
+        Inputs:
+            - point_zones: function that, given arrays of x and y, returns
+              the pairs (point index, zone index) of the points in the zones.
+            - n_zones: number of zones.
+        Outputs:
+            - Array (windows, n_zones).
+        """
+        seconds = self.times[:].astype(np.int64) # as int(float(time))
+        boundary = seconds % time_laps == 0
+        window = np.cumsum(boundary) # timesteps before the first boundary are in the window 0
+        n_windows = int(boundary.sum())
+        if label_start:
+            window -= 1 # -1 before the first boundary
+            n_windows = max(n_windows - 1, 0)
+        counts = np.zeros((n_windows + 1, n_zones), dtype=np.int64)
+
+        sampled = np.flatnonzero((seconds % interv == 0) & (window >= 0))
+        if len(sampled) == 0:
+            return counts[:n_windows]
+        sizes = self.offsets[sampled + 1] - self.offsets[sampled]
+        # Blocks of timesteps with about `block_records` records
+        cuts = np.searchsorted(np.cumsum(sizes), np.arange(block_records, sizes.sum(), block_records))
+        for steps in np.split(np.arange(len(sampled)), np.unique(cuts + 1)):
+            if len(steps) == 0:
+                continue
+            timesteps = sampled[steps]
+            step_sizes = sizes[steps]
+            # Records of the timesteps of the block, and the timestep of every record
+            step_of_record = np.repeat(np.arange(len(steps)), step_sizes)
+            first = np.cumsum(step_sizes) - step_sizes # position of the first record of every timestep
+            records = self.offsets[timesteps][step_of_record] + np.arange(len(step_of_record)) - first[step_of_record]
+            points_idx, zones_idx = point_zones(self.x[records], self.y[records])
+            per_step = np.bincount(step_of_record[points_idx] * n_zones + zones_idx,
+                                   minlength=len(steps) * n_zones).reshape(len(steps), n_zones)
+            np.maximum.at(counts, window[timesteps], per_step)
+        return counts[:n_windows]
+
+def iterTimesteps(fcd_path, interv=1, codes=None):
+    """
+    Generator with a tuple (time, vehicle codes, x, y) per timestep of
+    `fcd_path`, a store or an fcd file (xml or xml.gz), with None instead of
+    the arrays in the timesteps not multiple of `interv`. The vehicles of an
+    fcd file are coded in the order they appear, in the dictionary `codes`
+    (id -> code) if given.
+    """
+    if isStore(fcd_path):
+        yield from FcdStore(fcd_path).iterTimesteps(interv)
+        return
+    codes = {} if codes is None else codes
+    with openFcd(fcd_path) as fin:
+        for event, elem in etree.iterparse(fin, tag='timestep'):
+            time = float(elem.attrib['time'])
+            if int(time) % interv != 0:
+                yield time, None, None, None
+            else:
+                vehicle = np.array([codes.setdefault(v, len(codes)) for v in elem.xpath('*/@id')], dtype=np.int32)
+                yield time, vehicle, np.array(elem.xpath('*/@x'), dtype=np.float64), \
+                      np.array(elem.xpath('*/@y'), dtype=np.float64)
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a SUMO FCD output in a columnar store")
+    parser.add_argument("fcd", help="fcd file (xml, or xml.gz)")
+    parser.add_argument("store", help="directory of the store")
+    args = parser.parse_args()
+    convertFcd(args.fcd, args.store)
+
+if __name__ == '__main__':
+    main()
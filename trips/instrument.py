@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import resource
+
+"""
+Lightweight instrumentation of the scripts: timed spans per stage, counters
+of the rows, edges, vehicles or trips processed, RSS memory at the end of
+every span, progress lines with throughput and ETA, an optional cProfile and
+a JSON report of the run.
+
+All of it is disabled by default, and then `span` returns a shared context
+manager that does nothing and `count` and `progress` return at once, so it
+can stay in the code. Scripts enable it with `configure` (usually from --report/--profile)
+and call `finish` at the end:
+
+    from instrument import span, count, progress, configure, finish
+    configure(report_path="run.json")
+    with span("classify"):
+        ...
+        count("lanes", n)
+    finish()
+"""
+
+class NullSpan:
+    """
+    Span of the disabled instrumentation.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def currentRss():
+    """
+    Resident memory of the process in MB (0 if /proc is not available).
+    """
+    try:
+        with open("/proc/self/statm") as fin:
+            return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.0**2
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+def peakRss():
+    """
+    Peak resident memory of the process in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0**2 if sys.platform == 'darwin' else peak / 1024.0 # bytes in macOS, kB in Linux
+
+class Span:
+    """
+    Timed stage. The counters added while it is the innermost span open are
+    saved with it.
+    """
+    def __init__(self, instrument, name):
+        self.instrument = instrument
+        self.name = name
+        self.counters = {}
+
+    def __enter__(self):
+        stack = self.instrument.stack
+        self.path = "/".join([s.name for s in stack] + [self.name])
+        stack.append(self)
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.begin
+        self.instrument.stack.pop()
+        record = {'span': self.path, 'start_s': self.begin - self.instrument.begin, 'seconds': seconds,
+                  'rss_mb': currentRss(), 'peak_rss_mb': peakRss()}
+        if len(self.counters) > 0:
+            record['counters'] = self.counters
+            record['per_second'] = {k: v / seconds for k, v in self.counters.items()} if seconds > 0 else {}
+        if exc[0] is not None:
+            record['error'] = repr(exc[1])
+        self.instrument.spans.append(record)
+        return False
+
+class Instrument:
+    def __init__(self):
+        self.enabled = False
+        self.report_path = None
+        self.profile_path = None
+        self.profiler = None
+        self.begin = time.perf_counter()
+        self.stack = []
+        self.spans = []
+        self.counters = {}
+        self.progress_last = {}
+        self.progress_interval = 5.0
+        self.info = {}
+
+    def configure(self, report_path=None, profile_path=None, progress_interval=5.0, **info):
+        """
+        Enable the instrumentation if `report_path` or `profile_path` are
+        given. `info` is saved in the report (script, arguments...).
+        """
+        self.enabled = report_path is not None or profile_path is not None
+        self.report_path = report_path
+        self.profile_path = profile_path
+        self.progress_interval = progress_interval
+        self.info = info
+        self.begin = time.perf_counter()
+        if profile_path is not None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        if len(self.stack) > 0:
+            counters = self.stack[-1].counters
+            counters[name] = counters.get(name, 0) + n
+
+    def progress(self, name, done, total=None, unit="rows"):
+        """
+        Print the progress of `name` (`done` of `total` `unit`), with its
+        throughput and ETA, at most once every `progress_interval` seconds.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        first, last = self.progress_last.get(name, (now, None))
+        if last is not None and now - last < self.progress_interval:
+            return
+        self.progress_last[name] = (first, now)
+        rate = done / (now - first) if now > first else 0.0
+        line = "{0}: {1} {2}".format(name, done, unit) if total is None else \
+               "{0}: {1}/{2} {3} ({4:.1f}%)".format(name, done, total, unit, 100.0 * done / max(total, 1))
+        if rate > 0:
+            line += ", {0:.0f} {1}/s".format(rate, unit)
+            if total is not None:
+                line += ", ETA {0:.0f} s".format((total - done) / rate)
+        print(line + ", RSS {0:.0f} MB".format(currentRss()))
+
+    def report(self):
+        """
+        Dictionary with all the measures of the run.
+        """
+        seconds = time.perf_counter() - self.begin
+        return {'info': self.info, 'seconds': seconds, 'peak_rss_mb': peakRss(),
+                'counters': self.counters,
+                'per_second': {k: v / seconds for k, v in self.counters.items()} if seconds > 0 else {},
+                'spans': self.spans}
+
+    def finish(self):
+        """
+        Stop the profiler and save the report and the profile.
+        """
+        if not self.enabled:
+            return None
+        report = self.report()
+        if self.profiler is not None:
+            import pstats
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+            stats = pstats.Stats(self.profiler)
+            top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:20]
+            report['profile'] = {'path': self.profile_path,
+                                 'top_cumulative': [{'function': "{0}:{1}({2})".format(*f), 'calls': s[1],
+                                                     'cumulative_s': s[3]} for f, s in top]}
+        if self.report_path is not None:
+            with open(self.report_path, 'w') as fout:
+                json.dump(report, fout, indent=1)
+            print("Run report saved in {0}".format(self.report_path))
+        return report
+
+# Instrumentation of the process
+INSTRUMENT = Instrument()
+
+def configure(report_path=None, profile_path=None, progress_interval=5.0, **info):
+    INSTRUMENT.configure(report_path, profile_path, progress_interval, **info)
+
+def span(name):
+    return INSTRUMENT.span(name)
+
+def count(name, n=1):
+    INSTRUMENT.count(name, n)
+
+def progress(name, done, total=None, unit="rows"):
+    INSTRUMENT.progress(name, done, total, unit)
+
+def finish():
+    return INSTRUMENT.finish()
+
+def addArguments(parser):
+    """
+    Add the options --report and --profile to an argparse parser.
+    """
+    parser.add_argument("--report", default=None, help="save a JSON report of the run (times, counters, memory)")
+    parser.add_argument("--profile", default=None, help="profile the run with cProfile and save the stats here")
@@ -0,0 +1,80 @@
+import numpy as np
+import xml.etree.ElementTree as ET
+
+"""
+Single pass reader of networks in net.xml (SUMO format), that keeps in
+memory only the allowed edges instead of the whole xml tree.
+"""
+
+def typeAllowed(attrib, carType):
+    """
+    Check if the car type `carType` can use the edge type with attributes `attrib`,
+    with the allow/disallow specification of SUMO.
+    """
+    if 'allow' in attrib: # Allow specification
+        return carType in attrib['allow'].split(" ")
+    if 'disallow' in attrib: # Disallow specification
+        return carType not in attrib['disallow'].split(" ")
+    return True # Without restrictions every vehicle class is allowed
+
+def laneCoords(shape, offset=np.zeros(2)):
+    """
+    Convert the attribute `shape` of a lane to an array of shape (n_points, 2),
+    subtracting `offset`.
+    """
+    return np.array(shape.replace(',', ' ').split(), dtype=float).reshape(-1, 2) - offset
+
+def iterEdges(map_path, carType='private', allowedTypes=None, offset=(0,0), verbose=1):
+    """
+    Read the network in `map_path` with iterparse, clearing every element
+    once it is processed, and yield the edges allowed for `carType`.
+    The <type> elements are placed before the edges in net.xml files, so the
+    allowed types are known when the first edge arrives.
+    Inputs:
+        - map_path: path to the net.xml file.
+        - carType: string with the type of car.
+        - allowedTypes: the edge types to be selected. If None, the ones allowed for `carType`.
+        - offset: a pair subtracted to the coordinates of the lanes.
+        - verbose: if >0, reports the types of edges allowed.
+    Outputs:
+        - Pairs (edge id, list with an array of coordinates per lane).
+    """
+    offset = np.array(offset, dtype=float)
+    types = set({})
+    if allowedTypes is not None:
+        allowedTypes = set(allowedTypes)
+
+    depth = 0
+    context = ET.iterparse(map_path, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth > 0: # Lanes and other children are read with their parent
+            continue
+
+        if elem.tag == "type":
+            if typeAllowed(elem.attrib, carType):
+                types.add(elem.attrib['id'])
+        elif elem.tag == "edge":
+            if allowedTypes is None:
+                allowedTypes = types
+                if verbose > 0:
+                    print("Allowed:")
+                    print(allowedTypes)
+            if elem.attrib.get('type') in allowedTypes:
+                lanes = [laneCoords(lane.attrib['shape'], offset) for lane in elem if lane.tag == "lane"]
+                yield elem.attrib['id'], lanes
+        # Drop the processed elements from the tree
+        root.clear()
+
+def iterLanes(edges):
+    """
+    Flatten the output of iterEdges to pairs (edge id, coordinates of a lane),
+    as used by tripsGenerator.classifyLanes.
+    """
+    for edge_id, lanes in edges:
+        for lane in lanes:
+            yield edge_id, lane
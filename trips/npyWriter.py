@@ -0,0 +1,73 @@
+import numpy as np
+import struct
+import os
+
+"""
+Write .npy files row by row, without knowing the number of rows in advance.
+"""
+
+# Size reserved for the header, enough for any 2-D or 1-D shape
+HEADER_SIZE = 128
+
+def npyHeader(shape, dtype):
+    """
+    Header of a .npy file (format 1.0) of exactly HEADER_SIZE bytes.
+    """
+    header = "{{'descr': {0!r}, 'fortran_order': False, 'shape': {1!r}, }}".format(
+        np.dtype(dtype).str, tuple(shape))
+    header = header.ljust(HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode('latin1')
+
+class NpyWriter:
+    """
+    Append rows of `row_shape` to the .npy file `path`. The header is written
+    again with the final number of rows at `close`, so the file can be read
+    with np.load (also with mmap_mode) as an array of shape (rows,) + row_shape.
+    With `rows`, the file is not created again: it is cut to its first `rows`
+    rows and the new ones are appended (to resume an interrupted write).
+    """
+    def __init__(self, path, row_shape, dtype, rows=None):
+        self.path = path
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = int(np.prod(self.row_shape, dtype=np.int64)) * self.dtype.itemsize
+        if rows is None:
+            self.fout = open(path, 'wb')
+            self.fout.write(npyHeader((0,) + self.row_shape, self.dtype))
+            self.rows = 0
+        else:
+            size = HEADER_SIZE + rows * self.row_bytes
+            if os.path.getsize(path) < size:
+                raise ValueError("{0} has less than {1} rows".format(path, rows))
+            self.fout = open(path, 'r+b')
+            np.lib.format.read_magic(self.fout)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(self.fout)
+            if self.fout.tell() != HEADER_SIZE or tuple(shape[1:]) != self.row_shape or dtype != self.dtype:
+                self.fout.close()
+                raise ValueError("{0} was not written with rows of {1} {2}".format(path, self.row_shape, self.dtype))
+            self.fout.truncate(size)
+            self.fout.seek(size)
+            self.rows = rows
+
+    def write(self, rows):
+        """
+        Append a row, or several rows stacked in the first axis.
+        """
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        n = rows.size * self.dtype.itemsize // self.row_bytes if self.row_bytes > 0 else 0
+        self.fout.write(rows.tobytes())
+        self.rows += n
+
+    def flush(self):
+        """
+        Update the header and flush, so the file is valid up to here.
+        """
+        position = self.fout.tell()
+        self.fout.seek(0)
+        self.fout.write(npyHeader((self.rows,) + self.row_shape, self.dtype))
+        self.fout.seek(position)
+        self.fout.flush()
+
+    def close(self):
+        self.flush()
+        self.fout.close()
@@ -0,0 +1,135 @@
+import numpy as np
+import os
+import json
+import heapq
+import shutil
+import tempfile
+
+"""
+Write trips sorted by depart time, with an external merge sort when they do
+not fit in memory, and optionally split in files by time windows (shards).
+"""
+
+# Width of the depart prefix of the lines in the sorted runs
+DEPART_WIDTH = 12
+
+class SortedTripsWriter:
+    """
+    Collect trip lines with their depart times and write them sorted.
+    Blocks are kept in memory until `run_size` trips, then sorted and saved
+    in a temporary run file. At `close`, the runs are merged.
+    Trips with the same depart keep the order in which they were added.
+    """
+    def __init__(self, tripsFile_path, header, footer, run_size=1000000, shard_seconds=None):
+        self.tripsFile_path = tripsFile_path
+        self.header = header
+        self.footer = footer
+        self.run_size = run_size
+        self.shard_seconds = shard_seconds
+        self.departs = []
+        self.lines = []
+        self.n_buffered = 0
+        self.runs = []
+        self.tmp_dir = None
+
+    def add(self, departs, lines):
+        self.departs.append(np.asarray(departs, dtype=np.int64))
+        self.lines.extend(lines)
+        self.n_buffered += len(lines)
+        if self.n_buffered >= self.run_size:
+            self._spill()
+
+    def _sortedBuffer(self):
+        departs = np.concatenate(self.departs) if len(self.departs) > 0 else np.zeros(0, dtype=np.int64)
+        order = np.argsort(departs, kind='stable')
+        lines = self.lines
+        return [(int(departs[i]), lines[i]) for i in order]
+
+    def _spill(self):
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.mkdtemp(prefix="trips_runs_",
+                                            dir=os.path.dirname(os.path.abspath(self.tripsFile_path)))
+        path = os.path.join(self.tmp_dir, "run{0:05d}.txt".format(len(self.runs)))
+        with open(path, 'w') as fout:
+            fout.write("".join("{0:0{1}d}{2}".format(depart, DEPART_WIDTH, line)
+                               for depart, line in self._sortedBuffer()))
+        self.runs.append(path)
+        self.departs, self.lines, self.n_buffered = [], [], 0
+
+    def _merged(self):
+        """
+        Generator with the pairs (depart, line) of all the trips, sorted.
+        """
+        if len(self.runs) == 0: # Everything fits in memory
+            for item in self._sortedBuffer():
+                yield item
+            return
+        if self.n_buffered > 0:
+            self._spill()
+        files = [open(path) for path in self.runs]
+        try:
+            for line in heapq.merge(*files, key=lambda l: l[:DEPART_WIDTH]):
+                yield int(line[:DEPART_WIDTH]), line[DEPART_WIDTH:]
+        finally:
+            for fin in files:
+                fin.close()
+
+    def shardPath(self, shard):
+        root, ext = os.path.splitext(self.tripsFile_path)
+        return "{0}_{1:04d}{2}".format(root, shard, ext)
+
+    def close(self, block_size=100000):
+        """
+        Write the sorted trips. Without shards, all of them go to
+        `tripsFile_path`. With shards, the trips departing in
+        [k*shard_seconds, (k+1)*shard_seconds) go to the file shardPath(k), and
+        a manifest `<tripsFile_path without extension>.manifest.json` lists the
+        files with their time range and number of trips.
+        Outputs:
+            - The list of shards (dictionaries), or None without shards.
+        """
+        shards = []
+        fout = None
+        current = None
+        block = []
+        for depart, line in self._merged():
+            shard = 0 if self.shard_seconds is None else depart // self.shard_seconds
+            if shard != current:
+                if fout is not None:
+                    fout.write("".join(block))
+                    block = []
+                    fout.write(self.footer)
+                    fout.close()
+                current = shard
+                path = self.tripsFile_path if self.shard_seconds is None else self.shardPath(shard)
+                fout = open(path, 'w')
+                fout.write(self.header)
+                shards.append({'file': os.path.basename(path),
+                               'begin': None if self.shard_seconds is None else int(shard * self.shard_seconds),
+                               'end': None if self.shard_seconds is None else int((shard+1) * self.shard_seconds),
+                               'first_depart': depart, 'last_depart': depart, 'trips': 0})
+            block.append(line)
+            shards[-1]['last_depart'] = depart
+            shards[-1]['trips'] += 1
+            if len(block) >= block_size:
+                fout.write("".join(block))
+                block = []
+
+        if fout is None: # No trips at all
+            fout = open(self.tripsFile_path if self.shard_seconds is None else self.shardPath(0), 'w')
+            fout.write(self.header)
+        fout.write("".join(block))
+        fout.write(self.footer)
+        fout.close()
+
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir)
+            self.tmp_dir = None
+        self.runs = []
+
+        if self.shard_seconds is None:
+            return None
+        root, _ = os.path.splitext(self.tripsFile_path)
+        with open(root + ".manifest.json", 'w') as fout:
+            json.dump({'shard_seconds': self.shard_seconds, 'shards': shards}, fout, indent=1)
+        return shards
@@ -0,0 +1,104 @@
+import numpy as np
+import os
+import json
+import hashlib
+import tempfile
+
+"""
+Persistent cache of the classification of the edges in zones (TAZ), keyed by
+the hashes of everything it depends on: the geojson, the net.xml, the zones
+required, the types of edges allowed and the offset.
+"""
+
+TAZ_CACHE_DIR = "tazCache"
+
+# Hits and misses of this process
+CACHE_STATS = {'hits': 0, 'misses': 0}
+
+def fileHash(path):
+    """
+    sha256 of the content of the file in `path`.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        while True:
+            block = fin.read(1 << 20)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+def tazCacheKey(zones_path, map_path, zones_req, allowedTypes, carType, offset):
+    """
+    Key of a classification. If `allowedTypes` is None, they come from the
+    net.xml and `carType`.
+    """
+    inputs = {
+        'zones': fileHash(zones_path),
+        'map': fileHash(map_path),
+        'zones_req': 'all' if zones_req is None else sorted(int(z) for z in zones_req),
+        'types': carType if allowedTypes is None else sorted(allowedTypes),
+        'offset': [float(offset[0]), float(offset[1])],
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def saveNpz(path, overwrite=True, **arrays):
+    """
+    Save `arrays` in the npz file `path` through a temporary file with a
+    unique name in the same directory, renamed at the end, so processes
+    that save the same file at the same time do not clash. Without
+    `overwrite`, an existing `path` (saved by another process) is kept.
+    """
+    if not overwrite and os.path.exists(path):
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".npz")
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            np.savez(fout, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def saveTazs(path, tazs, overwrite=True):
+    """
+    Save the dictionary `tazs` (zone -> set of edges) in a npz file, with the
+    edge names stored once and the zones as ranges of indexes (CSR).
+    """
+    zones = list(tazs.keys())
+    edges = sorted(set().union(*tazs.values())) if len(tazs) > 0 else []
+    position = {e: i for i, e in enumerate(edges)}
+    members = [sorted(position[e] for e in tazs[z]) for z in zones]
+    ptr = np.zeros(len(zones)+1, dtype=np.int64)
+    ptr[1:] = np.cumsum([len(m) for m in members])
+    indices = np.array([i for m in members for i in m], dtype=np.int32)
+    saveNpz(path, overwrite, zones=np.array(zones, dtype=np.int64), edges=np.array(edges, dtype=str),
+            ptr=ptr, indices=indices)
+
+def loadTazs(path):
+    """
+    Read a classification saved with saveTazs.
+    """
+    data = np.load(path)
+    zones, edges, ptr, indices = data['zones'], data['edges'], data['ptr'], data['indices']
+    return {int(z): set(edges[indices[ptr[i]:ptr[i+1]]].tolist()) for i, z in enumerate(zones)}
+
+def cachedTazs(key, build, cache_dir=TAZ_CACHE_DIR, rebuild=False):
+    """
+    Return the classification with key `key` from the cache, or compute it with
+    `build()` and save it if it is not there (or if `rebuild` is True).
+    """
+    path = os.path.join(cache_dir, key + ".npz")
+    if not rebuild and os.path.exists(path):
+        CACHE_STATS['hits'] += 1
+        print("TAZ cache hit: {0}".format(path))
+        return loadTazs(path)
+
+    CACHE_STATS['misses'] += 1
+    print("TAZ cache miss: {0}".format(key))
+    tazs = build()
+    os.makedirs(cache_dir, exist_ok=True)
+    # Another process may have saved it meanwhile; it is the same classification
+    saveTazs(path, tazs, overwrite=rebuild)
+    return tazs
@@ -0,0 +1,318 @@
+import numpy as np
+import pandas as pd
+import datetime
+import os
+import json
+import shutil
+import hashlib
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Helpers to read the Yellow Taxi trip records of
+https://www1.nyc.gov/site/tlc/about/tlc-trip-record-data.page month by month.
+"""
+
+TRIPS_URL = "https://s3.amazonaws.com/nyc-tlc/trip+data/yellow_tripdata_{0}-{1:02d}.csv"
+
+# Columns needed by the O/D matrices and the trips generator
+TRIP_COLUMNS = ['tpep_pickup_datetime', 'PULocationID', 'DOLocationID']
+TRIP_DTYPES = {'PULocationID': np.int16, 'DOLocationID': np.int16}
+
+# Default directory of the columnar cache, with one parquet file per month
+CACHE_DIR = "taxiCache"
+# Default directory of the downloaded files, saved by content hash
+DOWNLOAD_DIR = "taxiDownloads"
+
+def parseDate(sdate):
+    """
+    Convert a string in format yyyy/mm/dd (%Y/%m/%d) to a datetime object.
+    """
+    return datetime.datetime(int(sdate[0:4]), int(sdate[5:7]), int(sdate[8:]), 0, 0, 0)
+
+def monthRange(start_date, end_date):
+    """
+    List the pairs (year, month) of the monthly files that cover the
+    interval [`start_date`, `end_date`).
+    """
+    last = end_date - datetime.timedelta(seconds=1)
+    months = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (last.year, last.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def isLocalSource(source):
+    """
+    True if `source` is a local directory (a path without url scheme).
+    """
+    return source is not None and "://" not in source
+
+def tripUrl(year, month, source=None):
+    """
+    Location of the file of a month in `source`, that can be a local
+    directory or the base url of a mirror with the TLC file names.
+    By default, the TLC site.
+    """
+    if source is None:
+        return TRIPS_URL.format(year, month)
+    name = os.path.basename(TRIPS_URL).format(year, month)
+    if isLocalSource(source):
+        return os.path.join(source, name)
+    return source.rstrip('/') + '/' + name
+
+def readIndex(index_path):
+    """
+    Index from url to file name of the downloads (empty if there is none).
+    """
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as fin:
+        return json.load(fin)
+
+_index_lock = threading.Lock()
+
+def fetchMonth(year, month, source=None, download_dir=DOWNLOAD_DIR):
+    """
+    Get a local copy of the file of a month. Remote files are saved in
+    `download_dir` with the sha256 of their content as name, and an index
+    from url to hash avoids downloading them twice.
+    Outputs:
+        - The local path of the file.
+    """
+    url = tripUrl(year, month, source)
+    if isLocalSource(source):
+        if not os.path.exists(url):
+            raise FileNotFoundError("The file of {0}-{1:02d} is not in {2}: {3}".format(year, month, source, url))
+        return url
+
+    os.makedirs(download_dir, exist_ok=True)
+    index_path = os.path.join(download_dir, "index.json")
+    with _index_lock:
+        index = readIndex(index_path)
+    if url in index and os.path.exists(os.path.join(download_dir, index[url])):
+        return os.path.join(download_dir, index[url])
+
+    print("Downloading "+url)
+    sha = hashlib.sha256()
+    tmp_path = os.path.join(download_dir, "{0}-{1:02d}.part".format(year, month))
+    with urllib.request.urlopen(url) as fin, open(tmp_path, 'wb') as fout:
+        while True:
+            block = fin.read(1 << 20)
+            if not block:
+                break
+            sha.update(block)
+            fout.write(block)
+    name = sha.hexdigest() + ".csv"
+    path = os.path.join(download_dir, name)
+    if os.path.exists(path): # Same content under another url
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
+    with _index_lock:
+        index = readIndex(index_path)
+        index[url] = name
+        with open(index_path + ".tmp", 'w') as fout:
+            json.dump(index, fout, indent=1)
+        os.replace(index_path + ".tmp", index_path)
+    return path
+
+def fetchMonths(months, func, workers=4):
+    """
+    Apply `func(year, month)` to the `months` in a pool of `workers` threads,
+    so downloads and parsing of different months overlap. At most `workers`
+    months are in process at the same time, to bound the memory used.
+    Outputs:
+        - Generator with the tuples (year, month, result), in the order of `months`.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for year, month in months:
+            if len(pending) == workers:
+                y, m, future = pending.pop(0)
+                yield y, m, future.result()
+            pending.append((year, month, pool.submit(func, year, month)))
+        for y, m, future in pending:
+            yield y, m, future.result()
+
+def readTripChunks(path, chunksize):
+    """
+    Read the trips csv in `path` by pieces of `chunksize` rows, with only the
+    columns in TRIP_COLUMNS and compact types.
+    If the file was written by pandas with its index (like taxiDataFrame.csv),
+    the index is kept, otherwise the rows are numbered from 0.
+    """
+    reader = pd.read_csv(path, chunksize=chunksize, dtype=TRIP_DTYPES,
+                         usecols=lambda c: c in TRIP_COLUMNS or c == 'Unnamed: 0')
+    for chunk in reader:
+        if 'Unnamed: 0' in chunk.columns:
+            chunk = chunk.set_index('Unnamed: 0')
+            chunk.index.name = None
+        chunk['tpep_pickup_datetime'] = pd.to_datetime(chunk['tpep_pickup_datetime'],
+                                                       format='%Y-%m-%d %H:%M:%S')
+        yield chunk
+
+def filterTrips(df, start_date, end_date, zones_req=None):
+    """
+    Keep the trips picked up in [`start_date`, `end_date`) and, if `zones_req`
+    is given, the ones starting and ending in those zones.
+    """
+    mask = (df['tpep_pickup_datetime'] >= start_date) & (df['tpep_pickup_datetime'] < end_date)
+    if zones_req is not None:
+        mask &= df['PULocationID'].isin(zones_req) & df['DOLocationID'].isin(zones_req)
+    return df[mask]
+
+def sourceKey(source=None):
+    """
+    Directory of the months of `source` in the columnar cache: the cache
+    itself for the TLC site and, for other sources, `source_` and the sha1
+    of the absolute path or url, so the months of different sources are
+    never mixed.
+    """
+    if source is None:
+        return ""
+    source = os.path.abspath(source) if isLocalSource(source) else source.rstrip('/')
+    return "source_" + hashlib.sha1(source.encode()).hexdigest()[:16]
+
+def partitionPath(cache_dir, year, month, source=None):
+    return os.path.join(cache_dir, sourceKey(source), str(year), "{0:02d}.parquet".format(month))
+
+def cacheMonth(year, month, cache_dir, chunksize=1000000, source=None,
+               download_dir=DOWNLOAD_DIR):
+    """
+    Save the trips of a month in the columnar cache: a parquet file with the
+    columns in TRIP_COLUMNS already typed, plus `row`, the row of the trip in
+    the monthly file. Nothing is done if the month is already in the cache.
+    The months of every source are kept apart (see sourceKey).
+    Inputs:
+        - year, month: month to save.
+        - cache_dir: directory of the cache.
+        - chunksize: rows read (and written as a row group) at once.
+        - source, download_dir: where to get the month from (see fetchMonth).
+    Outputs:
+        - The path of the parquet file.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    out_path = partitionPath(cache_dir, year, month, source)
+    if os.path.exists(out_path):
+        return out_path
+    path = fetchMonth(year, month, source, download_dir)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    print("Caching "+path)
+
+    # Written aside and renamed at the end, so a broken download never
+    # leaves a partial month in the cache
+    tmp_path = out_path + ".tmp"
+    writer = None
+    for chunk in readTripChunks(path, chunksize):
+        chunk['row'] = chunk.index.values.astype(np.int32)
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(tmp_path, table.schema)
+        writer.write_table(table, row_group_size=chunksize)
+    if writer is None: # A month without trips is cached as an empty table
+        schema = pa.schema([(c, pa.from_numpy_dtype(TRIP_DTYPES.get(c, np.dtype('datetime64[us]'))))
+                            for c in TRIP_COLUMNS] + [('row', pa.int32())])
+        writer = pq.ParquetWriter(tmp_path, schema)
+    writer.close()
+    os.replace(tmp_path, out_path)
+    return out_path
+
+def cacheMonths(start_date, end_date, cache_dir, chunksize=1000000, source=None,
+                download_dir=DOWNLOAD_DIR, workers=4):
+    """
+    Save in the columnar cache the months that cover [`start_date`,
+    `end_date`) and are not there yet, `workers` months at the same time.
+    Outputs:
+        - List with the paths of the parquet files of the months.
+    """
+    prepare = lambda year, month: cacheMonth(year, month, cache_dir, chunksize, source, download_dir)
+    return [path for year, month, path in fetchMonths(monthRange(start_date, end_date), prepare, workers)]
+
+def readCachedMonth(path, start_date, end_date, zones_req=None, chunksize=1000000):
+    """
+    Generator with the trips of a cached month in [`start_date`, `end_date`)
+    and between the zones in `zones_req`. The filters are given to pyarrow,
+    so the row groups out of the interval are not read.
+    Outputs:
+        - Dataframes with the columns in TRIP_COLUMNS, indexed by `row`.
+    """
+    import pyarrow.dataset as ds
+
+    pickup = ds.field('tpep_pickup_datetime')
+    condition = (pickup >= start_date) & (pickup < end_date)
+    if zones_req is not None:
+        zones_req = list(zones_req)
+        condition &= ds.field('PULocationID').isin(zones_req) & ds.field('DOLocationID').isin(zones_req)
+    dataset = ds.dataset(path, format="parquet")
+    for batch in dataset.to_batches(columns=TRIP_COLUMNS + ['row'], filter=condition,
+                                    batch_size=chunksize):
+        chunk = batch.to_pandas()
+        chunk.index = chunk.pop('row').values.astype(np.int64)
+        yield chunk
+
+def monthRows(path):
+    """
+    Number of trips in a cached month.
+    """
+    import pyarrow.parquet as pq
+    return pq.ParquetFile(path).metadata.num_rows
+
+def streamTrips(start_date, end_date, zones_req=None, chunksize=1000000, dataset_path=None,
+                cache_dir=None, source=None, download_dir=DOWNLOAD_DIR, workers=4, keep_from=None):
+    """
+    Generator with the trips in [`start_date`, `end_date`), read by pieces
+    of `chunksize` rows, so only one piece is in memory at a time.
+    Inputs:
+        - start_date, end_date: datetime objects.
+        - zones_req: if given, only the trips between these zones are kept.
+        - chunksize: number of rows read at once.
+        - dataset_path: a csv with the trips. If None, the monthly files are
+          read from internet.
+        - cache_dir: if given (and there is no `dataset_path`), the months are
+          read from this columnar cache, downloading first the missing ones.
+        - source, download_dir: where to get the months from (see fetchMonth).
+        - workers: number of months fetched at the same time.
+        - keep_from: if given, the trips picked up in [`keep_from`,
+          `start_date`) are also kept from the monthly files of the months
+          that begin at `start_date` or later, the ones that a run that ended
+          at `start_date` did not read.
+    Outputs:
+        - Dataframes with the columns in TRIP_COLUMNS. The index is the row of
+          the trip as if all the months were concatenated.
+    """
+    if dataset_path is not None:
+        for chunk in readTripChunks(dataset_path, chunksize):
+            yield filterTrips(chunk, start_date, end_date, zones_req)
+        return
+
+    # The next months are downloaded (and cached) while the current one is read
+    if cache_dir is not None:
+        prepare = lambda year, month: cacheMonth(year, month, cache_dir, chunksize, source, download_dir)
+    else:
+        prepare = lambda year, month: fetchMonth(year, month, source, download_dir)
+
+    row = 0
+    for year, month, path in fetchMonths(monthRange(start_date, end_date), prepare, workers):
+        first = start_date
+        if keep_from is not None and datetime.datetime(year, month, 1) >= start_date:
+            first = min(keep_from, start_date)
+        if cache_dir is not None:
+            for chunk in readCachedMonth(path, first, end_date, zones_req, chunksize):
+                chunk.index = chunk.index + row
+                yield chunk
+            row += monthRows(path)
+            continue
+
+        print("Reading "+path)
+        n = 0
+        for chunk in readTripChunks(path, chunksize):
+            n += len(chunk)
+            chunk.index = chunk.index + row
+            yield filterTrips(chunk, first, end_date, zones_req)
+        row += n
@@ -1,16 +1,25 @@
 import numpy as np
 import geopandas as gpd
 from shapely.geometry import Polygon, mapping, Point, LineString
+from shapely.strtree import STRtree
+import shapely
 import xml.etree.ElementTree as ET
 
 import pandas as pd
 import os
 import collections
 import datetime
-import random
 import sys
+import argparse
 
-from datetime import timedelta, date
+from tlcData import parseDate, streamTrips, cacheMonths, CACHE_DIR, TRIP_COLUMNS
+from netReader import iterEdges, iterLanes, laneCoords
+from sortedTrips import SortedTripsWriter
+from zoneGrid import loadOrBuildGrid
+from tazCache import tazCacheKey, cachedTazs, CACHE_STATS, TAZ_CACHE_DIR
+from zoneModel import ZoneModel, loadZoneModel, ZONE_CACHE_DIR
+import instrument
+from instrument import span, count, progress
 
 def geojson2plygons(zones_path, zones_req=None):
     """
@@ -18,78 +27,63 @@ def geojson2plygons(zones_path, zones_req=None):
     convert it to Polygons
     Inputs:
         - zones_path: string with the path to the geojson files
-        - zones_req: names' list of the zones required
+        - zones_req: OBJECTIDs of the zones required (all if None)
     Output:
-        - Geoseries with the poligons
+        - Geoseries with the poligons, indexed by OBJECTID
     """
-    zones = gpd.read_file(zones_path)
-    if zones_req == None:
-        zones_req = [a for a in range(len(zones))]
-    else:
-        zones_req = [a-1 for a in zones_req]
-    # Save polygons in GeoSeries format
-    polys = gpd.GeoSeries({zones['OBJECTID'][i] : zones.geometry[i] for i in zones_req})
-    return polys
+    return loadZoneModel(zones_path).polygons(zones_req)
 
-def getTypesAllowed(mapRoot, type, verbose = 1):
+def laneShapes(mapRoot, allowedIndexs, offset=(0,0)):
     """
-    Function that extracts from net.xml (SUMO format) the types of edges allowed for car type `type`.
+    Generator with the shape of every lane of the edges in `allowedIndexs`.
     Inputs:
-        - mapRoot: An fcd-export type from xml.etree.ElementTree, that correspond to the root of the net.xml.
-        - type: Atring with the type.
-        - verbose: if >0, reports the types of edges allowed.
+        - mapRoot: An fcd-export type from xml.etree.ElementTree, that correspond to the root of net.xml.
+        - allowedIdexes: indexes in mapRoot where are located the edges.
+        - offset: a pair with a bias for the coordinates, subtracted to the shapes.
     Outputs:
-        - A set with the name of the edges allowed.
+        - Pairs (edge id, array of shape (n_points, 2) with the coordinates of the lane).
     """
-    allowedTypes = set({})
-    # Get types of edges
-    for child in mapRoot: # For every label in file
-        flag = False
-        if child.tag == "type": # if tag is <type>
-            try: # Allow specification
-                allowed = child.attrib['allow'].split(" ")
-                if type in allowed:
-                    flag = True
-            except: # Disallow specification
-                disallowed = child.attrib['disallow'].split(" ")
-                if type not in disallowed:
-                    flag = True
-            if flag: # if 'private' is allowed
-                allowedTypes.add(child.attrib['id'])
-
-    if verbose > 0:
-        print("Allowed:")
-        print(allowedTypes)
-
-    return allowedTypes
+    offset = np.array(offset, dtype=float)
+    for index in allowedIndexs: #for every permitted edge
+        edge_id = mapRoot[index].attrib['id']
+        for lane in mapRoot[index]: #for all the lanes in the edge
+            yield edge_id, laneCoords(lane.attrib['shape'], offset)
 
-def getAllowedEdges(mapRoot, allowedTypes, verbose = 1):
+def classifyLanes(lanes, polys, grid=None):
     """
-    Given a map in net.xml SUMO format, extract the indexes of the allowed edges
-    in the xml file.
+    Intersects the lanes with the Polygon objects in `polys` using a spatial
+    index (STRtree) over the polygons, queried once with all the lanes.
     Inputs:
-        - mapRoot: An fcd-export type from xml.etree.ElementTree, that correspond to the root of net.xml.
-        - allowedTypes: list of strings with the name of the types that you are looking for.
-        - Verbose: if >0, reports the indexes.
+        - lanes: iterable of pairs (edge id, array with the coordinates of a lane).
+        - polys: Geoseries object with the plygons.
+        - grid: optional ZoneGrid of `polys`; the lanes far from the borders of
+          the zones are classified with it, and the rest with the STRtree.
     Outputs:
-        - A list with the indexes in mapRoot where are located the edges allowed for `allowedTypes`.
+        - A dictionary where at polys.index[i] is the set of edges intersecting poly[i].
     """
-    allowedTypes = set(allowedTypes)
-
-    # Getting the allowed edges
-    allowedIndexs = [] # To save the index of the allowed edges
-    for i in range(len(mapRoot)):
-        if mapRoot[i].tag == "edge": # if it is an edge
-            try: # if it has an attribut 'type'
-                if mapRoot[i].attrib['type'] in allowedTypes:
-                    allowedIndexs.append(i)
-            except:
-                continue
-    if verbose > 1:
-        print("Indexs of the allowed edges:")
-        print(allowedIndexs)
-
-    return allowedIndexs
+    tazs = {polys.index[i] : set({}) for i in range(len(polys))} #sets per zone
+    edge_ids = []
+    coords = []
+    for edge_id, shape in lanes:
+        edge_ids.append(edge_id)
+        coords.append(shape)
+    if len(coords) == 0:
+        return tazs
+    print("Lanes to classify: {0}".format(len(coords)))
+    count("lanes", len(coords))
+
+    if grid is not None:
+        lines_idx, polys_idx = grid.classifyLines(coords)
+    else:
+        # All the lanes are built in a single call
+        sizes = np.array([len(c) for c in coords])
+        lines = shapely.linestrings(np.concatenate(coords), indices=np.repeat(np.arange(len(coords)), sizes))
+
+        tree = STRtree(np.asarray(polys.values))
+        lines_idx, polys_idx = tree.query(lines, predicate='intersects')
+    for l, p in zip(lines_idx, polys_idx):
+        tazs[polys.index[p]].add(edge_ids[l])
+    return tazs
 
 def classifyEdges(mapRoot, allowedIndexs, polys, offset=(0,0)):
     """
@@ -104,14 +98,27 @@ def classifyEdges(mapRoot, allowedIndexs, polys, offset=(0,0)):
 
         The last one can be seen in the header of the network if necessary.
     """
+    return classifyLanes(laneShapes(mapRoot, allowedIndexs, offset), polys)
+
+def classifyEdgesBruteForce(mapRoot, allowedIndexs, polys, offset=(0,0)):
+    """
+    Reference version of classifyEdges, that tests every lane against every
+    polygon. It is much slower, but it is kept to check the results of
+    classifyEdges.
+    Inputs:
+        - mapRoot: An fcd-export type from xml.etree.ElementTree, that correspond to the root of net.xml.
+        - allowedIdexes: indexes in mapRoot where are located the edges to classify.
+        - polys: Geoseries object with the plygons.
+        - offset: a pair with a bias for the coordinates in `polys`.
+
+        The last one can be seen in the header of the network if necessary.
+    """
     n = len(polys)
     ## Classification of the edges per zone ##
     tazs = {polys.index[i] : set({}) for i in range(n)} #sets per zone
     k=0
-    K = len(allowedIndexs) // 10
     for index in allowedIndexs: #for every permitted edge
-        if k%K == 0:
-            print(str(k/len(allowedIndexs)))
+        progress("classifyEdgesBruteForce", k, len(allowedIndexs), "edges")
         k+=1
         for lane in mapRoot[index]: #for all the lanes in the edge
             coordStrings = lane.attrib['shape'].split(' ') #Split in coordinates
@@ -128,150 +135,80 @@ def classifyEdges(mapRoot, allowedIndexs, polys, offset=(0,0)):
                     tazs[polys.index[i]].add(mapRoot[index].attrib['id'])
     return tazs
 
-def writeTazFile(tazFile_path, zones_path, tazs, zones_req=None, offset=(0,0)):
+def writeTazFile(tazFile_path, zones, tazs, zones_req=None, offset=(0,0)):
     """
     Write a xml docment with the regions in TAZ format, of `zones_req`
-    with the coordinates in `zones_path` and edges in `tazs`.
+    with the coordinates in `zones` and edges in `tazs`.
     Inputs:
         - tazFile_path: path of the output file.
-        - zones_path: path to the geojson file.
+        - zones: path to the geojson file, or its ZoneModel (with the offset).
         - tazs: a dictionary where at k, are located the edges of zone k.
         - zones_req: if you don't want all the zones in the geojson to be plot.
 
     Outputs:
         - tazFile_path xml file.
     """
-    offset = np.array(offset)
-    ## read geojson
-    zones = gpd.read_file(zones_path)
+    model = zones if isinstance(zones, ZoneModel) else loadZoneModel(zones, offset)
+    if zones_req == None:
+        zones_req = model.ids.tolist()
+    colours = ["blue", "red", "green"]
+
     ## Open output file
     fout = open(tazFile_path,'w')
     # Header
     fout.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n\n")
     fout.write("<additional xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\" xsi:noNamespaceSchemaLocation=\"http://sumo.dlr.de/xsd/additional_file.xsd\">\n")
 
-    colours = ["blue", "red", "green"]
-    n = len(zones.OBJECTID)
-
-    if zones_req == None:
-        zones_req = [a for a in range(n)]
-
-    # For all the geometries in the geojson
+    # A taz per zone, or per part of the MultiPolygons (the edges go in the last one)
     for i in zones_req:
-        arr = np.array(mapping(zones.geometry[i-1])["coordinates"][0]) # get coords
-        if type(arr[0][0]) == np.float64: # if it's one piece
-            fout.write("<taz id=\"taz_{0}\" color=\"{1}\" shape=\"".format(i, colours[i%3]))
-
-            to_print = arr[0] + offset
-            fout.write("{0},{1}".format(to_print[0], to_print[1]))
-
-            for a in arr[1:]:
-                to_print = a + offset
-                fout.write(" {0},{1}".format(to_print[0], to_print[1]))
-            fout.write("\">\n")
-        else: # if there are more then one pieces
-            #print(i+1)
-            e=0
-            for e, b in enumerate(np.array(mapping(zones.geometry[i])["coordinates"])):
-                fout.write("<taz id=\"taz_{0}#{2}\" color=\"{1}\" shape=\"" .format(i+1, colours[i%3], e))
-                bb = np.array(b[0])
-
-                to_print = bb[0] + offset
-                fout.write("{0},{1}".format(to_print[0], to_print[1]))
-
-                for a in bb[1:]:
-                    to_print = a + offset
-                    fout.write(" {0},{1}".format(to_print[0], to_print[1]))
-                fout.write("\">\n")
-                if e < len(mapping(zones.geometry[i])["coordinates"])-1:
-                    fout.write("</taz>\n")
+        shapes = model.shapes(i)
+        if not model.multi[model.index(i)]:
+            lines = ["<taz id=\"taz_{0}\" color=\"{1}\" shape=\"{2}\">\n".format(i, colours[i%3], shapes[0])]
+        else:
+            lines = ["<taz id=\"taz_{0}#{2}\" color=\"{1}\" shape=\"{3}\">\n".format(i, colours[i%3], e, shape)
+                     for e, shape in enumerate(shapes)]
         # Write edges
-        for lane in tazs[i]:
-            fout.write("<tazSource weight=\"1.00\" id=\"{0}\"/> \n".format(lane))
-            fout.write("<tazSink weight=\"1.00\" id=\"{0}\"/> \n".format(lane))
-        fout.write("</taz>\n")
+        count("taz_edges", len(tazs[i]))
+        edges = "".join("<tazSource weight=\"1.00\" id=\"{0}\"/> \n<tazSink weight=\"1.00\" id=\"{0}\"/> \n".format(lane)
+                        for lane in tazs[i])
+        fout.write("</taz>\n".join(lines) + edges + "</taz>\n")
 
     fout.write("</additional>\n\n") # Clousure
 
     fout.close()
 
 
-def daterange(start_date, end_date):
-    for n in range(int ((end_date - start_date).days)):
-        yield start_date + timedelta(n)
-
-# Clean Data
-def clean_data(df):
-    df = df.drop(['payment_type', 'fare_amount', 'extra', 'mta_tax', 'tip_amount',
-       'tolls_amount', 'improvement_surcharge'], axis = 1) # Delete non-necessary
-    df.tpep_pickup_datetime = pd.to_datetime(df.tpep_pickup_datetime,
-                                                 format='%Y-%m-%d %H:%M:%S')
-    df.tpep_dropoff_datetime = pd.to_datetime(df.tpep_dropoff_datetime,
-                                                 format='%Y-%m-%d %H:%M:%S')
-    return df
-
-def importDatabase(sdate, edate, dataset_path=None, verbose=1):
+def importDatabase(sdate, edate, dataset_path=None, verbose=1, chunksize=None, zones_req=None,
+                   source=None, workers=4):
     """
     Import the taxi databases in the interval [`sdate`, `edate`).
     Inputs:
         - sdate: string with the date in format yyyy/mm/dd (%Y/%m/%d).
         - edate: string in the same format yyyy/mm/dd (%Y/%m/%d).
-        - dataset_path: a path to the database. If you leave this in blank,
-          the dbs will be download first from internet and save in taxiDataFrame.csv
+        - dataset_path: a path to the database, a csv file or the directory of
+          a columnar cache. If you leave this in blank, the months missing in
+          the cache taxiCache are downloaded first from internet.
         - verbose: if >0, print a summary.
+        - chunksize: if given, the data is streamed by pieces of `chunksize` rows.
+        - zones_req: keep only the trips between these zones.
+        - source: a local directory or the url of a mirror with the monthly
+          files, instead of the TLC site.
+        - workers: number of months downloaded at the same time.
     Outputs:
-        - A geopandas dataframe object.
+        - A geopandas dataframe object, or a generator of dataframes if
+          `chunksize` is given.
     """
     # Time definitions
-    sdate = (int(sdate[0:4]), int(sdate[5:7]), int(sdate[8:]))
-    edate = (int(edate[0:4]), int(edate[5:7]), int(edate[8:]))
-    start_date = datetime.datetime(*sdate, 0, 0, 0)
-    end_date = datetime.datetime(*edate, 0, 0, 0)
-
-    # Load database
-    data = []
-    lastMonth = 12
+    start_date = parseDate(sdate)
+    end_date = parseDate(edate)
 
+    cache_dir = None
     if dataset_path == None:
-        print("Reading dataset from internet.")
-        if sdate[0] == edate[0]: # Same year
-            lastMonth = edate[1]
-
-        # First year
-        for i in range(sdate[1], lastMonth+1):
-            url = "https://s3.amazonaws.com/nyc-tlc/trip+data/yellow_tripdata_{0}-{1:02d}.csv".format(sdate[0], i)
-            print("Reading "+url)
-            data_taxis = pd.read_csv(url)
-            data_taxis = clean_data(data_taxis)
-            if i == sdate[1]:
-                data = data_taxis
-            else:
-                data = pd.concat([data, data_taxis], ignore_index=True)
-
-        # Years in the middle
-        for y in range(sdate[0]+1, edate[0]):
-            for i in range(1, 13):
-                url = "https://s3.amazonaws.com/nyc-tlc/trip+data/yellow_tripdata_{0}-{1:02d}.csv".format(y, i)
-                data_taxis = pd.read_csv(url)
-                print("Reading "+url)
-                data_taxis = clean_data(data_taxis)
-                data = pd.concat([data, data_taxis], ignore_index=True)
-
-        # Last year if first and last are not equal (otherwise, is included in first loop)
-        if sdate[0] != edate[0]:
-            for i in range(1, edate[1]+1):
-                url = "https://s3.amazonaws.com/nyc-tlc/trip+data/yellow_tripdata_{0}-{1:02d}.csv".format(edate[0], i)
-                data_taxis = pd.read_csv(url)
-                print("Reading "+url)
-                data_taxis = clean_data(data_taxis)
-                data = pd.concat([data, data_taxis], ignore_index=True)
-        print("Writing data in taxiDataFrame.csv file\n")
-        data.to_csv("taxiDataFrame.csv", sep=',')
-    else:
-        data = pd.read_csv(dataset_path)
-        data.tpep_pickup_datetime = pd.to_datetime(data.tpep_pickup_datetime,
-                                                     format='%Y-%m-%d %H:%M:%S')
-        print("Read dataset from {0}".format(dataset_path))
+        print("Reading dataset from the cache {0}.".format(CACHE_DIR))
+        cache_dir = CACHE_DIR
+    elif os.path.isdir(dataset_path):
+        print("Reading dataset from the cache {0}.".format(dataset_path))
+        cache_dir, dataset_path = dataset_path, None
 
     if verbose > 0:
         print("Dates:")
@@ -279,54 +216,140 @@ def importDatabase(sdate, edate, dataset_path=None, verbose=1):
         print(end_date)
         print("Seconds between them: {0}".format(abs(int((end_date-start_date).total_seconds()))))
 
+    if chunksize is not None:
+        return streamTrips(start_date, end_date, zones_req, chunksize, dataset_path, cache_dir,
+                           source=source, workers=workers)
+
+    if cache_dir is not None:
+        # Only the months, columns and rows required are read from the cache
+        chunks = list(streamTrips(start_date, end_date, zones_req, cache_dir=cache_dir,
+                                  source=source, workers=workers))
+        if len(chunks) == 0:
+            return pd.DataFrame(columns=TRIP_COLUMNS)
+        count("rows", sum(len(c) for c in chunks))
+        return pd.concat(chunks)
+
+    data = pd.read_csv(dataset_path)
+    count("rows", len(data))
+    data.tpep_pickup_datetime = pd.to_datetime(data.tpep_pickup_datetime,
+                                                 format='%Y-%m-%d %H:%M:%S')
+    print("Read dataset from {0}".format(dataset_path))
+
     data = data[(data['tpep_pickup_datetime'] >= start_date.strftime('%Y-%m-%d %H:%M:%S')) & (data['tpep_pickup_datetime'] < end_date.strftime('%Y-%m-%d %H:%M:%S'))]
+    if zones_req is not None:
+        data = data[data['PULocationID'].isin(zones_req) & data['DOLocationID'].isin(zones_req)]
 
     return data
 
-def writeTripsFile(tripsFile_path, zones_req, tazs, df, sdate, edate):
+TRIP_FORMAT = ("<trip id=\"{0}\" depart=\"{1}\" from=\"{2}\" to=\"{3}\" "
+               "type=\"private\" fromTaz=\"taz_{4}\" toTaz=\"taz_{5}\" "
+               "departLane=\"best\" departSpeed=\"0.0\" departPos=\"random_free\"/>\n")
+
+def edgeArrays(tazs):
+    """
+    Put the edges of `tazs` in numpy arrays, sorted inside every zone so the
+    sampling of edges does not depend on the order of the sets.
+    Outputs:
+        - Array with the edges of all the zones, one zone after the other.
+        - Arrays indexed by zone id with the position of the first edge of the
+          zone and its number of edges.
+    """
+    n = max([int(zone) for zone in tazs] + [0]) + 1
+    first = np.zeros(n, dtype=np.int64)
+    count = np.zeros(n, dtype=np.int64)
+    allEdges = []
+    for zone in sorted(tazs, key=int):
+        first[int(zone)] = len(allEdges)
+        count[int(zone)] = len(tazs[zone])
+        allEdges.extend(sorted(tazs[zone]))
+    return np.array(allEdges, dtype=object), first, count
+
+def formatTrips(df, zones_req, edges, start_date, rng):
+    """
+    Select the trips of `df` between `zones_req` with edges in both zones,
+    and format them as <trip> elements. The edges are chosen with two uniform
+    numbers per trip drawn from `rng`, so the result does not depend on how
+    the trips are split in dataframes.
+    Inputs:
+        - edges: the output of edgeArrays.
+        - rng: a numpy.random.Generator.
+    Outputs:
+        - Array with the depart of the trips in seconds from `start_date`.
+        - List with a line per trip.
+    """
+    allEdges, first, count = edges
+    withEdges = np.flatnonzero(count > 0)
+    mask = df.PULocationID.isin(withEdges) & df.DOLocationID.isin(withEdges)
+    if zones_req is not None:
+        mask &= df.PULocationID.isin(zones_req) & df.DOLocationID.isin(zones_req)
+    df = df[mask]
+
+    origins = df.PULocationID.values.astype(np.int64)
+    destinations = df.DOLocationID.values.astype(np.int64)
+    delta = df.tpep_pickup_datetime.values - np.datetime64(start_date)
+    departs = np.abs((delta / np.timedelta64(1, 's')).astype(np.int64))
+
+    u = rng.random((len(df), 2))
+    lanesPU = allEdges[first[origins] + (u[:, 0] * count[origins]).astype(np.int64)]
+    lanesDO = allEdges[first[destinations] + (u[:, 1] * count[destinations]).astype(np.int64)]
+
+    lines = [TRIP_FORMAT.format(*trip) for trip in zip(df.index.tolist(), departs.tolist(),
+                                                        lanesPU, lanesDO,
+                                                        origins.tolist(), destinations.tolist())]
+    return departs, lines
+
+ROUTES_HEADER = "<routes xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\" xsi:noNamespaceSchemaLocation=\"http://sumo.dlr.de/xsd/routes_file.xsd\">\n"
+ROUTES_FOOTER = "</routes>\n"
+
+def writeTripsFile(tripsFile_path, zones_req, tazs, df, sdate, edate, seed=None, block_size=100000,
+                   sort=False, shard_seconds=None, run_size=1000000):
     """
         Given some zones, the edges in the zones, the taxi dataset and
         `sdate`, `edate`, write a xml with the trips from the data frame
         using random edges.
+        `df` can also be an iterable of dataframes, as returned by
+        importDatabase in streaming mode.
+        The edges are drawn with a numpy.random.Generator seeded with `seed`,
+        so a fixed seed gives the same file, whatever the size of the chunks.
+        Trips are formatted and written by blocks of `block_size`.
+        If `sort` is True, the trips are written sorted by depart time (with an
+        external merge sort over runs of `run_size` trips), so the routes do not
+        need to be sorted after duarouter. With `shard_seconds`, the sorted
+        trips are also split in a file per time window (see SortedTripsWriter).
     """
-    sdate = (int(sdate[0:4]), int(sdate[5:7]), int(sdate[8:]))
-    edate = (int(edate[0:4]), int(edate[5:7]), int(edate[8:]))
-    start_date = datetime.datetime(*sdate, 0, 0, 0)
-    end_date = datetime.datetime(*edate, 0, 0, 0)
+    start_date = parseDate(sdate)
     ## Creating the routes file ##
     print("Writing routes...")
-    fout = open(tripsFile_path,'w')
-    # Header
-    fout.write("<routes xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\" xsi:noNamespaceSchemaLocation=\"http://sumo.dlr.de/xsd/routes_file.xsd\">\n")
+    if sort or shard_seconds is not None:
+        writer = SortedTripsWriter(tripsFile_path, ROUTES_HEADER, ROUTES_FOOTER, run_size, shard_seconds)
+        write = writer.add
+    else:
+        fout = open(tripsFile_path,'w')
+        # Header
+        fout.write(ROUTES_HEADER)
+        write = lambda departs, lines: fout.write("".join(lines))
 
-    n = len(df.VendorID)
+    frames = [df] if isinstance(df, pd.DataFrame) else df
+    edges = edgeArrays(tazs)
+    rng = np.random.default_rng(seed)
 
     n_trips = 0
-    for k in df.index[0:n]:
-        zoneOrigin = int(df.PULocationID[k])
-        zoneDestiny = int(df.DOLocationID[k])
-
-        if zoneOrigin not in zones_req:
-            continue
-        if zoneDestiny not in zones_req:
-            continue
-
-        dateTrip = df.tpep_pickup_datetime[k]
-        secondsTrip = abs(int((dateTrip-start_date).total_seconds()))
-
-        lanePU = random.choice(list(tazs[zoneOrigin]))
-        laneDO = random.choice(list(tazs[zoneDestiny]))
-
-        fout.write("<trip id=\"{0}\" depart=\"{1}\" ".format(k, secondsTrip))
-        fout.write("from=\"{0}\" to=\"{1}\" ".format(lanePU, laneDO))
-
-        fout.write("type=\"private\" fromTaz=\"taz_{0}\" toTaz=\"taz_{1}\" ".format(zoneOrigin, zoneDestiny))
-        fout.write("departLane=\"best\" departSpeed=\"0.0\" departPos=\"random_free\"/>\n")
-        n_trips += 1
-
-    # Footer
-    fout.write("</routes>\n")
-    fout.close()
+    for df in frames:
+        for i in range(0, len(df), block_size):
+            departs, lines = formatTrips(df.iloc[i:i+block_size], zones_req, edges, start_date, rng)
+            write(departs, lines)
+            n_trips += len(lines)
+            count("trips", len(lines))
+            progress("writeTripsFile", n_trips, unit="trips")
+
+    if sort or shard_seconds is not None:
+        shards = writer.close(block_size)
+        if shards is not None:
+            print("Shards written: {0}".format(len(shards)))
+    else:
+        # Footer
+        fout.write(ROUTES_FOOTER)
+        fout.close()
     print("Trips saved:"+str(n_trips))
 
 def main():
@@ -334,7 +357,39 @@ def main():
     Read some parameters from a config file and build the trips using them.
 
     """
-    fin = open(sys.argv[1],'r')
+    parser = argparse.ArgumentParser(description="Trips generator for yellow cabs in NYC")
+    parser.add_argument("config", help="path to the configuration file")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="stream the trips by pieces of this number of rows")
+    parser.add_argument("--source", default=None,
+                        help="local directory or mirror url with the monthly trip files")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of months downloaded at the same time")
+    parser.add_argument("--taz-cache", default=TAZ_CACHE_DIR,
+                        help="directory of the cache of the edges classification")
+    parser.add_argument("--rebuild-taz-cache", action="store_true",
+                        help="classify the edges again even if they are in the cache")
+    parser.add_argument("--zone-cache", default=ZONE_CACHE_DIR,
+                        help="directory of the binary cache of the zones")
+    parser.add_argument("--zone-grid", default=None,
+                        help="path (.npy) of a zone raster grid used to classify the edges, built if it does not exist")
+    parser.add_argument("--grid-resolution", type=float, default=50.0,
+                        help="size of the cells of the zone grid")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed for the random choice of edges")
+    parser.add_argument("--sort", action="store_true",
+                        help="write the trips sorted by depart time")
+    parser.add_argument("--shard-hours", type=float, default=None,
+                        help="split the sorted trips in a file per window of this number of hours")
+    parser.add_argument("--run-size", type=int, default=1000000,
+                        help="trips sorted in memory at once when sorting")
+    parser.add_argument("--only", default=None, choices=['taz', 'import', 'trips'],
+                        help="run only a part: the TAZ file, the import of the trips to the cache, or the trips file")
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.report, args.profile, script="tripsGenerator", args=vars(args))
+
+    fin = open(args.config,'r')
     ## Definition of some variables##
     # path to geojson with the zones
     zones_path = fin.readline()[:-1] # "taxi_zones.geojson"
@@ -356,14 +411,14 @@ def main():
     edate = fin.readline()[:-1] #'2017/12/31'
 
     zones_reqString = fin.readline()[:-1].split(',')
-    if zones_reqString == 'all':
+    if zones_reqString == ['all']:
         zones_req = None
     else:
         zones_req = [int(a) for a in zones_reqString] #[140, 141, 236, 237, 262, 263]
 
-    carType = fin.readline() # private
-    allowedTypesString = fin.readline()[:-1].split(',')
-    if allowedTypesString != 'none':
+    carType = fin.readline().strip() # private
+    allowedTypesString = fin.readline().strip().split(',')
+    if allowedTypesString != ['none']:
         allowedTypes = set(allowedTypesString)
     else:
         allowedTypes = None
@@ -371,25 +426,58 @@ def main():
 
     fin.close()
 
-    polys = geojson2plygons(zones_path, zones_req)
-    nZones = len(polys)
-    print("Zones read: {0}.".format(nZones))
-
-    mapRoot = ET.parse(map_path).getroot() #read the net.xml file
-
-    if allowedTypes == None:
-        allowedTypes = getTypesAllowed(mapRoot, carType, verbose = 1)
-    print("Allowed types")
-    print(allowedTypes)
-
-    allowedEdges = getAllowedEdges(mapRoot, allowedTypes, verbose = 1)
-    tazs = classifyEdges(mapRoot, allowedEdges, polys, offset=offset)
-    writeTazFile(tazFile_path, zones_path, tazs, zones_req, offset=offset)
-    print("TAZ file wrote.")
-
-    df = importDatabase(sdate, edate, dataset_path)
-
-    writeTripsFile(tripsFile_path, zones_req, tazs, df, sdate, edate)
+    if args.only == 'import':
+        # Only fill the cache of the trips, for the next runs
+        cache_dir = CACHE_DIR if dataset_path is None else dataset_path
+        if os.path.isdir(cache_dir) or dataset_path is None:
+            with span("importDatabase"):
+                paths = cacheMonths(parseDate(sdate), parseDate(edate), cache_dir, source=args.source,
+                                    workers=args.workers)
+            print("Months in the cache {0}: {1}".format(cache_dir, len(paths)))
+        else:
+            print("The trips are read from {0}, nothing to import".format(dataset_path))
+        instrument.finish()
+        return
+
+    # The zones are read once, for the classification and the TAZ file
+    with span("loadZones"):
+        zones = loadZoneModel(zones_path, offset, args.zone_cache)
+
+    def classify():
+        polys = zones.polygons(zones_req)
+        nZones = len(polys)
+        print("Zones read: {0}.".format(nZones))
+
+        # The net.xml file is read in a single pass, keeping only the allowed edges
+        edges = iterEdges(map_path, carType, allowedTypes, offset=offset, verbose=1)
+        grid = None
+        if args.zone_grid is not None:
+            grid = loadOrBuildGrid(args.zone_grid, polys, args.grid_resolution, offset)
+        return classifyLanes(iterLanes(edges), polys, grid)
+
+    # The classification is only done if its inputs changed
+    with span("classifyEdges"):
+        key = tazCacheKey(zones_path, map_path, zones_req, allowedTypes, carType, offset)
+        tazs = cachedTazs(key, classify, args.taz_cache, rebuild=args.rebuild_taz_cache)
+    print("TAZ cache hits: {0}, misses: {1}".format(CACHE_STATS['hits'], CACHE_STATS['misses']))
+    if args.only != 'trips':
+        with span("writeTazFile"):
+            writeTazFile(tazFile_path, zones, tazs, zones_req, offset=offset)
+        print("TAZ file wrote.")
+    if args.only == 'taz':
+        instrument.finish()
+        return
+
+    with span("importDatabase"):
+        df = importDatabase(sdate, edate, dataset_path, chunksize=args.chunksize, zones_req=zones_req,
+                            source=args.source, workers=args.workers)
+
+    # In streaming mode, the trips are read while they are written
+    with span("writeTripsFile"):
+        shard_seconds = None if args.shard_hours is None else int(args.shard_hours * 3600)
+        writeTripsFile(tripsFile_path, zones_req, tazs, df, sdate, edate, seed=args.seed,
+                       sort=args.sort, shard_seconds=shard_seconds, run_size=args.run_size)
+    instrument.finish()
     print("\nProgram ends successfully!")
 
 if __name__ == '__main__':
@@ -0,0 +1,239 @@
+import numpy as np
+import os
+import json
+import shapely
+from shapely.strtree import STRtree
+
+"""
+Raster of the zones to know in which zone is a coordinate without exact
+polygon tests. Every cell stores the index of the zone that contains it,
+OUTSIDE if it does not touch any zone, or BOUNDARY if it touches more than
+one zone (or the border of one); only the points in BOUNDARY cells need the
+exact test, so the results are the same as with the polygons.
+"""
+
+OUTSIDE = -1
+BOUNDARY = -2
+
+def firstZone(points_idx, zones_idx, n):
+    """
+    From the pairs (point, zone) of an STRtree query, the lowest zone index
+    of each of the `n` points, OUTSIDE for the points without zone.
+    """
+    zones = np.full(n, OUTSIDE, dtype=np.int64)
+    order = np.lexsort((zones_idx, points_idx))[::-1] # the lowest zone is written last
+    zones[points_idx[order]] = zones_idx[order]
+    return zones
+
+class ZoneGrid:
+    """
+    Grid with cells of `resolution` x `resolution` over the polygons in
+    `polys` (a GeoSeries). Coordinates are in the frame of the polygons, that
+    is, the SUMO coordinates minus `offset`.
+    """
+    def __init__(self, cells, origin, resolution, offset, zones, polys):
+        self.cells = cells
+        self.origin = np.array(origin, dtype=float)
+        self.resolution = float(resolution)
+        self.offset = tuple(float(o) for o in offset)
+        self.zones = list(zones)
+        self.polys = polys
+        self.tree = STRtree(np.asarray(polys.values))
+        self.safe = None
+
+    @classmethod
+    def build(cls, polys, resolution=50.0, offset=(0,0), batch=200000):
+        """
+        Classify the cells of the grid that covers `polys`, with a margin of
+        one cell, testing the cells by batches against an STRtree of the zones.
+        """
+        tree = STRtree(np.asarray(polys.values))
+        minx, miny, maxx, maxy = polys.total_bounds
+        origin = (minx - resolution, miny - resolution)
+        nx = int(np.ceil((maxx - minx) / resolution)) + 2
+        ny = int(np.ceil((maxy - miny) / resolution)) + 2
+
+        cells = np.full(nx * ny, OUTSIDE, dtype=np.int32)
+        for start in range(0, nx * ny, batch):
+            ids = np.arange(start, min(start + batch, nx * ny))
+            x0 = origin[0] + (ids % nx) * resolution
+            y0 = origin[1] + (ids // nx) * resolution
+            boxes = shapely.box(x0, y0, x0 + resolution, y0 + resolution)
+
+            boxes_idx, zones_idx = tree.query(boxes, predicate='intersects')
+            hits = np.bincount(boxes_idx, minlength=len(ids))
+            within = np.zeros(len(ids), dtype=bool)
+            within[tree.query(boxes, predicate='within')[0]] = True
+
+            block = np.full(len(ids), OUTSIDE, dtype=np.int32)
+            block[hits > 0] = BOUNDARY
+            single = (hits == 1) & within
+            block[boxes_idx[single[boxes_idx]]] = zones_idx[single[boxes_idx]]
+            cells[ids] = block
+        return cls(cells.reshape(ny, nx), origin, resolution, offset, polys.index, polys)
+
+    def save(self, path):
+        """
+        Save the cells in the .npy file `path` (memory-mappable) and the
+        parameters of the grid in `path`.json.
+        """
+        with open(path, 'wb') as fout:
+            np.save(fout, self.cells)
+        with open(path + ".json", 'w') as fout:
+            json.dump({'origin': self.origin.tolist(), 'resolution': self.resolution,
+                       'offset': list(self.offset), 'zones': [int(z) for z in self.zones]}, fout)
+
+    @classmethod
+    def load(cls, path, polys, offset=None):
+        """
+        Load a grid saved with `save`, mapping the cells in memory. The zones of
+        `polys` (and the offset, if given) must be the ones of the grid.
+        """
+        meta = json.load(open(path + ".json"))
+        if meta['zones'] != [int(z) for z in polys.index]:
+            raise ValueError("The zone grid {0} was built for other zones".format(path))
+        if offset is not None and tuple(meta['offset']) != tuple(float(o) for o in offset):
+            raise ValueError("The zone grid {0} was built for the offset {1}".format(path, meta['offset']))
+        cells = np.load(path, mmap_mode='r')
+        return cls(cells, meta['origin'], meta['resolution'], meta['offset'], meta['zones'], polys)
+
+    def cellsOf(self, x, y, cells=None):
+        """
+        Value of the cells with the points (`x`, `y`), OUTSIDE out of the grid.
+        """
+        cells = self.cells if cells is None else cells
+        ix = np.floor((np.asarray(x) - self.origin[0]) / self.resolution).astype(np.int64)
+        iy = np.floor((np.asarray(y) - self.origin[1]) / self.resolution).astype(np.int64)
+        ny, nx = cells.shape
+        valid = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        values = np.full(len(ix), OUTSIDE, dtype=np.int32)
+        values[valid] = cells[iy[valid], ix[valid]]
+        return values
+
+    def countPoints(self, x, y):
+        """
+        Number of points (`x`, `y`) in every zone. A point in the border of
+        two zones counts in both, as with `intersects`.
+        """
+        values = self.cellsOf(x, y)
+        counts = np.bincount(values[values >= 0], minlength=len(self.zones))
+        boundary = values == BOUNDARY
+        if boundary.any():
+            _, zones_idx = self.tree.query(shapely.points(np.asarray(x)[boundary], np.asarray(y)[boundary]),
+                                           predicate='intersects')
+            counts += np.bincount(zones_idx, minlength=len(self.zones))
+        return counts
+
+    def queryPoints(self, x, y):
+        """
+        Pairs (point index, zone index) of the points (`x`, `y`) in every zone,
+        like STRtree.query with `intersects`, sorted by point.
+        """
+        values = self.cellsOf(x, y)
+        inside = np.flatnonzero(values >= 0)
+        boundary = np.flatnonzero(values == BOUNDARY)
+        points_idx, zones_idx = self.tree.query(shapely.points(np.asarray(x)[boundary], np.asarray(y)[boundary]),
+                                                predicate='intersects')
+        points_idx = np.concatenate([inside, boundary[points_idx]])
+        zones_idx = np.concatenate([values[inside].astype(np.int64), zones_idx])
+        order = np.argsort(points_idx, kind='stable')
+        return points_idx[order], zones_idx[order]
+
+    def lookup(self, x, y):
+        """
+        Index of the zone of every point (`x`, `y`), OUTSIDE if it is in none.
+        For points in several zones, the first one is returned.
+        """
+        values = self.cellsOf(x, y)
+        boundary = np.flatnonzero(values == BOUNDARY)
+        if len(boundary) > 0:
+            points_idx, zones_idx = self.tree.query(shapely.points(np.asarray(x)[boundary], np.asarray(y)[boundary]),
+                                                    predicate='intersects')
+            values[boundary] = firstZone(points_idx, zones_idx, len(boundary))
+        return values
+
+    def _safeCells(self):
+        """
+        Cells whose 8 neighbours have the same value. A segment shorter than the
+        resolution that starts in one of them does not leave its 3x3 block.
+        """
+        if self.safe is None:
+            padded = np.pad(np.asarray(self.cells), 1, constant_values=OUTSIDE)
+            ny, nx = self.cells.shape
+            safe = np.array(self.cells)
+            for dy in range(3):
+                for dx in range(3):
+                    safe[padded[dy:dy+ny, dx:dx+nx] != self.cells] = BOUNDARY
+            self.safe = safe
+        return self.safe
+
+    def classifyLines(self, coords):
+        """
+        Zones intersected by the lines with vertices `coords` (list of arrays
+        of shape (n, 2)). Lines are densified to the resolution of the grid; the
+        ones whose points fall in safe cells of a single zone are classified by
+        the grid, the rest with the exact test.
+        Outputs:
+            - Arrays (lines index, zones index), like STRtree.query.
+        """
+        if len(coords) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        sizes = np.array([len(c) for c in coords])
+        lines = shapely.linestrings(np.concatenate(coords), indices=np.repeat(np.arange(len(coords)), sizes))
+        points, lines_of_points = shapely.get_coordinates(shapely.segmentize(lines, self.resolution / 2),
+                                                          return_index=True)
+        values = self.cellsOf(points[:, 0], points[:, 1], self._safeCells())
+
+        starts = np.searchsorted(lines_of_points, np.arange(len(coords)))
+        low = np.minimum.reduceat(values, starts)
+        high = np.maximum.reduceat(values, starts)
+        uniform = (low == high) & (low != BOUNDARY)
+
+        inside = np.flatnonzero(uniform & (low >= 0))
+        exact = np.flatnonzero(~uniform)
+        exact_lines, zones_idx = self.tree.query(lines[exact], predicate='intersects')
+        lines_idx = np.concatenate([inside, exact[exact_lines]])
+        zones_idx = np.concatenate([low[inside], zones_idx])
+        order = np.argsort(lines_idx, kind='stable')
+        return lines_idx[order], zones_idx[order].astype(np.int64)
+
+    def accuracyReport(self, x=None, y=None, n=100000, seed=0):
+        """
+        Compare the grid with the exact test on the points (`x`, `y`), or on `n`
+        random points over the zones.
+        Outputs:
+            - Dictionary with the number of points, the fraction that needed the
+              exact test and the fraction where both methods agree.
+        """
+        if x is None:
+            rng = np.random.default_rng(seed)
+            minx, miny, maxx, maxy = self.polys.total_bounds
+            x = rng.uniform(minx, maxx, n)
+            y = rng.uniform(miny, maxy, n)
+        values = self.cellsOf(x, y)
+        points_idx, zones_idx = self.tree.query(shapely.points(x, y), predicate='intersects')
+        exact = firstZone(points_idx, zones_idx, len(x))
+        known = values != BOUNDARY
+        return {'points': int(len(x)),
+                'cells': int(self.cells.size),
+                'resolution': self.resolution,
+                'boundary_fraction': float(1 - known.mean()),
+                'agreement': float((self.lookup(x, y) == exact).mean()),
+                'agreement_without_fallback': float((values[known] == exact[known]).mean()) if known.any() else 1.0}
+
+def loadOrBuildGrid(path, polys, resolution=50.0, offset=(0,0), verbose=1):
+    """
+    Load the grid in `path` or build it and save it there if it does not exist.
+    """
+    if os.path.exists(path) and os.path.exists(path + ".json"):
+        try:
+            grid = ZoneGrid.load(path, polys, offset)
+            if grid.resolution == float(resolution):
+                return grid
+        except ValueError as e: # Built for other zones, it is built again
+            print(e)
+    grid = ZoneGrid.build(polys, resolution, offset)
+    grid.save(path)
+    if verbose > 0:
+        print("Zone grid saved in {0}: {1}".format(path, grid.accuracyReport()))
+    return grid
@@ -0,0 +1,307 @@
+import numpy as np
+import os
+import json
+import argparse
+from fcd2counts import FcdCounter, zones_path, fcd_path, req_polys, offset, interv, time_laps, begin_value
+from fcdStore import iterTimesteps
+from zoneGrid import firstZone
+from zoneModel import ZONE_CACHE_DIR
+from npyWriter import NpyWriter
+import instrument
+from instrument import span, count, progress
+
+"""
+Several metrics per zone from the FCD output of SUMO in a single pass over
+the timesteps (sampled every `interv` seconds), in windows of `time_laps`
+seconds like `fcd2counts.py --label-start` (the row k is the k-th window
+that begins at a timestep multiple of `time_laps`, labelled by its start):
+    - occupancy: max (the counts of fcd2counts.py) and mean number of vehicles.
+    - flows: vehicles that enter and exit every zone.
+    - dwell: mean time in the zone of the stays that end in the window.
+    - transitions: vehicles that go from a zone to another one, a matrix per
+      window comparable with the O/D matrices of generateOD.py.
+The fcd can be an fcd file (xml or xml.gz) or its columnar store (fcdStore.py).
+The rows are written as they are computed, a .npy file per metric.
+
+python3 zoneMetrics.py [--fcd sumo/fcd.txt] [--metrics occupancy,flows] [--output zone_metrics] [options]
+"""
+
+METRICS = ('occupancy', 'flows', 'dwell', 'transitions')
+
+class ZoneMetrics:
+    """
+    Aggregation of the metrics in `metrics` (names of METRICS) of the zones
+    of `counter` (an FcdCounter, with the zones, offset, interv, time_laps,
+    begin_value and label_start). The zone of every vehicle is tracked in
+    arrays indexed by its vehicle code; a vehicle in the border of two zones
+    counts in both for the occupancy, and is in the lowest of them for the
+    other metrics.
+    A stay in a zone begins when the vehicle is sampled in it and ends when
+    it is sampled out of it or it leaves the simulation. A transition from
+    zone A to zone B is counted when a vehicle enters B and the last zone
+    where it was is A, even if it went out of all the zones in between.
+    The rows of the windows are written with `writer` (a MetricsWriter).
+    """
+    def __init__(self, counter, writer, metrics=METRICS):
+        unknown = set(metrics) - set(METRICS)
+        if len(unknown) > 0:
+            raise ValueError("Unknown metrics: {0}".format(", ".join(sorted(unknown))))
+        self.counter = counter
+        self.writer = writer
+        self.metrics = [m for m in METRICS if m in metrics]
+        self.n_zones = counter.n_polys
+        self.tracking = any(m in self.metrics for m in ('flows', 'dwell', 'transitions'))
+        # State of the vehicles, by code
+        self.zone = np.zeros(0, dtype=np.int64) # current zone, -1 if out of all of them
+        self.last_zone = np.zeros(0, dtype=np.int64) # last zone visited, -1 if none
+        self.enter_time = np.zeros(0, dtype=np.float64) # time of the entry in the current zone
+        self.stamp = np.zeros(0, dtype=np.int64) # last sample where the vehicle was seen
+        self.previous = np.zeros(0, dtype=np.int32) # vehicles of the last sample
+        self.samples = 0
+        self.n_rows = 0
+        self.started = False # a timestep multiple of time_laps was reached
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new window.
+        """
+        n = self.n_zones
+        self.window = {'occupancy_max': np.zeros(n, dtype=np.int64), 'occupancy_sum': np.zeros(n, dtype=np.int64),
+                       'window_samples': 0, 'entries': np.zeros(n, dtype=np.int64),
+                       'exits': np.zeros(n, dtype=np.int64), 'dwell_sum': np.zeros(n, dtype=np.float64),
+                       'stays': np.zeros(n, dtype=np.int64), 'transitions': np.zeros((n, n), dtype=np.int64)}
+
+    def close(self):
+        """
+        Write the metrics of the current window as a row and start another
+        one. With the `label_start` of the counter, the window before the
+        first timestep multiple of `time_laps` is not written.
+        """
+        if not self.started:
+            self.started = True
+            if self.counter.label_start:
+                self.reset()
+                return
+        w = self.window
+        values = {}
+        if 'occupancy' in self.metrics:
+            values['occupancy_max'] = w['occupancy_max']
+            values['occupancy_mean'] = w['occupancy_sum'] / max(w['window_samples'], 1)
+        if 'flows' in self.metrics:
+            values['entries'], values['exits'] = w['entries'], w['exits']
+        if 'dwell' in self.metrics:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values['dwell_mean'] = np.where(w['stays'] > 0, w['dwell_sum'] / w['stays'], np.nan)
+            values['stays'] = w['stays']
+        if 'transitions' in self.metrics:
+            values['transitions'] = w['transitions']
+        self.writer.write(values)
+        self.n_rows += 1
+        self.reset()
+
+    def grow(self, n):
+        """
+        Make room in the state arrays for the vehicle codes below `n`.
+        """
+        size = len(self.zone)
+        if n <= size:
+            return
+        extra = max(n, 2*size) - size
+        self.zone = np.concatenate([self.zone, np.full(extra, -1, dtype=np.int64)])
+        self.last_zone = np.concatenate([self.last_zone, np.full(extra, -1, dtype=np.int64)])
+        self.enter_time = np.concatenate([self.enter_time, np.zeros(extra)])
+        self.stamp = np.concatenate([self.stamp, np.full(extra, -1, dtype=np.int64)])
+
+    def leave(self, vehicles, time):
+        """
+        End the stays of `vehicles` (all of them in a zone) at `time`.
+        """
+        if len(vehicles) == 0:
+            return
+        zones = self.zone[vehicles]
+        w = self.window
+        w['exits'] += np.bincount(zones, minlength=self.n_zones)
+        w['stays'] += np.bincount(zones, minlength=self.n_zones)
+        w['dwell_sum'] += np.bincount(zones, weights=time - self.enter_time[vehicles], minlength=self.n_zones)
+        self.zone[vehicles] = -1
+
+    def sample(self, time, vehicles, x, y):
+        """
+        Add a sample of the vehicles with codes `vehicles` in the positions
+        (`x`, `y`) (SUMO coordinates) at `time`.
+        """
+        n = self.n_zones
+        w = self.window
+        points_idx, zones_idx = self.counter.point_zones(x, y)
+        count("vehicles", len(vehicles))
+        if 'occupancy' in self.metrics:
+            occupancy = np.bincount(zones_idx, minlength=n)
+            np.maximum(w['occupancy_max'], occupancy, out=w['occupancy_max'])
+            w['occupancy_sum'] += occupancy
+            w['window_samples'] += 1
+        self.samples += 1
+        if not self.tracking:
+            return
+
+        vehicles = np.asarray(vehicles, dtype=np.int64)
+        if len(vehicles) > 0:
+            self.grow(int(vehicles.max()) + 1)
+        current = firstZone(points_idx, zones_idx, len(vehicles))
+        # Vehicles of the last sample that left the simulation
+        self.stamp[vehicles] = self.samples
+        gone = self.previous[self.stamp[self.previous] != self.samples]
+        self.leave(gone[self.zone[gone] >= 0], time)
+        # Vehicles that changed of zone
+        changed = self.zone[vehicles] != current
+        leaving = vehicles[changed & (self.zone[vehicles] >= 0)]
+        self.leave(leaving, time)
+        entering = changed & (current >= 0)
+        new_zones = current[entering]
+        entering = vehicles[entering]
+        w['entries'] += np.bincount(new_zones, minlength=n)
+        last = self.last_zone[entering]
+        moved = (last >= 0) & (last != new_zones)
+        w['transitions'] += np.bincount(last[moved] * n + new_zones[moved], minlength=n*n).reshape(n, n)
+        self.last_zone[entering] = new_zones
+        self.enter_time[entering] = time
+        self.zone[entering] = new_zones
+        self.previous = vehicles
+
+    def run(self, timesteps):
+        """
+        Aggregate the tuples (time, vehicle codes, x, y) of `timesteps` (see
+        fcdStore.iterTimesteps, with None in the timesteps not sampled). As in
+        fcd2counts.py, a window ends at every timestep multiple of
+        `time_laps` and the last one, that is not closed, is not written.
+        With the `label_start` of the counter, the timesteps before the first
+        multiple are not written either (the vehicles seen in them are
+        tracked all the same).
+        Outputs:
+            - Number of rows written.
+        """
+        time_laps = self.counter.time_laps
+        for time, vehicles, x, y in timesteps:
+            if int(time) % time_laps == 0:
+                self.close()
+                progress("zoneMetrics", self.n_rows, unit="windows")
+            if vehicles is not None:
+                self.sample(time, vehicles, x, y)
+        return self.n_rows
+
+class MetricsWriter:
+    """
+    Write the rows of the metrics as they are computed: a .npy file per
+    metric (NpyWriter) in the directory `path`, and the zones, metrics and
+    times in `path`/meta.json. With `od_path`, the transitions are also
+    written in the .npy `od_path` indexed by zone id (see odLayout).
+    """
+    def __init__(self, path, zones, begin_value=0, time_laps=600, od_path=None, n_ids=264):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.zones = np.asarray(zones)
+        self.begin_value = begin_value
+        self.time_laps = time_laps
+        self.od_path = od_path
+        self.n_ids = n_ids
+        self.writers = {}
+        self.od_writer = None
+        self.rows = 0
+
+    def write(self, values):
+        """
+        Append a row with `values`, a dictionary metric -> array of the window.
+        """
+        for name, value in values.items():
+            if name not in self.writers:
+                self.writers[name] = NpyWriter(os.path.join(self.path, name + ".npy"), value.shape, value.dtype)
+            self.writers[name].write(value)
+        if self.od_path is not None and 'transitions' in values:
+            if self.od_writer is None:
+                self.od_writer = NpyWriter(self.od_path, (self.n_ids, self.n_ids), np.int64)
+            self.od_writer.write(odLayout(values['transitions'][None], self.zones, self.n_ids))
+        self.rows += 1
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        if self.od_writer is not None:
+            self.od_writer.close()
+        with open(os.path.join(self.path, "meta.json"), 'w') as fout:
+            json.dump({'zones': [int(z) for z in self.zones], 'metrics': sorted(self.writers),
+                       'begin_value': self.begin_value, 'time_laps': self.time_laps, 'rows': self.rows}, fout)
+
+def loadMetrics(path):
+    """
+    Read the metrics written by MetricsWriter in the directory `path`.
+    Outputs:
+        - Dictionary with `times` (start of every window), `zones` (OBJECTIDs)
+          and, per metric, arrays (windows, zones) mapped in memory:
+          occupancy_max, occupancy_mean, entries, exits, dwell_mean (seconds,
+          nan without stays), stays, and transitions (windows, zones, zones).
+    """
+    meta = json.load(open(os.path.join(path, "meta.json")))
+    results = {'times': meta['begin_value'] + np.arange(meta['rows']) * meta['time_laps'],
+               'zones': np.array(meta['zones'])}
+    for name in meta['metrics']:
+        results[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+    return results
+
+def odLayout(transitions, zones, n_ids=264):
+    """
+    Transitions (windows, zones, zones) in the layout of the O/D matrices of
+    generateOD.py, (windows, `n_ids`, `n_ids`) indexed by zone id.
+    """
+    zones = np.asarray(zones)
+    keep = np.flatnonzero(zones < n_ids)
+    OD = np.zeros((transitions.shape[0], n_ids, n_ids), dtype=transitions.dtype)
+    OD[:, zones[keep, None], zones[None, keep]] = transitions[:, keep[:, None], keep[None, :]]
+    return OD
+
+def main():
+    parser = argparse.ArgumentParser(description="Metrics per zone from a SUMO fcd output")
+    parser.add_argument("--zones", default=zones_path, help="geojson with the zones")
+    parser.add_argument("--fcd", default=fcd_path, help="path to the fcd file, or to its columnar store (fcdStore.py)")
+    parser.add_argument("--zones-req", default=",".join(map(str, req_polys)), help="OBJECTIDs of the zones")
+    parser.add_argument("--offset", default=",".join(map(str, offset)), help="offset of the network, x,y")
+    parser.add_argument("--interv", type=int, default=interv, help="seconds between the samples")
+    parser.add_argument("--time-laps", type=int, default=time_laps, help="size of the windows in seconds")
+    parser.add_argument("--begin", type=int, default=begin_value, help="time of the first row")
+    parser.add_argument("--zone-grid", default=None, help="zone raster grid (.npy), built if it does not exist")
+    parser.add_argument("--grid-resolution", type=float, default=50.0, help="size of the cells of the zone grid")
+    parser.add_argument("--zone-cache", default=ZONE_CACHE_DIR, help="directory of the binary cache of the zones")
+    parser.add_argument("--metrics", default=",".join(METRICS),
+                        help="metrics to compute, separated by commas ({0})".format(", ".join(METRICS)))
+    parser.add_argument("--output", default="zone_metrics", help="directory with a .npy per metric")
+    parser.add_argument("--od-output", default=None,
+                        help="write also the transitions as O/D matrices indexed by zone id (.npy, like generateOD.py)")
+    parser.add_argument("--od-ids", type=int, default=264, help="size of the O/D matrices of --od-output")
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    instrument.configure(args.report, args.profile, script="zoneMetrics", args=vars(args))
+
+    with span("loadZones"):
+        counter = FcdCounter(args.zones, [int(z) for z in args.zones_req.split(',')],
+                             tuple(float(o) for o in args.offset.split(',')),
+                             args.interv, args.time_laps, args.begin, args.zone_grid, args.grid_resolution,
+                             zone_cache=args.zone_cache, label_start=True)
+    print("Number of zones: "+str(counter.n_polys))
+
+    metric_names = args.metrics.split(',')
+    od_output = args.od_output
+    if od_output is not None and 'transitions' not in metric_names:
+        print("No O/D matrices without the metric transitions")
+        od_output = None
+    writer = MetricsWriter(args.output, list(counter.polys.index), args.begin, args.time_laps,
+                           od_output, args.od_ids)
+    metrics = ZoneMetrics(counter, writer, metric_names)
+    with span("aggregate"):
+        rows = metrics.run(iterTimesteps(args.fcd, args.interv))
+        writer.close()
+    print("Metrics saved in {0} ({1} windows): {2}".format(args.output, rows, ", ".join(metrics.metrics)))
+    if od_output is not None:
+        print("Transitions saved in {0}".format(od_output))
+    instrument.finish()
+
+if __name__ == '__main__':
+    main()
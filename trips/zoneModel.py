@@ -0,0 +1,130 @@
+import numpy as np
+import os
+import json
+import hashlib
+import shapely
+import geopandas as gpd
+from tazCache import fileHash, saveNpz
+
+"""
+Zones of the geojson, loaded once per process and kept in a binary cache.
+A ZoneModel has, by OBJECTID, the polygons in the coordinates of the geojson
+(for the queries of lanes and vehicles, whose coordinates have the offset
+subtracted) and the exterior rings of every part of the zone with the SUMO
+offset already added (for the TAZ shapes). The cache (zoneCache/<key>.npz,
+keyed by the hash of the geojson and the offset) has the geometries as WKB
+and the rings as arrays, so the geojson is not parsed again.
+"""
+
+ZONE_CACHE_DIR = "zoneCache"
+
+# Models of this process, by (geojson, offset, cache)
+MODELS = {}
+
+class ZoneModel:
+    """
+    Zones with OBJECTIDs `ids` and shapely `geometries`. The rings of the
+    parts are in `coords` (SUMO coordinates): the part p has the points
+    [ring_ptr[p], ring_ptr[p+1]) and the zone i the parts
+    [zone_ptr[i], zone_ptr[i+1]).
+    """
+    def __init__(self, ids, geometries, offset=(0,0), coords=None, ring_ptr=None, zone_ptr=None):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.geometries = np.asarray(geometries)
+        self.offset = tuple(float(o) for o in offset)
+        self.position = {int(z): i for i, z in enumerate(self.ids)}
+        self.multi = shapely.get_type_id(self.geometries) == 6 # MultiPolygons
+        if coords is None:
+            parts, part_zone = shapely.get_parts(self.geometries, return_index=True)
+            coords, part_idx = shapely.get_coordinates(shapely.get_exterior_ring(parts), return_index=True)
+            coords = coords + np.array(self.offset)
+            ring_ptr = np.concatenate([[0], np.cumsum(np.bincount(part_idx, minlength=len(parts)))])
+            zone_ptr = np.concatenate([[0], np.cumsum(np.bincount(part_zone, minlength=len(self.ids)))])
+        self.coords = coords
+        self.ring_ptr = ring_ptr
+        self.zone_ptr = zone_ptr
+
+    @classmethod
+    def fromGeojson(cls, zones_path, offset=(0,0)):
+        zones = gpd.read_file(zones_path)
+        return cls(zones['OBJECTID'].values, np.asarray(zones.geometry.values), offset)
+
+    def save(self, path, overwrite=True):
+        """
+        Save the model in the npz file `path`, with the geometries as WKB.
+        Without `overwrite`, an existing file is kept (see tazCache.saveNpz).
+        """
+        wkb = shapely.to_wkb(self.geometries)
+        wkb_ptr = np.concatenate([[0], np.cumsum([len(w) for w in wkb])])
+        saveNpz(path, overwrite, ids=self.ids, offset=np.array(self.offset),
+                wkb=np.frombuffer(b"".join(wkb), dtype=np.uint8), wkb_ptr=wkb_ptr,
+                coords=self.coords, ring_ptr=self.ring_ptr, zone_ptr=self.zone_ptr)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        wkb, wkb_ptr = data['wkb'].tobytes(), data['wkb_ptr']
+        geometries = shapely.from_wkb([wkb[wkb_ptr[i]:wkb_ptr[i+1]] for i in range(len(wkb_ptr) - 1)])
+        return cls(data['ids'], geometries, tuple(data['offset']), data['coords'], data['ring_ptr'], data['zone_ptr'])
+
+    def index(self, zone):
+        """
+        Position of the zone with OBJECTID `zone`.
+        """
+        if int(zone) not in self.position:
+            raise ValueError("Zone {0} is not in the geojson".format(zone))
+        return self.position[int(zone)]
+
+    def polygons(self, zones_req=None):
+        """
+        Geoseries with the geometries of `zones_req` (OBJECTIDs, all the zones
+        if None), indexed by OBJECTID, in the coordinates of the geojson.
+        """
+        zones_req = self.ids.tolist() if zones_req is None else [int(z) for z in zones_req]
+        return gpd.GeoSeries(list(self.geometries[[self.index(z) for z in zones_req]]), index=zones_req)
+
+    def rings(self, zone):
+        """
+        Exterior rings (arrays of points in SUMO coordinates) of the parts of
+        the zone `zone`.
+        """
+        i = self.index(zone)
+        return [self.coords[self.ring_ptr[p]:self.ring_ptr[p+1]] for p in range(self.zone_ptr[i], self.zone_ptr[i+1])]
+
+    def shapes(self, zone):
+        """
+        The rings of `zone` as SUMO shapes, "x,y x,y ...".
+        """
+        i = self.index(zone)
+        first, last = self.ring_ptr[self.zone_ptr[i]], self.ring_ptr[self.zone_ptr[i+1]]
+        points = self.coords[first:last].astype(str)
+        points = np.char.add(np.char.add(points[:, 0], ","), points[:, 1]).tolist()
+        return [" ".join(points[self.ring_ptr[p]-first:self.ring_ptr[p+1]-first])
+                for p in range(self.zone_ptr[i], self.zone_ptr[i+1])]
+
+def zoneCacheKey(zones_path, offset):
+    inputs = {'zones': fileHash(zones_path), 'offset': [float(offset[0]), float(offset[1])]}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def loadZoneModel(zones_path, offset=(0,0), cache_dir=ZONE_CACHE_DIR):
+    """
+    The ZoneModel of the geojson `zones_path` with `offset`, read only once
+    per process, from the cache in `cache_dir` if it is there (None to
+    always parse the geojson).
+    """
+    memo = (os.path.abspath(zones_path), tuple(float(o) for o in offset), cache_dir)
+    if memo in MODELS:
+        return MODELS[memo]
+    if cache_dir is None:
+        model = ZoneModel.fromGeojson(zones_path, offset)
+    else:
+        path = os.path.join(cache_dir, zoneCacheKey(zones_path, offset) + ".npz")
+        if os.path.exists(path):
+            model = ZoneModel.load(path)
+        else:
+            model = ZoneModel.fromGeojson(zones_path, offset)
+            os.makedirs(cache_dir, exist_ok=True)
+            # If another process saved it meanwhile, it is the same model
+            model.save(path, overwrite=False)
+    MODELS[memo] = model
+    return model